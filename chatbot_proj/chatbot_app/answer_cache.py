@@ -0,0 +1,274 @@
+"""Semantic cache of final answers, for near-duplicate questions.
+
+Many users ask the same question in different words. We embed the normalized
+message with the shared query encoder and look up the nearest previously
+answered question of the same role and building type (exact match: one index
+namespace per pair) in a local vector index. If it is similar enough
+(ANSWER_CACHE_SIMILARITY_THRESHOLD), its answer and cited sections are
+returned right away, skipping query expansion, retrieval and summarization.
+
+Entries expire after ANSWER_CACHE_TTL_SECONDS, the least recently used entries
+are evicted beyond ANSWER_CACHE_MAX_ENTRIES, and the whole cache is dropped
+when the corpus version changes (see retrieval.corpus_version).
+
+With ANSWER_CACHE_PATH set, the cache is also loaded from that file (answers
+of the current corpus version only) and reloaded whenever the file changes,
+checked at most every ANSWER_CACHE_RELOAD_SECONDS. The file is written by
+the pre-warming job (prewarm.py), so answers to popular questions are
+computed once, offline, and shared by every server process.
+"""
+
+import collections
+import dataclasses
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import typing
+
+import numpy as np
+from django.conf import settings
+
+from . import retrieval  # also puts embedding/ on sys.path
+import local_index  # noqa: E402
+
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.92
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_RELOAD_SECONDS = 30.0
+
+
+@dataclasses.dataclass
+class CachedAnswer:
+    entry_id: str
+    namespace: str
+    question: str
+    answer: str
+    sections: typing.List[typing.Dict[str, typing.Any]]
+    created_at: float
+    similarity: float = 1.0
+
+
+def _clean(text: str) -> str:
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+def normalize_question(user_message: str) -> str:
+    return _clean(user_message)
+
+
+def cache_namespace(user_role: str, building_type: str) -> str:
+    """Answers depend on the role and building type, so only questions with
+    the same (normalized) pair are compared."""
+    return f"role: {_clean(user_role)} | building type: {_clean(building_type)}"
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        encode: typing.Callable[[typing.List[str]], typing.List[typing.List[float]]],
+        corpus_version: typing.Callable[[], str],
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        path: typing.Optional[str] = None,
+        reload_seconds: float = DEFAULT_RELOAD_SECONDS,
+    ):
+        self.encode = encode
+        self.corpus_version = corpus_version
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self._loaded_mtime_ns: typing.Optional[int] = None
+        self._reload_checked = 0.0
+
+        self._lock = threading.Lock()
+        self._index = local_index.LocalIndex(metric="cosine")
+        self._entries: typing.OrderedDict[str, CachedAnswer] = collections.OrderedDict()
+        self._entry_ids = itertools.count()
+        # (namespace, question) -> created_at of entries evicted to stay under
+        # max_entries, so that reloading the file doesn't add them back
+        self._evicted: typing.Dict[typing.Tuple[str, str], float] = {}
+        self._version: typing.Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self):
+        version = self.corpus_version()
+        if version != self._version:
+            # answers cite sections of the old corpus; drop them all
+            self._index = local_index.LocalIndex(metric="cosine")
+            self._entries.clear()
+            self._evicted.clear()
+            self._version = version
+
+    def _evict(self, entry_ids: typing.List[str]):
+        by_namespace = collections.defaultdict(list)
+        for entry_id in entry_ids:
+            entry = self._entries.pop(entry_id, None)
+            if entry is not None:
+                by_namespace[entry.namespace].append(entry_id)
+        for namespace, ids in by_namespace.items():
+            self._index.delete(ids, namespace=namespace)
+
+    def lookup(self, user_role: str, building_type: str, user_message: str) -> typing.Optional[CachedAnswer]:
+        namespace = cache_namespace(user_role, building_type)
+        vector = self.encode([normalize_question(user_message)])[0]
+        self._maybe_reload()
+        with self._lock:
+            self._check_version()
+            result = self._index.query(vector=vector, top_k=1, namespace=namespace)
+            if not result["matches"] or result["matches"][0]["score"] < self.similarity_threshold:
+                self.misses += 1
+                return None
+
+            match = result["matches"][0]
+            entry = self._entries[match["id"]]
+            if time.time() - entry.created_at > self.ttl_seconds:
+                self._evict([entry.entry_id])
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(entry.entry_id)
+            self.hits += 1
+            return dataclasses.replace(entry, similarity=match["score"])
+
+    def store(
+        self,
+        user_role: str,
+        building_type: str,
+        user_message: str,
+        answer: str,
+        sections: typing.List[typing.Dict[str, typing.Any]],
+    ):
+        namespace = cache_namespace(user_role, building_type)
+        question = normalize_question(user_message)
+        vector = self.encode([question])[0]
+        with self._lock:
+            self._check_version()
+            self._evicted.pop((namespace, question), None)
+            self._insert(namespace, question, answer, sections, time.time(), vector)
+            self._evict_stale()
+
+    def _insert(self, namespace, question, answer, sections, created_at, vector):
+        entry_id = str(next(self._entry_ids))
+        self._entries[entry_id] = CachedAnswer(entry_id, namespace, question, answer, sections, created_at)
+        self._index.upsert([{"id": entry_id, "values": vector}], namespace=namespace)
+
+    def _evict_stale(self):
+        now = time.time()
+        expired = {e.entry_id for e in self._entries.values() if now - e.created_at > self.ttl_seconds}
+        overflow = max(0, len(self._entries) - len(expired) - self.max_entries)
+        # OrderedDict keeps least recently used entries first
+        lru = [entry_id for entry_id in self._entries if entry_id not in expired][:overflow]
+        for entry_id in lru:
+            entry = self._entries[entry_id]
+            self._evicted[(entry.namespace, entry.question)] = entry.created_at
+        self._evicted = {
+            key: created_at for key, created_at in self._evicted.items() if now - created_at <= self.ttl_seconds
+        }
+        self._evict(list(expired) + lru)
+
+    def save(self, path: typing.Optional[str] = None):
+        """Write the entries, their vectors and the corpus version to one
+        .npz file (atomically: readers never see half a file)."""
+        path = path or self.path
+        with self._lock:
+            self._check_version()
+            entries = list(self._entries.values())
+            vectors = {}
+            for namespace in {entry.namespace for entry in entries}:
+                ids = [entry.entry_id for entry in entries if entry.namespace == namespace]
+                vectors.update(self._index.fetch(ids, namespace=namespace)["vectors"])
+            manifest = {
+                "version": self._version,
+                "entries": [
+                    {
+                        "namespace": e.namespace, "question": e.question, "answer": e.answer,
+                        "sections": e.sections, "created_at": e.created_at,
+                    }
+                    for e in entries
+                ],
+            }
+            matrix = np.asarray([vectors[entry.entry_id]["values"] for entry in entries], dtype=np.float32)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, manifest=np.array(json.dumps(manifest)), vectors=matrix)
+        os.replace(tmp_path, path)
+        if path == self.path:
+            # our own write: nothing to reload
+            self._loaded_mtime_ns = os.stat(path).st_mtime_ns
+
+    def load(self, path: typing.Optional[str] = None) -> int:
+        """Add the unexpired entries of a saved cache, if it was saved for the
+        current corpus version; questions already cached keep their entry,
+        and entries this cache evicted as least recently used stay evicted
+        (unless the file has a newer answer). Returns the number of entries
+        added."""
+        path = path or self.path
+        mtime_ns = os.stat(path).st_mtime_ns
+        with np.load(path, allow_pickle=False) as npz:
+            manifest = json.loads(str(npz["manifest"]))
+            vectors = npz["vectors"]
+        added = 0
+        with self._lock:
+            self._check_version()
+            if manifest["version"] == self._version:
+                now = time.time()
+                cached = {(entry.namespace, entry.question) for entry in self._entries.values()}
+                for saved, vector in zip(manifest["entries"], vectors):
+                    key = (saved.get("namespace"), saved["question"])
+                    # entries without a namespace were saved before answers
+                    # were keyed by role and building type
+                    if key[0] is None or key in cached or now - saved["created_at"] > self.ttl_seconds:
+                        continue
+                    if key in self._evicted and saved["created_at"] <= self._evicted[key]:
+                        continue
+                    self._insert(
+                        saved["namespace"], saved["question"], saved["answer"], saved["sections"],
+                        saved["created_at"], vector,
+                    )
+                    added += 1
+                self._evict_stale()
+            if path == self.path:
+                self._loaded_mtime_ns = mtime_ns
+        return added
+
+    def _maybe_reload(self):
+        """Load self.path again if it changed since it was last loaded."""
+        if not self.path or time.monotonic() - self._reload_checked < self.reload_seconds:
+            return
+        self._reload_checked = time.monotonic()
+        try:
+            if os.stat(self.path).st_mtime_ns != self._loaded_mtime_ns:
+                added = self.load()
+                print(f"answer cache: loaded {added} entries from {self.path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"answer cache: could not load {self.path}: {e!r}")
+
+
+_answer_cache: typing.Optional[SemanticAnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> SemanticAnswerCache:
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache(
+                encode=lambda texts: retrieval.get_encoder().encode(texts),
+                corpus_version=retrieval.corpus_version,
+                similarity_threshold=getattr(settings, "ANSWER_CACHE_SIMILARITY_THRESHOLD", DEFAULT_SIMILARITY_THRESHOLD),
+                ttl_seconds=getattr(settings, "ANSWER_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS),
+                max_entries=getattr(settings, "ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+                path=getattr(settings, "ANSWER_CACHE_PATH", None),
+                reload_seconds=getattr(settings, "ANSWER_CACHE_RELOAD_SECONDS", DEFAULT_RELOAD_SECONDS),
+            )
+        return _answer_cache
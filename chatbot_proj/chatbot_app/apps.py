@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatbotAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chatbot_app"
+
+    def ready(self):
+        # preload models and indexes (see warmup.py)
+        from . import warmup
+        warmup.on_app_ready()
@@ -0,0 +1,189 @@
+"""Bounded, session-scoped conversation history for the query machines.
+
+Each browser session keeps its own list of turns. The history is bounded:
+
+- once the turns exceed CONVERSATION_MAX_HISTORY_TOKENS, the oldest turns are
+  compacted into a short running summary (only the most recent
+  CONVERSATION_KEEP_RECENT_MESSAGES are kept verbatim), and the summary itself
+  is capped at CONVERSATION_SUMMARY_MAX_TOKENS
+- sessions idle for more than CONVERSATION_IDLE_SECONDS are evicted, and the
+  in-memory backend keeps at most CONVERSATION_MAX_SESSIONS sessions (LRU)
+
+Backends: "memory" (per process) or "django_cache", which stores
+conversations in a Django cache (CONVERSATION_CACHE_ALIAS), e.g. a
+DatabaseCache on our sqlite db shared by all workers.
+"""
+
+import collections
+import dataclasses
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+DEFAULT_MAX_HISTORY_TOKENS = 1000
+DEFAULT_KEEP_RECENT_MESSAGES = 4
+DEFAULT_SUMMARY_MAX_TOKENS = 300
+DEFAULT_IDLE_SECONDS = 30 * 60
+DEFAULT_MAX_SESSIONS = 10000
+SUMMARY_SNIPPET_TOKENS = 40  # per compacted message
+
+
+def _estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+@dataclasses.dataclass
+class Conversation:
+    summary: typing.List[str] = dataclasses.field(default_factory=list)
+    messages: typing.List[typing.Dict[str, str]] = dataclasses.field(default_factory=list)
+    last_active: float = dataclasses.field(default_factory=time.time)
+
+
+class InMemoryBackend:
+    def __init__(self, idle_seconds: float = DEFAULT_IDLE_SECONDS, max_sessions: int = DEFAULT_MAX_SESSIONS):
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self._conversations: typing.OrderedDict[str, Conversation] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        # least recently active sessions are first
+        now = time.time()
+        while self._conversations:
+            session_key, conversation = next(iter(self._conversations.items()))
+            if len(self._conversations) > self.max_sessions or now - conversation.last_active > self.idle_seconds:
+                del self._conversations[session_key]
+            else:
+                break
+
+    def get(self, session_key: str) -> Conversation:
+        with self._lock:
+            self._evict()
+            conversation = self._conversations.get(session_key)
+            if conversation is None:
+                return Conversation()
+            # hand out a copy, callers modify it before set()
+            return Conversation(
+                list(conversation.summary),
+                [dict(message) for message in conversation.messages],
+                conversation.last_active,
+            )
+
+    def set(self, session_key: str, conversation: Conversation):
+        with self._lock:
+            self._conversations[session_key] = conversation
+            self._conversations.move_to_end(session_key)
+            self._evict()
+
+    def __len__(self):
+        return len(self._conversations)
+
+
+class DjangoCacheBackend:
+    """Idle sessions expire through the cache timeout."""
+
+    KEY_PREFIX = "conversation:"
+
+    def __init__(self, cache_alias: str = "default", idle_seconds: float = DEFAULT_IDLE_SECONDS):
+        self.cache = caches[cache_alias]
+        self.idle_seconds = idle_seconds
+
+    def get(self, session_key: str) -> Conversation:
+        stored = self.cache.get(self.KEY_PREFIX + session_key)
+        return Conversation(**stored) if stored else Conversation()
+
+    def set(self, session_key: str, conversation: Conversation):
+        self.cache.set(self.KEY_PREFIX + session_key, dataclasses.asdict(conversation), timeout=self.idle_seconds)
+
+
+class ConversationStore:
+    def __init__(
+        self,
+        backend,
+        max_history_tokens: int = DEFAULT_MAX_HISTORY_TOKENS,
+        keep_recent_messages: int = DEFAULT_KEEP_RECENT_MESSAGES,
+        summary_max_tokens: int = DEFAULT_SUMMARY_MAX_TOKENS,
+        count_tokens: typing.Callable[[str], int] = _estimate_tokens,
+    ):
+        self.backend = backend
+        self.max_history_tokens = max_history_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.summary_max_tokens = summary_max_tokens
+        self.count_tokens = count_tokens
+
+    def get_messages(self, session_key: typing.Optional[str]) -> typing.List[typing.Dict[str, str]]:
+        """Prior messages of the session, with the summary of compacted turns
+        (if any) first. Returns a new list, safe to hand to a query machine."""
+        if not session_key:
+            return []
+        conversation = self.backend.get(session_key)
+        messages = []
+        if conversation.summary:
+            messages.append({
+                "role": "system",
+                "content": "Summary of the earlier conversation:\n" + "\n".join(conversation.summary),
+            })
+        return messages + [dict(message) for message in conversation.messages]
+
+    def append(self, session_key: typing.Optional[str], messages: typing.List[typing.Dict[str, str]]):
+        if not session_key:
+            return
+        conversation = self.backend.get(session_key)
+        conversation.messages = conversation.messages + [dict(message) for message in messages]
+        conversation.last_active = time.time()
+        self._compact(conversation)
+        self.backend.set(session_key, conversation)
+
+    def _snippet(self, text: str) -> str:
+        words = text.split()
+        snippet = []
+        for word in words:
+            snippet.append(word)
+            if self.count_tokens(" ".join(snippet)) >= SUMMARY_SNIPPET_TOKENS:
+                return " ".join(snippet) + " ..."
+        return " ".join(snippet)
+
+    def _compact(self, conversation: Conversation):
+        def _history_tokens():
+            return sum(self.count_tokens(message["content"]) for message in conversation.messages)
+
+        def _compact_oldest():
+            oldest = conversation.messages.pop(0)
+            conversation.summary.append(f"{oldest['role']}: {self._snippet(oldest['content'])}")
+
+        while len(conversation.messages) > self.keep_recent_messages and _history_tokens() > self.max_history_tokens:
+            _compact_oldest()
+        # don't leave a dangling answer whose question was compacted
+        while len(conversation.messages) > 1 and conversation.messages[0]["role"] != "user":
+            _compact_oldest()
+
+        # the summary keeps the most recent compacted turns
+        while conversation.summary and self.count_tokens("\n".join(conversation.summary)) > self.summary_max_tokens:
+            conversation.summary.pop(0)
+
+
+_store: typing.Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store(count_tokens: typing.Callable[[str], int] = _estimate_tokens) -> ConversationStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            idle_seconds = getattr(settings, "CONVERSATION_IDLE_SECONDS", DEFAULT_IDLE_SECONDS)
+            if getattr(settings, "CONVERSATION_STORE_BACKEND", "memory") == "django_cache":
+                backend = DjangoCacheBackend(getattr(settings, "CONVERSATION_CACHE_ALIAS", "default"), idle_seconds)
+            else:
+                backend = InMemoryBackend(idle_seconds, getattr(settings, "CONVERSATION_MAX_SESSIONS", DEFAULT_MAX_SESSIONS))
+            _store = ConversationStore(
+                backend,
+                max_history_tokens=getattr(settings, "CONVERSATION_MAX_HISTORY_TOKENS", DEFAULT_MAX_HISTORY_TOKENS),
+                keep_recent_messages=getattr(settings, "CONVERSATION_KEEP_RECENT_MESSAGES", DEFAULT_KEEP_RECENT_MESSAGES),
+                summary_max_tokens=getattr(settings, "CONVERSATION_SUMMARY_MAX_TOKENS", DEFAULT_SUMMARY_MAX_TOKENS),
+                count_tokens=count_tokens,
+            )
+        return _store
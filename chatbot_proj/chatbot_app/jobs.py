@@ -0,0 +1,290 @@
+"""Background job queue for chat requests.
+
+Submitting a question stores a ChatJob row and returns right away; a bounded
+pool of worker threads runs the pipeline (views.perform_full_loop) and
+writes the answer back to the row, which the page polls (or streams, see
+views.job_events_view).
+
+- the queue is the ChatJob table in our sqlite db: workers claim the oldest
+  queued job with a conditional UPDATE, so every process's workers can share
+  one queue, and queued jobs survive a restart
+- backpressure: submit() raises QueueFull once JOB_MAX_PENDING jobs are
+  queued or running, and the view answers 503 with Retry-After
+- timeouts: the job's deadline (JOB_TIMEOUT_SECONDS after it started) is
+  checked between pipeline stages, and the time left is passed down to the
+  stages themselves, so an LLM call or a retrieval doesn't outlive it
+- cancellation is checked between stages
+- the running worker refreshes each job's heartbeat every
+  JOB_HEARTBEAT_SECONDS; jobs whose heartbeat is older than
+  JOB_REAP_GRACE_SECONDS lost their worker (e.g. the process was recycled)
+  and are marked timed out
+"""
+
+import datetime
+import os
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChatJob
+from . import tracing
+
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_PENDING = 100
+DEFAULT_TIMEOUT_SECONDS = 120.0
+DEFAULT_POLL_SECONDS = 1.0
+DEFAULT_REAP_GRACE_SECONDS = 60.0
+DEFAULT_HEARTBEAT_SECONDS = 10.0
+DEFAULT_RETENTION_SECONDS = 24 * 60 * 60
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStopped(Exception):
+    """Raised between stages of a job that was cancelled or ran out of time."""
+
+    def __init__(self, status: str, stage: str):
+        super().__init__(f"{status} before {stage}")
+        self.status = status
+        self.stage = stage
+
+
+class JobQueue:
+    def __init__(
+        self,
+        run_job: typing.Callable[[ChatJob, typing.Callable[[str], None], float], str],
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+        poll_seconds: float = DEFAULT_POLL_SECONDS,
+        reap_grace_seconds: float = DEFAULT_REAP_GRACE_SECONDS,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS,
+        heartbeat_seconds: float = DEFAULT_HEARTBEAT_SECONDS,
+    ):
+        """run_job(job, progress, deadline) returns the answer; it must call
+        progress(stage) before each stage, which raises JobStopped when the
+        job should stop, and give its stages no more time than is left until
+        deadline (a time.monotonic() value)."""
+        self.run_job = run_job
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout_seconds = timeout_seconds
+        self.poll_seconds = poll_seconds
+        self.reap_grace_seconds = reap_grace_seconds
+        self.retention_seconds = retention_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+
+        self._wakeup = threading.Condition()
+        self._threads: typing.List[threading.Thread] = []
+        self._running_lock = threading.Lock()
+        self._running_ids: typing.Set[typing.Any] = set()
+        self._stopping = False
+        self._last_housekeeping = 0.0
+
+    def start(self):
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._worker, name=f"chat-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="chat-job-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, session_key: str, user_role: str, building_type: str, user_message: str) -> ChatJob:
+        # not atomic across processes, so the bound is approximate, which is
+        # fine for shedding load
+        pending = ChatJob.objects.filter(status__in=ChatJob.PENDING_STATUSES).count()
+        if pending >= self.max_pending:
+            raise QueueFull(f"{pending} jobs pending")
+        job = ChatJob.objects.create(
+            session_key=session_key,
+            user_role=user_role,
+            building_type=building_type,
+            user_message=user_message,
+        )
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    def cancel(self, job: ChatJob) -> ChatJob:
+        """Queued jobs are cancelled right away, running ones at their next
+        stage."""
+        ChatJob.objects.filter(pk=job.pk, status=ChatJob.QUEUED).update(
+            status=ChatJob.CANCELLED, cancel_requested=True, finished_at=timezone.now()
+        )
+        ChatJob.objects.filter(pk=job.pk, status=ChatJob.RUNNING).update(cancel_requested=True)
+        job.refresh_from_db()
+        return job
+
+    def queue_position(self, job: ChatJob) -> int:
+        """Number of queued jobs ahead of this one."""
+        return ChatJob.objects.filter(status=ChatJob.QUEUED, created_at__lt=job.created_at).count()
+
+    def _claim(self) -> typing.Optional[ChatJob]:
+        for job_id in ChatJob.objects.filter(status=ChatJob.QUEUED).order_by("created_at").values_list("id", flat=True)[:self.max_workers]:
+            now = timezone.now()
+            claimed = ChatJob.objects.filter(pk=job_id, status=ChatJob.QUEUED).update(
+                status=ChatJob.RUNNING,
+                started_at=now,
+                heartbeat_at=now,
+                worker=f"{os.getpid()}:{threading.current_thread().name}",
+            )
+            if claimed:
+                return ChatJob.objects.get(pk=job_id)
+        return None
+
+    def _beat(self):
+        with self._running_lock:
+            running_ids = list(self._running_ids)
+        if running_ids:
+            ChatJob.objects.filter(pk__in=running_ids, status=ChatJob.RUNNING).update(heartbeat_at=timezone.now())
+
+    def _heartbeat(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            close_old_connections()
+            try:
+                self._beat()
+            except Exception as e:
+                print(f"chat job heartbeat: {e!r}")
+            with self._wakeup:
+                if not self._stopping:
+                    self._wakeup.wait(self.heartbeat_seconds)
+
+    def _housekeeping(self):
+        now = timezone.now()
+        # the worker running these stopped beating: it is gone (e.g. the
+        # process was recycled)
+        stale = now - datetime.timedelta(seconds=self.reap_grace_seconds)
+        ChatJob.objects.filter(status=ChatJob.RUNNING).filter(
+            Q(heartbeat_at__lt=stale)
+            # claimed before heartbeats existed
+            | Q(heartbeat_at__isnull=True, started_at__lt=stale - datetime.timedelta(seconds=self.timeout_seconds))
+        ).update(status=ChatJob.TIMED_OUT, error="worker lost", finished_at=now)
+        ChatJob.objects.filter(
+            finished_at__lt=now - datetime.timedelta(seconds=self.retention_seconds),
+        ).exclude(status__in=ChatJob.PENDING_STATUSES).delete()
+
+    def _finish(self, job: ChatJob, status: str, result: str = "", error: str = ""):
+        ChatJob.objects.filter(pk=job.pk, status=ChatJob.RUNNING).update(
+            status=status, result=result, error=error, finished_at=timezone.now()
+        )
+
+    def _run(self, job: ChatJob):
+        deadline = time.monotonic() + self.timeout_seconds
+        stages = []
+
+        def _progress(stage: str):
+            if ChatJob.objects.filter(pk=job.pk, cancel_requested=True).exists():
+                raise JobStopped(ChatJob.CANCELLED, stage)
+            if time.monotonic() > deadline:
+                raise JobStopped(ChatJob.TIMED_OUT, stage)
+            stages.append(stage)
+            ChatJob.objects.filter(pk=job.pk).update(stage=stage, heartbeat_at=timezone.now())
+
+        with self._running_lock:
+            self._running_ids.add(job.pk)
+        try:
+            with tracing.request_trace("chat_job") as trace:
+                trace.attributes["job_id"] = str(job.pk)
+                try:
+                    answer = self.run_job(job, _progress, deadline)
+                except JobStopped as e:
+                    trace.attributes["outcome"] = e.status
+                    raise
+                except TimeoutError:
+                    if time.monotonic() < deadline:
+                        raise
+                    # a stage ran out of the job's time
+                    stage = stages[-1] if stages else "the job"
+                    trace.attributes["outcome"] = ChatJob.TIMED_OUT
+                    raise JobStopped(ChatJob.TIMED_OUT, f"{stage} finished")
+        except JobStopped as e:
+            self._finish(job, e.status, error=str(e))
+        except Exception as e:
+            print(f"chat job {job.pk} failed: {e!r}")
+            self._finish(job, ChatJob.FAILED, error=f"{type(e).__name__}: {e}")
+        else:
+            # a job that finished after its deadline still gets its answer
+            self._finish(job, ChatJob.DONE, result=answer)
+        finally:
+            with self._running_lock:
+                self._running_ids.discard(job.pk)
+
+    def _worker(self):
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            close_old_connections()
+            try:
+                if time.monotonic() - self._last_housekeeping > self.poll_seconds * 30:
+                    self._last_housekeeping = time.monotonic()
+                    self._housekeeping()
+                job = self._claim()
+            except Exception as e:
+                # e.g. "database is locked"; try again on the next poll
+                print(f"chat job queue: {e!r}")
+                job = None
+            if job is not None:
+                self._run(job)
+                continue
+            with self._wakeup:
+                if not self._stopping:
+                    # woken up by a local submit, or poll for jobs submitted
+                    # by other processes
+                    self._wakeup.wait(self.poll_seconds)
+
+
+_job_queue: typing.Optional[JobQueue] = None
+_job_queue_lock = threading.Lock()
+
+
+def _run_chat_job(job: ChatJob, progress: typing.Callable[[str], None], deadline: float) -> str:
+    from . import views
+
+    return views.perform_full_loop(
+        user_role=job.user_role,
+        building_type=job.building_type,
+        user_message=job.user_message,
+        session_key=job.session_key,
+        progress=progress,
+        deadline=deadline,
+    )
+
+
+def get_job_queue() -> JobQueue:
+    """The process's queue; its workers start on first use (so after any
+    fork)."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(
+                _run_chat_job,
+                max_workers=getattr(settings, "JOB_MAX_WORKERS", DEFAULT_MAX_WORKERS),
+                max_pending=getattr(settings, "JOB_MAX_PENDING", DEFAULT_MAX_PENDING),
+                timeout_seconds=getattr(settings, "JOB_TIMEOUT_SECONDS", DEFAULT_TIMEOUT_SECONDS),
+                poll_seconds=getattr(settings, "JOB_POLL_SECONDS", DEFAULT_POLL_SECONDS),
+                reap_grace_seconds=getattr(settings, "JOB_REAP_GRACE_SECONDS", DEFAULT_REAP_GRACE_SECONDS),
+                retention_seconds=getattr(settings, "JOB_RETENTION_SECONDS", DEFAULT_RETENTION_SECONDS),
+                heartbeat_seconds=getattr(settings, "JOB_HEARTBEAT_SECONDS", DEFAULT_HEARTBEAT_SECONDS),
+            )
+            _job_queue.start()
+        return _job_queue
@@ -0,0 +1,61 @@
+"""Fill the answer cache file with answers to popular questions (see
+chatbot_app/prewarm.py).
+
+Example usage (run from chatbot_proj):
+python manage.py prewarm_cache --questions_path popular_questions.jsonl --concurrency 2
+
+Plain-text questions need the role and building type to answer them for:
+python manage.py prewarm_cache --questions_path popular_questions.txt --user_role homeowner --building_type residential
+
+The 50 most asked questions of the request log, again on every new corpus
+version:
+python manage.py prewarm_cache --from_jobs 50 --watch
+"""
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot_app import prewarm
+
+
+class Command(BaseCommand):
+    help = "Pre-warm the answer cache over a popular-question set."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions_path', default=None, help='Questions, one per line: json with user_role, building_type and user_message, or just the message.')
+        parser.add_argument('--user_role', default="", help='User role for questions given as plain messages (required if there are any).')
+        parser.add_argument('--building_type', default="", help='Building type for questions given as plain messages (required if there are any).')
+        parser.add_argument('--from_jobs', type=int, default=None, help='Also warm this many of the most asked questions of the request log.')
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, "PREWARM_CONCURRENCY", prewarm.DEFAULT_CONCURRENCY), help='Questions answered at once.')
+        parser.add_argument('--save_every', type=int, default=prewarm.DEFAULT_SAVE_EVERY, help='Save the cache file after this many new answers.')
+        parser.add_argument('--watch', action='store_true', help='Keep running; warm again whenever the corpus version changes.')
+        parser.add_argument('--interval', type=float, default=getattr(settings, "PREWARM_WATCH_SECONDS", prewarm.DEFAULT_WATCH_SECONDS), help='Seconds between corpus version checks with --watch.')
+
+    def handle(self, *args, **options):
+        if not options["questions_path"] and not options["from_jobs"]:
+            raise CommandError("give --questions_path and/or --from_jobs")
+        try:
+            prewarm.check_settings()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def load_questions():
+            questions = []
+            if options["questions_path"]:
+                try:
+                    questions += prewarm.questions_from_file(
+                        options["questions_path"], options["user_role"], options["building_type"]
+                    )
+                except ValueError as e:
+                    raise CommandError(f"{e}; give --user_role and --building_type for plain-text questions")
+            if options["from_jobs"]:
+                questions += prewarm.questions_from_jobs(options["from_jobs"])
+            return list(dict.fromkeys(questions))
+
+        job = prewarm.PrewarmJob(load_questions, concurrency=options["concurrency"], save_every=options["save_every"])
+        if options["watch"]:
+            job.watch(options["interval"])
+        else:
+            self.stdout.write(json.dumps(job.run()))
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:54
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('session_key', models.CharField(db_index=True, max_length=40)),
+                ('user_role', models.TextField()),
+                ('building_type', models.TextField()),
+                ('user_message', models.TextField()),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled'), ('timed_out', 'Timed out')], default='queued', max_length=16)),
+                ('stage', models.CharField(blank=True, default='', max_length=32)),
+                ('cancel_requested', models.BooleanField(default=False)),
+                ('result', models.TextField(blank=True, default='')),
+                ('error', models.TextField(blank=True, default='')),
+                ('worker', models.CharField(blank=True, default='', max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='chatbot_app_status_00724b_idx')],
+            },
+        ),
+    ]
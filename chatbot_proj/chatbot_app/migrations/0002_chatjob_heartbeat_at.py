@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
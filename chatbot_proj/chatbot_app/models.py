@@ -1,3 +1,61 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class ChatJob(models.Model):
+    """A chat request run by the background job queue (see jobs.py). The
+    table doubles as the queue: workers claim the oldest queued row."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    TIMED_OUT = "timed_out"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+        (CANCELLED, "Cancelled"),
+        (TIMED_OUT, "Timed out"),
+    ]
+    PENDING_STATUSES = (QUEUED, RUNNING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    session_key = models.CharField(max_length=40, db_index=True)
+    user_role = models.TextField()
+    building_type = models.TextField()
+    user_message = models.TextField()
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=32, blank=True, default="")
+    cancel_requested = models.BooleanField(default=False)
+    result = models.TextField(blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    worker = models.CharField(max_length=64, blank=True, default="")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # refreshed by the running worker; a stale heartbeat means it is gone
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def is_finished(self) -> bool:
+        return self.status not in self.PENDING_STATUSES
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": str(self.id),
+            "status": self.status,
+            "stage": self.stage,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
@@ -0,0 +1,197 @@
+"""Offline pre-warming of the answer cache over popular questions.
+
+Popular questions are answered ahead of time, at batch priority, so users
+asking them get the cached answer (answer_cache.py) instead of two LLM calls.
+The answers are saved to ANSWER_CACHE_PATH, which every server process
+reloads when it changes.
+
+- questions come from a file (json lines with user_role, building_type and
+  user_message, or one message per line) or from the request log: the most
+  frequent questions of finished ChatJob rows
+- at most `concurrency` questions run at once, each through the full
+  pipeline (views.perform_full_loop) with llm_scheduler.BATCH priority; the
+  scheduler is per process, so keep concurrency below the API rate limit
+  left over by the servers
+- resumable: questions the cache already answers are skipped, and the cache
+  file is saved every `save_every` answers, so a killed job picks up where
+  it stopped
+- the cache only keeps answers of the current corpus version: a run stops
+  when the version changes, and watch() runs again on every new version
+
+Run with `python manage.py prewarm_cache` (see
+management/commands/prewarm_cache.py).
+"""
+
+import collections
+import concurrent.futures
+import dataclasses
+import json
+import os
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.db.models import Count
+
+import sys
+sys.path.append("../")
+from llm_scheduler import llm_scheduler
+from . import answer_cache
+from . import retrieval
+from . import tracing
+from .models import ChatJob
+
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_SAVE_EVERY = 10
+DEFAULT_WATCH_SECONDS = 60.0
+
+
+@dataclasses.dataclass(frozen=True)
+class Question:
+    user_role: str
+    building_type: str
+    user_message: str
+
+
+def questions_from_file(
+    path: str,
+    user_role: str = "",
+    building_type: str = "",
+) -> typing.List[Question]:
+    """One question per line: a json object with user_role, building_type and
+    user_message, or just the message (then user_role and building_type are
+    the given defaults). Duplicates are dropped, keeping file order.
+
+    Raises ValueError for a question left without a role or building type:
+    the chat form requires both, and the cache's semantic match would serve
+    such an answer to users of another role."""
+    questions = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                row = json.loads(line)
+                question = Question(
+                    row.get("user_role", user_role), row.get("building_type", building_type), row["user_message"]
+                )
+            else:
+                question = Question(user_role, building_type, line)
+            if not question.user_role.strip() or not question.building_type.strip():
+                raise ValueError(f"{path}:{line_number}: question without a user role or building type")
+            questions.append(question)
+    return list(dict.fromkeys(questions))
+
+
+def questions_from_jobs(limit: int) -> typing.List[Question]:
+    """The limit most frequently asked questions of the request log (finished
+    jobs), most frequent first."""
+    rows = (
+        ChatJob.objects.filter(status=ChatJob.DONE)
+        .values("user_role", "building_type", "user_message")
+        .annotate(asked=Count("id"))
+        .order_by("-asked")[:limit]
+    )
+    return [Question(row["user_role"], row["building_type"], row["user_message"]) for row in rows]
+
+
+class VersionChanged(Exception):
+    pass
+
+
+class PrewarmJob:
+    def __init__(
+        self,
+        load_questions: typing.Callable[[], typing.Sequence[Question]],
+        concurrency: int = DEFAULT_CONCURRENCY,
+        save_every: int = DEFAULT_SAVE_EVERY,
+    ):
+        """load_questions() is called at the start of every run, so watch()
+        picks up what became popular since the last one."""
+        self.load_questions = load_questions
+        self.concurrency = concurrency
+        self.save_every = save_every
+        self.cache = answer_cache.get_answer_cache()
+        self._save_lock = threading.Lock()
+        self._unsaved = 0
+
+    def _save(self, force: bool = False):
+        with self._save_lock:
+            if self._unsaved == 0 or (not force and self._unsaved < self.save_every):
+                return
+            self.cache.save()
+            self._unsaved = 0
+
+    def _answer(self, question: Question, version: str) -> str:
+        # the cache drops answers of an older corpus version; stop instead of
+        # answering the rest against an index that is being replaced
+        if retrieval.corpus_version() != version:
+            raise VersionChanged(version)
+        if self.cache.lookup(question.user_role, question.building_type, question.user_message) is not None:
+            return "cached"
+
+        # imported here: views imports this app's models and forms
+        from . import views
+
+        with tracing.request_trace("prewarm"):
+            views.perform_full_loop(
+                question.user_role, question.building_type, question.user_message,
+                priority=llm_scheduler.BATCH,
+            )
+        with self._save_lock:
+            self._unsaved += 1
+        self._save()
+        return "answered"
+
+    def run(self) -> typing.Dict[str, typing.Any]:
+        """Answer every question not cached yet; returns counts by outcome
+        (answered, cached, failed, skipped) and the corpus version."""
+        version = retrieval.corpus_version()
+        if self.cache.path and os.path.exists(self.cache.path):
+            self.cache.load()
+        questions = list(self.load_questions())
+        start = time.perf_counter()
+        counts = collections.Counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self._answer, question, version): question for question in questions}
+            for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                question = futures[future]
+                try:
+                    outcome = future.result()
+                except VersionChanged:
+                    outcome = "skipped"
+                except Exception as e:
+                    outcome = "failed"
+                    print(f"prewarm failed: {question.user_message!r}: {e!r}")
+                counts[outcome] += 1
+                print(f"{i}/{len(futures)} {outcome:<8} {question.user_message[:60]!r}")
+        self._save(force=True)
+        return {
+            "version": version,
+            "version_changed": retrieval.corpus_version() != version,
+            "seconds": round(time.perf_counter() - start, 3),
+            **{outcome: counts[outcome] for outcome in ("answered", "cached", "failed", "skipped")},
+        }
+
+    def watch(self, interval_seconds: float = DEFAULT_WATCH_SECONDS):
+        """Run, then run again whenever the corpus version changes; runs
+        until interrupted."""
+        last_version = None
+        while True:
+            version = retrieval.corpus_version()
+            if version != last_version:
+                summary = self.run()
+                print(json.dumps(summary))
+                last_version = None if summary["version_changed"] else version
+            time.sleep(interval_seconds)
+
+
+def check_settings():
+    """The job fills the cache file; without one there is nothing to warm."""
+    if not getattr(settings, "ANSWER_CACHE_ENABLED", False):
+        raise ValueError("the answer cache is disabled (ANSWER_CACHE_ENABLED)")
+    if not getattr(settings, "ANSWER_CACHE_PATH", None):
+        raise ValueError("no answer cache file to fill (ANSWER_CACHE_PATH)")
@@ -0,0 +1,548 @@
+"""In-process retrieval for the chat view.
+
+The local corpus, the BM25 index and the query encoder are loaded once per
+process and shared by every request thread. Query embeddings go through the
+micro-batching encoder (embedding/encoder_server.py), so concurrent requests
+share forward passes instead of each running (and loading) their own model.
+
+Each expanded topic is searched and augmented as its own asyncio task (the
+blocking backends run on a shared thread pool), so retrieval takes as long as
+the slowest topic rather than the sum of all topics. Every stage has its own
+timeout; a topic that times out comes back empty instead of failing the whole
+request. The pool thread running a timed-out stage can't be cancelled, so the
+search timeout is also passed down to the requests to the hosted vector index:
+a hung backend holds a pool thread no longer than that, instead of filling
+the pool until every later topic times out.
+
+With RETRIEVAL_RERANK set, each topic's search fetches a wider candidate set
+that one process-wide cross-encoder (embedding/rerank.py) narrows down to
+top_k before the augment stage.
+
+Speculative retrieval: the raw user message is searched while the query
+expansion LLM call runs (start_speculative_retrieval). Once the topics arrive,
+only those not covered by the message (cosine similarity of their embeddings
+below RETRIEVAL_SPECULATIVE_COVERAGE_THRESHOLD) are searched, then merged
+with the speculative result (retrieve_topics_with_speculation).
+
+With RETRIEVAL_SNAPSHOT_DIR set, the corpus and indexes come from the current
+index snapshot instead (embedding/index_snapshot.py), and a new snapshot is
+loaded in the background and hot swapped without a restart. Each request
+reads all of them from one snapshot (current_indexes).
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+import typing
+
+import numpy as np
+from django.conf import settings
+
+from . import tracing
+
+sys.path.append("../")
+sys.path.append("../embedding")
+import bm25  # noqa: E402
+import context_expansion  # noqa: E402
+import corpus_store  # noqa: E402
+import dedup  # noqa: E402
+import encoder_server  # noqa: E402
+import filter_index  # noqa: E402
+import hierarchical_index  # noqa: E402
+import index_snapshot  # noqa: E402
+import infer_embedder  # noqa: E402
+import lineage_table  # noqa: E402
+import rerank  # noqa: E402
+import sharded_index  # noqa: E402
+
+
+EMBEDDING_MODEL_PATH = "../embedding/models/chapter_1_embedder"
+EMBEDDING_PATH = "../embedding/embeddings.json"
+LOCAL_BUILDING_CODE_DATA_PATH = "../process_pdf_to_jsonl/building_code_output.jsonl"
+CORPUS_STORE_PATH = "../process_pdf_to_jsonl/building_code_corpus.npz"
+LEXICAL_INDEX_PATH = "../embedding/bm25_index.npz"
+LINEAGE_TABLE_PATH = "../process_pdf_to_jsonl/building_code_lineage.json"
+DUPLICATE_MAP_PATH = "../process_pdf_to_jsonl/building_code_duplicates.json"
+DEFAULT_TOP_K = 10
+DEFAULT_SEARCH_TIMEOUT_SECONDS = 10.0
+DEFAULT_AUGMENT_TIMEOUT_SECONDS = 5.0
+DEFAULT_RERANK_CANDIDATES = 30
+DEFAULT_RERANK_TIMEOUT_SECONDS = 5.0
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_SPECULATIVE_WORKERS = 8
+DEFAULT_SPECULATIVE_COVERAGE_THRESHOLD = 0.8
+
+_load_lock = threading.Lock()
+_lexical_index: typing.Optional[bm25.BM25Index] = None
+_corpus: typing.Optional[corpus_store.CorpusStore] = None
+_lineage: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None
+_duplicate_groups: typing.Dict[str, typing.List[str]] = {}
+_vector_index = None
+_vector_index_loaded = False
+_snapshot_manager: typing.Optional[index_snapshot.SnapshotManager] = None
+_snapshot_manager_loaded = False
+_reranker: typing.Optional[rerank.CrossEncoderReranker] = None
+_reranker_version: typing.Optional[str] = None
+
+
+class Indexes(typing.NamedTuple):
+    lexical_index: bm25.BM25Index
+    corpus: corpus_store.CorpusStore
+    lineage: typing.Dict[str, typing.Dict[str, typing.Any]]
+    duplicate_groups: typing.Dict[str, typing.List[str]]
+    vector_index: typing.Any
+
+
+def _make_executor() -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=getattr(settings, "RETRIEVAL_MAX_WORKERS", DEFAULT_MAX_WORKERS),
+        thread_name_prefix="retrieval",
+    )
+
+
+def _make_speculative_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # separate from _executor: speculative retrievals block on work they
+    # submit to _executor
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=getattr(settings, "RETRIEVAL_SPECULATIVE_WORKERS", DEFAULT_SPECULATIVE_WORKERS),
+        thread_name_prefix="speculative-retrieval",
+    )
+
+
+_executor = _make_executor()
+_speculative_executor = _make_speculative_executor()
+
+
+def _reset_after_fork():
+    # the pools' threads (and any lock they held) don't survive a fork; the
+    # loaded corpus does, and is shared copy-on-write with the parent
+    global _executor, _speculative_executor, _load_lock
+    _executor = _make_executor()
+    _speculative_executor = _make_speculative_executor()
+    _load_lock = threading.Lock()
+    if _reranker is not None:
+        # the score cache's lock may have been held by a parent thread
+        _reranker.cache = rerank.ScoreCache(_reranker.cache.max_size)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_snapshot_manager() -> typing.Optional[index_snapshot.SnapshotManager]:
+    """The index snapshot manager, if RETRIEVAL_SNAPSHOT_DIR is set."""
+    global _snapshot_manager, _snapshot_manager_loaded
+    with _load_lock:
+        if not _snapshot_manager_loaded:
+            snapshot_dir = getattr(settings, "RETRIEVAL_SNAPSHOT_DIR", None)
+            if snapshot_dir:
+                _snapshot_manager = index_snapshot.SnapshotManager(
+                    snapshot_dir,
+                    poll_interval_seconds=getattr(
+                        settings, "RETRIEVAL_SNAPSHOT_POLL_SECONDS", index_snapshot.DEFAULT_POLL_INTERVAL_SECONDS
+                    ),
+                )
+            _snapshot_manager_loaded = True
+    return _snapshot_manager
+
+
+def load_corpus():
+    """Load the compact corpus store, the lineage table, the near-duplicate
+    map and the BM25 index once per process (or the current snapshot's)."""
+    global _lexical_index, _corpus, _lineage, _duplicate_groups
+    start = time.perf_counter()
+    manager = get_snapshot_manager()
+    if manager is not None:
+        cold = manager.version is None
+        snapshot = manager.current()
+        tracing.record_model_load("corpus", cold, time.perf_counter() - start)
+        return snapshot.lexical_index, snapshot.corpus, snapshot.lineage
+    with _load_lock:
+        cold = _lexical_index is None
+        if cold:
+            if os.path.exists(CORPUS_STORE_PATH):
+                _corpus = corpus_store.CorpusStore.load(CORPUS_STORE_PATH)
+            else:
+                _corpus = corpus_store.CorpusStore.from_jsonl(LOCAL_BUILDING_CODE_DATA_PATH)
+            if os.path.exists(LINEAGE_TABLE_PATH):
+                _lineage = lineage_table.load_lineage_table(LINEAGE_TABLE_PATH)
+            else:
+                _lineage = lineage_table.build_lineage_table(_corpus)
+            duplicate_map = dedup.load_duplicate_map(DUPLICATE_MAP_PATH) if os.path.exists(DUPLICATE_MAP_PATH) else {}
+            _duplicate_groups = dedup.duplicate_groups(duplicate_map)
+            if os.path.exists(LEXICAL_INDEX_PATH):
+                _lexical_index = bm25.BM25Index.load(LEXICAL_INDEX_PATH)
+            else:
+                _lexical_index = bm25.BM25Index.from_nodes(
+                    [
+                        node for node in _corpus
+                        if infer_embedder.utils.is_informative(node) and node.key not in duplicate_map
+                    ],
+                    filter_fields_by_key=filter_index.node_filter_fields(_corpus),
+                )
+    tracing.record_model_load("corpus", cold, time.perf_counter() - start)
+    return _lexical_index, _corpus, _lineage
+
+
+def get_lexical_index() -> bm25.BM25Index:
+    return load_corpus()[0]
+
+
+def get_vector_index():
+    """The sharded vector index: local shards from RETRIEVAL_SHARD_DIR, or
+    the RETRIEVAL_SHARD_NAMESPACES of the hosted index; else the local
+    section-grouped index at RETRIEVAL_HIERARCHICAL_INDEX_PATH. None (the
+    default) searches the single hosted namespace."""
+    global _vector_index, _vector_index_loaded
+    with _load_lock:
+        if not _vector_index_loaded:
+            shard_dir = getattr(settings, "RETRIEVAL_SHARD_DIR", None)
+            namespaces = getattr(settings, "RETRIEVAL_SHARD_NAMESPACES", None)
+            hierarchical_path = getattr(settings, "RETRIEVAL_HIERARCHICAL_INDEX_PATH", None)
+            kwargs = {
+                "max_workers": getattr(settings, "RETRIEVAL_SHARD_MAX_WORKERS", sharded_index.DEFAULT_MAX_WORKERS),
+                "timeout_seconds": getattr(settings, "RETRIEVAL_SEARCH_TIMEOUT_SECONDS", DEFAULT_SEARCH_TIMEOUT_SECONDS),
+            }
+            if shard_dir:
+                _vector_index = sharded_index.ShardedIndex.from_directory(shard_dir, **kwargs)
+                reload_seconds = getattr(settings, "RETRIEVAL_SHARD_RELOAD_SECONDS", None)
+                if reload_seconds:
+                    _vector_index.start_reloader(reload_seconds)
+            elif namespaces:
+                _vector_index = infer_embedder.sharded_pinecone_index(namespaces, **kwargs)
+            elif hierarchical_path:
+                _vector_index = hierarchical_index.HierarchicalIndex.load(
+                    hierarchical_path,
+                    probe_sections=getattr(settings, "RETRIEVAL_HIERARCHICAL_PROBE_SECTIONS", None),
+                )
+            _vector_index_loaded = True
+    return _vector_index
+
+
+def current_indexes() -> Indexes:
+    """Everything one request searches, from the same build: the current
+    snapshot's, if snapshots are enabled. Take it once per request; a hot
+    swap doesn't affect requests in flight."""
+    manager = get_snapshot_manager()
+    if manager is not None:
+        snapshot = manager.current()
+        return Indexes(
+            snapshot.lexical_index,
+            snapshot.corpus,
+            snapshot.lineage,
+            snapshot.duplicate_groups,
+            snapshot.vector_index,
+        )
+    lexical_index, corpus, lineage = load_corpus()
+    return Indexes(lexical_index, corpus, lineage, _duplicate_groups, get_vector_index())
+
+
+def corpus_version() -> str:
+    """Changes whenever the corpus or the embeddings are rebuilt (or another
+    snapshot is swapped in)."""
+    manager = get_snapshot_manager()
+    if manager is not None:
+        return "snapshot:" + manager.current().version
+    parts = []
+    for path in (LOCAL_BUILDING_CODE_DATA_PATH, CORPUS_STORE_PATH, EMBEDDING_PATH, LINEAGE_TABLE_PATH, DUPLICATE_MAP_PATH):
+        try:
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}-{stat.st_mtime_ns}")
+        except FileNotFoundError:
+            parts.append("missing")
+    return ":".join(parts)
+
+
+def load_encoder_model():
+    """Fork-safe part of get_encoder: the weights only."""
+    cold = EMBEDDING_MODEL_PATH not in encoder_server._shared_models
+    start = time.perf_counter()
+    model = encoder_server.load_shared_model(EMBEDDING_MODEL_PATH)
+    tracing.record_model_load("encoder", cold, time.perf_counter() - start)
+    return model
+
+
+def get_encoder() -> encoder_server.MicroBatchingEncoder:
+    cold = EMBEDDING_MODEL_PATH not in encoder_server._shared_models
+    start = time.perf_counter()
+    encoder = encoder_server.get_shared_encoder(EMBEDDING_MODEL_PATH)
+    tracing.record_model_load("encoder", cold, time.perf_counter() - start)
+    return encoder
+
+
+def get_reranker() -> rerank.CrossEncoderReranker:
+    """The process-wide cross-encoder, shared by every request thread so its
+    pair-score cache is too. The cache is dropped whenever the corpus
+    version changes, since a section id may then have another text."""
+    global _reranker, _reranker_version
+    version = corpus_version()
+    cold = _reranker is None
+    start = time.perf_counter()
+    with _load_lock:
+        if _reranker is None:
+            _reranker = rerank.CrossEncoderReranker(
+                model_name=getattr(settings, "RETRIEVAL_RERANK_MODEL", rerank.DEFAULT_RERANK_MODEL)
+            )
+        elif _reranker_version != version:
+            _reranker.cache.clear()
+        _reranker_version = version
+    tracing.record_model_load("reranker", cold, time.perf_counter() - start)
+    return _reranker
+
+
+def _rerank(reranker, topic: str, results, corpus, top_k: int):
+    """Cross-encoder rerank of the search candidates, keeping the best
+    top_k; scores them against the texts of the corpus that was searched."""
+    texts_by_id = {}
+    for match in results[0]["matches"]:
+        node = corpus.get(match["id"])
+        if node is not None:
+            texts_by_id[match["id"]] = node["title"] + " " + node["text"]
+    return reranker.rerank([topic], results, top_n=top_k, texts_by_id=texts_by_id)
+
+
+def _augment(results, corpus, lineage, duplicate_groups):
+    """Text, title and readable lineage of every match, plus its tree context
+    (parent and nearby siblings, see context_expansion.py) if enabled."""
+    results = infer_embedder.augment_results_with_local_embeddings(
+        results, EMBEDDING_PATH, table=lineage, corpus=corpus, duplicate_groups=duplicate_groups
+    )
+    if getattr(settings, "RETRIEVAL_CONTEXT_EXPANSION", False):
+        context_expansion.expand_context(
+            results,
+            corpus,
+            token_budget=getattr(settings, "RETRIEVAL_CONTEXT_TOKENS", context_expansion.DEFAULT_TOKEN_BUDGET),
+            max_siblings=getattr(settings, "RETRIEVAL_CONTEXT_MAX_SIBLINGS", context_expansion.DEFAULT_MAX_SIBLINGS),
+        )
+    return results
+
+
+def retrieve(
+    input_strings: typing.List[str],
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Hybrid search for each input string, augmented with the local text,
+    title, readable lineage and tree context. Same output as
+    infer_embedder.py's stdout, plus the context."""
+    indexes = current_indexes()
+    results = infer_embedder.search(
+        input_strings,
+        top_k=top_k,
+        lexical_index=indexes.lexical_index,
+        filter=metadata_filter,
+        encoder=get_encoder(),
+        vector_index=indexes.vector_index,
+    )
+    return _augment(results, indexes.corpus, indexes.lineage, indexes.duplicate_groups)
+
+
+async def _run_stage(func, timeout: float, /, *args, **kwargs):
+    """Run a blocking stage on the retrieval pool, with a timeout. The stage
+    keeps its pool thread until it returns: give it the timeout too (a
+    timeout keyword argument goes to func)."""
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(
+        loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs)),
+        timeout=timeout,
+    )
+
+
+async def _retrieve_topic(
+    topic: str,
+    top_k: int,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]],
+    search_timeout: float,
+    augment_timeout: float,
+    deadline: typing.Optional[float] = None,
+    rerank_timeout: typing.Optional[float] = None,
+) -> typing.Dict[str, typing.Any]:
+    """Search, optionally rerank (RETRIEVAL_RERANK: search wider, keep the
+    cross-encoder's best top_k), then augment one topic. A rerank that
+    times out keeps the search order instead of emptying the topic."""
+    def _stage_timeout(timeout: float) -> float:
+        # no stage runs past the caller's deadline
+        return timeout if deadline is None else max(min(timeout, deadline - time.monotonic()), 0.0)
+
+    indexes = current_indexes()
+    encoder = get_encoder()
+    reranker = get_reranker() if getattr(settings, "RETRIEVAL_RERANK", False) else None
+    candidates = top_k
+    if reranker is not None:
+        candidates = max(top_k, getattr(settings, "RETRIEVAL_RERANK_CANDIDATES", DEFAULT_RERANK_CANDIDATES))
+    start = time.perf_counter()
+    stage = "search"
+    try:
+        with tracing.span("retrieval_search", topic=topic):
+            timeout = _stage_timeout(search_timeout)
+            results = await _run_stage(
+                infer_embedder.search,
+                timeout,
+                [topic],
+                top_k=candidates,
+                lexical_index=indexes.lexical_index,
+                filter=metadata_filter,
+                encoder=encoder,
+                vector_index=indexes.vector_index,
+                timeout=timeout,
+            )
+        search_ms = (time.perf_counter() - start) * 1000
+
+        rerank_ms = None
+        if reranker is not None:
+            rerank_start = time.perf_counter()
+            try:
+                with tracing.span("retrieval_rerank", topic=topic):
+                    results = await _run_stage(
+                        _rerank, _stage_timeout(rerank_timeout), reranker, topic, results, indexes.corpus, top_k
+                    )
+            except asyncio.TimeoutError:
+                print(f"retrieval rerank timed out for topic: {topic}")
+                tracing.increment_attribute("retrieval_timeouts")
+                results = [{**result, "matches": result["matches"][:top_k]} for result in results]
+            rerank_ms = (time.perf_counter() - rerank_start) * 1000
+
+        stage = "augment"
+        with tracing.span("retrieval_augment", topic=topic):
+            results = await _run_stage(
+                _augment, _stage_timeout(augment_timeout), results, indexes.corpus, indexes.lineage, indexes.duplicate_groups
+            )
+    except asyncio.TimeoutError:
+        print(f"retrieval {stage} timed out for topic: {topic}")
+        tracing.increment_attribute("retrieval_timeouts")
+        return {"matches": [], "error": f"{stage} timed out", "latency_ms": {"total": (time.perf_counter() - start) * 1000}}
+
+    result = results[0]
+    result["latency_ms"]["search"] = search_ms
+    if rerank_ms is not None:
+        result["latency_ms"]["rerank"] = rerank_ms
+    result["latency_ms"]["total"] = (time.perf_counter() - start) * 1000
+    tracing.record_retrieval_latency(result["latency_ms"])
+    return result
+
+
+async def retrieve_topics_async(
+    topics: typing.List[str],
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    search_timeout: typing.Optional[float] = None,
+    augment_timeout: typing.Optional[float] = None,
+    timeout: typing.Optional[float] = None,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Search and augment every topic concurrently; one result per topic, in
+    the same order as topics. Topics not done within timeout seconds (if
+    given) come back empty."""
+    if search_timeout is None:
+        search_timeout = getattr(settings, "RETRIEVAL_SEARCH_TIMEOUT_SECONDS", DEFAULT_SEARCH_TIMEOUT_SECONDS)
+    if augment_timeout is None:
+        augment_timeout = getattr(settings, "RETRIEVAL_AUGMENT_TIMEOUT_SECONDS", DEFAULT_AUGMENT_TIMEOUT_SECONDS)
+    rerank_timeout = getattr(settings, "RETRIEVAL_RERANK_TIMEOUT_SECONDS", DEFAULT_RERANK_TIMEOUT_SECONDS)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    tasks = [
+        asyncio.create_task(
+            _retrieve_topic(topic, top_k, metadata_filter, search_timeout, augment_timeout, deadline, rerank_timeout)
+        )
+        for topic in topics
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # e.g. the caller was cancelled: don't leave topic tasks running
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def retrieve_topics(
+    topics: typing.List[str],
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    timeout: typing.Optional[float] = None,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Blocking wrapper around retrieve_topics_async, for sync views."""
+    return asyncio.run(retrieve_topics_async(topics, top_k=top_k, metadata_filter=metadata_filter, timeout=timeout))
+
+
+def _encode_queries(texts: typing.List[str]) -> np.ndarray:
+    # same preprocessing as infer_embedder.vectorize_queries
+    vectors = np.asarray(get_encoder().encode([text.lower() for text in texts]), dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _speculate(
+    user_message: str,
+    top_k: int,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]],
+) -> typing.Tuple[np.ndarray, typing.Dict[str, typing.Any]]:
+    with tracing.span("speculative_retrieval"):
+        message_vector = _encode_queries([user_message])[0]
+        result = retrieve_topics([user_message], top_k=top_k, metadata_filter=metadata_filter)[0]
+    return message_vector, result
+
+
+def start_speculative_retrieval(
+    user_message: str,
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+) -> concurrent.futures.Future:
+    """Search the raw user message in the background (e.g. while the query
+    expansion runs); pass the future to retrieve_topics_with_speculation."""
+    # copy the context, so the span lands in the current request's trace
+    return _speculative_executor.submit(contextvars.copy_context().run, _speculate, user_message, top_k, metadata_filter)
+
+
+def retrieve_topics_with_speculation(
+    user_message: str,
+    topics: typing.List[str],
+    speculative: concurrent.futures.Future,
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    coverage_threshold: typing.Optional[float] = None,
+    timeout: typing.Optional[float] = None,
+) -> typing.Tuple[typing.List[str], typing.List[typing.Dict[str, typing.Any]]]:
+    """Merge the speculative result for user_message with searches for the
+    topics it doesn't cover. Returns (topics, results): the user message
+    first, standing in for the covered topics, then the other topics. Falls
+    back to searching every topic if the speculative search failed. Gives up
+    on searches not done within timeout seconds (if given), like
+    retrieve_topics."""
+    if coverage_threshold is None:
+        coverage_threshold = getattr(
+            settings, "RETRIEVAL_SPECULATIVE_COVERAGE_THRESHOLD", DEFAULT_SPECULATIVE_COVERAGE_THRESHOLD
+        )
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def _time_left() -> typing.Optional[float]:
+        return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+    speculative_timeout = (
+        getattr(settings, "RETRIEVAL_SEARCH_TIMEOUT_SECONDS", DEFAULT_SEARCH_TIMEOUT_SECONDS)
+        + getattr(settings, "RETRIEVAL_AUGMENT_TIMEOUT_SECONDS", DEFAULT_AUGMENT_TIMEOUT_SECONDS)
+    )
+    if deadline is not None:
+        speculative_timeout = min(speculative_timeout, _time_left())
+    try:
+        message_vector, speculative_result = speculative.result(timeout=speculative_timeout)
+    except Exception as e:
+        print(f"speculative retrieval failed, searching every topic: {e!r}")
+        speculative_result = None
+    if speculative_result is None or speculative_result.get("error"):
+        tracing.set_attribute("speculative_retrieval", "failed")
+        return topics, retrieve_topics(topics, top_k=top_k, metadata_filter=metadata_filter, timeout=_time_left())
+
+    uncovered = topics
+    if topics:
+        similarities = _encode_queries(topics) @ message_vector
+        uncovered = [topic for topic, similarity in zip(topics, similarities) if similarity < coverage_threshold]
+    tracing.set_attribute("speculative_covered_topics", len(topics) - len(uncovered))
+
+    results = (
+        retrieve_topics(uncovered, top_k=top_k, metadata_filter=metadata_filter, timeout=_time_left())
+        if uncovered else []
+    )
+    return [user_message] + uncovered, [speculative_result] + results
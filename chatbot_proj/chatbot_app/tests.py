@@ -1,3 +1,516 @@
-from django.test import TestCase
+import concurrent.futures
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import answer_cache
+from . import conversation_store
+from . import jobs
+from . import prewarm
+from . import views
+from . import warmup
+from .models import ChatJob
+
+sys.path.append("../")
+from llm_scheduler import llm_scheduler  # noqa: E402
+from queried_results_to_app_response import queried_results_to_app_response as packing  # noqa: E402
+
+
+class JobQueueTests(TestCase):
+    """The queue's steps run synchronously here; no worker threads."""
+
+    def _queue(self, run_job=None, **kwargs):
+        if run_job is None:
+            def run_job(job, progress, deadline):
+                progress("summarization")
+                return "answer"
+        return jobs.JobQueue(run_job, **kwargs)
+
+    def _submit(self, queue, user_message="What does a Class 2 inspector do?"):
+        return queue.submit(
+            session_key="session",
+            user_role="homeowner",
+            building_type="residential",
+            user_message=user_message,
+        )
+
+    def test_claim_takes_oldest_queued_job_once(self):
+        queue = self._queue()
+        first = self._submit(queue, "first")
+        second = self._submit(queue, "second")
+        ChatJob.objects.filter(pk=first.pk).update(created_at=timezone.now() - datetime.timedelta(seconds=1))
+
+        claimed = queue._claim()
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual(claimed.status, ChatJob.RUNNING)
+        self.assertIsNotNone(claimed.started_at)
+        self.assertIsNotNone(claimed.heartbeat_at)
+        self.assertEqual(queue._claim().pk, second.pk)
+        self.assertIsNone(queue._claim())
+
+    def test_run_stores_answer(self):
+        queue = self._queue()
+        self._submit(queue)
+        job = queue._claim()
+        queue._run(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.DONE)
+        self.assertEqual(job.result, "answer")
+        self.assertEqual(job.stage, "summarization")
+        self.assertIsNotNone(job.finished_at)
+
+    def test_submit_refuses_when_full(self):
+        queue = self._queue(max_pending=1)
+        self._submit(queue)
+        with self.assertRaises(jobs.QueueFull):
+            self._submit(queue)
+
+    def test_cancel_queued_job(self):
+        queue = self._queue()
+        job = queue.cancel(self._submit(queue))
+
+        self.assertEqual(job.status, ChatJob.CANCELLED)
+        self.assertIsNone(queue._claim())
+
+    def test_cancel_running_job_stops_at_next_stage(self):
+        def run_job(job, progress, deadline):
+            progress("query_expansion")
+            queue.cancel(job)
+            progress("summarization")
+            return "answer"
+
+        queue = self._queue(run_job)
+        self._submit(queue)
+        job = queue._claim()
+        queue._run(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.CANCELLED)
+        self.assertEqual(job.error, "cancelled before summarization")
+        self.assertEqual(job.result, "")
+
+    def test_timeout_between_stages(self):
+        def run_job(job, progress, deadline):
+            progress("query_expansion")
+            time.sleep(0.05)
+            progress("summarization")
+            return "answer"
+
+        queue = self._queue(run_job, timeout_seconds=0.01)
+        self._submit(queue)
+        job = queue._claim()
+        queue._run(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.TIMED_OUT)
+        self.assertEqual(job.error, "timed_out before summarization")
+
+    def test_stages_get_the_job_deadline(self):
+        deadlines = []
+
+        def run_job(job, progress, deadline):
+            deadlines.append(deadline)
+            return "answer"
+
+        queue = self._queue(run_job, timeout_seconds=30.0)
+        self._submit(queue)
+        start = time.monotonic()
+        queue._run(queue._claim())
+
+        self.assertAlmostEqual(deadlines[0] - start, 30.0, delta=1.0)
+
+    def test_stage_running_out_of_time_times_out(self):
+        def run_job(job, progress, deadline):
+            progress("summarization")
+            # what an LLM call given the time left raises
+            time.sleep(max(deadline - time.monotonic(), 0.0) + 0.01)
+            raise TimeoutError("LLM call not done after 0.1s")
+
+        queue = self._queue(run_job, timeout_seconds=0.1)
+        self._submit(queue)
+        job = queue._claim()
+        queue._run(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.TIMED_OUT)
+        self.assertEqual(job.error, "timed_out before summarization finished")
+
+    def test_timeout_error_before_deadline_fails(self):
+        def run_job(job, progress, deadline):
+            raise TimeoutError("search backend timed out")
+
+        queue = self._queue(run_job, timeout_seconds=30.0)
+        self._submit(queue)
+        job = queue._claim()
+        queue._run(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.FAILED)
+        self.assertIn("search backend timed out", job.error)
+
+    def test_reap_job_with_stale_heartbeat(self):
+        queue = self._queue(reap_grace_seconds=60.0)
+        self._submit(queue)
+        job = queue._claim()
+        ChatJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(seconds=61))
+        queue._housekeeping()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.TIMED_OUT)
+        self.assertEqual(job.error, "worker lost")
+
+    def test_live_job_is_not_reaped(self):
+        queue = self._queue(timeout_seconds=120.0, reap_grace_seconds=60.0)
+        self._submit(queue)
+        job = queue._claim()
+        # running for longer than timeout + grace, but its worker still beats
+        long_ago = timezone.now() - datetime.timedelta(seconds=600)
+        ChatJob.objects.filter(pk=job.pk).update(started_at=long_ago, heartbeat_at=long_ago)
+        queue._running_ids.add(job.pk)
+        queue._beat()
+        queue._housekeeping()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.RUNNING)
+        self.assertGreater(job.heartbeat_at, long_ago)
+
+        # and its answer is kept
+        queue._finish(job, ChatJob.DONE, result="answer")
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.DONE)
+        self.assertEqual(job.result, "answer")
+
+    def test_housekeeping_deletes_old_finished_jobs(self):
+        queue = self._queue(retention_seconds=60.0)
+        job = queue.cancel(self._submit(queue))
+        ChatJob.objects.filter(pk=job.pk).update(finished_at=timezone.now() - datetime.timedelta(seconds=61))
+        queue._housekeeping()
+
+        self.assertFalse(ChatJob.objects.filter(pk=job.pk).exists())
+
+
+@override_settings(
+    WARM_START_ENABLED=True,
+    WARM_START_COMPONENTS=("vector_index",),
+    WARM_START_RETRY_SECONDS=0.01,
+    WARM_START_MAX_RETRIES=3,
+)
+class WarmStartTests(TestCase):
+    def setUp(self):
+        with warmup._status_lock:
+            warmup._status.update({"state": "cold", "components": {}})
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 2.0
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_failed_vector_index_probe_is_retried_without_failing_readiness(self):
+        probe = mock.Mock(side_effect=[ConnectionError("network blip"), ConnectionError("network blip"), None])
+        with mock.patch.object(warmup, "_warm_vector_index", probe):
+            warmup.warm_worker()
+            warmup._finish()
+            self.assertTrue(warmup.is_ready())
+            self.assertTrue(self._wait_for(lambda: warmup.status()["components"]["vector_index"]["ok"]))
+
+        self.assertEqual(probe.call_count, 3)
+        self.assertEqual(warmup.status()["components"]["vector_index"]["attempts"], 3)
+
+    def test_failed_local_component_fails_readiness(self):
+        warmup._run_component("corpus", mock.Mock(side_effect=OSError("no corpus")))
+        warmup._finish()
+
+        self.assertFalse(warmup.is_ready())
+        self.assertEqual(warmup.status()["state"], "failed")
+
+
+class AnswerCacheTests(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "answer_cache.npz")
+        self.tmp_dir = tmp_dir.name
+        self.questions = []
+
+    def _encode(self, texts):
+        # one dimension per question, so different questions never match
+        vectors = []
+        for text in texts:
+            if text not in self.questions:
+                self.questions.append(text)
+            vector = [0.0] * 8
+            vector[self.questions.index(text)] = 1.0
+            vectors.append(vector)
+        return vectors
+
+    def _cache(self, **kwargs):
+        return answer_cache.SemanticAnswerCache(self._encode, lambda: "v1", path=self.path, **kwargs)
+
+    def test_reload_does_not_add_back_lru_evicted_entries(self):
+        writer = self._cache()
+        for question in ("first", "second", "third"):
+            writer.store("homeowner", "residential", question, f"answer to {question}", [])
+        writer.save()
+
+        cache = self._cache(max_entries=2)
+        cache.load()
+        self.assertIsNone(cache.lookup("homeowner", "residential", "first"))
+        self.assertEqual(cache.lookup("homeowner", "residential", "third").answer, "answer to third")
+
+        # the file changes (e.g. the pre-warming job saved again)
+        writer.store("homeowner", "residential", "fourth", "answer to fourth", [])
+        writer.save()
+        self.assertEqual(cache.load(), 1)
+        self.assertIsNone(cache.lookup("homeowner", "residential", "first"))
+        self.assertEqual(cache.lookup("homeowner", "residential", "fourth").answer, "answer to fourth")
+
+    def test_answers_are_not_shared_across_roles_and_building_types(self):
+        cache = self._cache()
+        cache.store("architect", "commercial", "How wide must exits be?", "44 inches", [])
+
+        self.assertIsNone(cache.lookup("homeowner", "residential", "How wide must exits be?"))
+        self.assertIsNone(cache.lookup("architect", "residential", "How wide must exits be?"))
+        self.assertEqual(cache.lookup("Architect ", "commercial", "how wide must exits be?").answer, "44 inches")
+
+    @override_settings(ANSWER_CACHE_ENABLED=True)
+    def test_cache_hit_is_recorded_in_the_conversation(self):
+        cache = self._cache()
+        sections = [
+            {"topic": "exit width", "index": ["Chapter 10, Article 1, 10-101. Exits."], "title": "Exits."},
+            {"topic": "egress", "index": ["Chapter 10, Article 1, 10-101. Exits."], "title": "Exits."},
+        ]
+        cache.store("architect", "commercial", "How wide must exits be?", "44 inches", sections)
+
+        with mock.patch.object(answer_cache, "get_answer_cache", return_value=cache):
+            answer = views.perform_full_loop("architect", "commercial", "How wide must exits be?", session_key="cache-hit")
+
+        self.assertEqual(answer, "44 inches\n\nSections this answer is based on:\n- Chapter 10, Article 1, 10-101. Exits.")
+        messages = conversation_store.get_store().get_messages("cache-hit")
+        self.assertEqual([message["role"] for message in messages], ["user", "assistant"])
+        self.assertIn("How wide must exits be?", messages[0]["content"])
+        self.assertEqual(messages[1]["content"], '["exit width", "egress"]')
+
+    def test_plain_questions_need_role_and_building_type(self):
+        questions_path = os.path.join(self.tmp_dir, "questions.txt")
+        with open(questions_path, "w") as f:
+            f.write('{"user_role": "architect", "building_type": "commercial", "user_message": "exits"}\n')
+            f.write("sprinklers\n")
+
+        with self.assertRaises(ValueError):
+            prewarm.questions_from_file(questions_path)
+        questions = prewarm.questions_from_file(questions_path, "homeowner", "residential")
+        self.assertEqual(
+            questions,
+            [
+                prewarm.Question("architect", "commercial", "exits"),
+                prewarm.Question("homeowner", "residential", "sprinklers"),
+            ],
+        )
+
+
+def _http_response(status_code=200, content="ok", headers=None):
+    response = mock.Mock(status_code=status_code, headers=headers or {}, text=content)
+    response.json.return_value = {
+        "choices": [{"message": {"content": content}}],
+        "usage": {"total_tokens": 10},
+    }
+    return response
+
+
+def _request_body(content):
+    return {"model": "gpt-4-0613", "messages": [{"role": "user", "content": content}]}
+
+
+class LLMSchedulerTests(SimpleTestCase):
+    """The HTTP calls are stubbed; the dispatcher and call threads are real."""
+
+    def _scheduler(self, **kwargs):
+        kwargs.setdefault("headers", {})
+        return llm_scheduler.LLMScheduler(url="http://llm.test/chat", **kwargs)
+
+    def _stub_post(self, side_effect):
+        patcher = mock.patch.object(llm_scheduler.requests.Session, "post", side_effect=side_effect)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_identical_requests_in_flight_are_coalesced(self):
+        release = threading.Event()
+
+        def post(url, headers, json, timeout):
+            release.wait(5)
+            return _http_response(content=json["messages"][0]["content"])
+
+        post = self._stub_post(post)
+        scheduler = self._scheduler()
+        call_infos = [{}, {}]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(scheduler.chat_completion, _request_body("same"), call_info=call_info)
+                for call_info in call_infos
+            ]
+            deadline = time.monotonic() + 5
+            while scheduler.stats["coalesced"] < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            responses = [future.result(timeout=5) for future in futures]
+
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual([r["choices"][0]["message"]["content"] for r in responses], ["same", "same"])
+        self.assertIsNot(responses[0], responses[1])
+        self.assertEqual(sorted(info["coalesced"] for info in call_infos), [False, True])
+
+    def test_interactive_requests_are_served_before_batch(self):
+        release = threading.Event()
+        sent = []
+
+        def post(url, headers, json, timeout):
+            content = json["messages"][0]["content"]
+            sent.append(content)
+            if content == "running":
+                release.wait(5)
+            return _http_response(content=content)
+
+        self._stub_post(post)
+        scheduler = self._scheduler(max_concurrency=1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            running = executor.submit(scheduler.chat_completion, _request_body("running"))
+            deadline = time.monotonic() + 5
+            while not sent and time.monotonic() < deadline:
+                time.sleep(0.01)
+            batch = executor.submit(scheduler.chat_completion, _request_body("batch"), priority=llm_scheduler.BATCH)
+            interactive = executor.submit(scheduler.chat_completion, _request_body("interactive"))
+            while len(scheduler._queue) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for future in (running, batch, interactive):
+                future.result(timeout=5)
+
+        self.assertEqual(sent, ["running", "interactive", "batch"])
+
+    def test_rate_limited_request_is_retried(self):
+        responses = iter([_http_response(429, "slow down", {"retry-after": "0.01"}), _http_response(content="done")])
+        post = self._stub_post(lambda url, headers, json, timeout: next(responses))
+        scheduler = self._scheduler()
+        call_info = {}
+        response = scheduler.chat_completion(_request_body("question"), call_info=call_info, timeout=5)
+
+        self.assertEqual(response["choices"][0]["message"]["content"], "done")
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(call_info["retries"], 1)
+        self.assertEqual(scheduler.stats["rate_limited"], 1)
+
+    def test_client_error_is_not_retried(self):
+        post = self._stub_post(lambda url, headers, json, timeout: _http_response(400, "bad request"))
+        scheduler = self._scheduler()
+        with self.assertRaises(llm_scheduler.LLMRequestError) as raised:
+            scheduler.chat_completion(_request_body("question"), timeout=5)
+
+        self.assertEqual(raised.exception.status_code, 400)
+        self.assertEqual(post.call_count, 1)
+
+    def test_request_bucket_holds_back_calls_over_the_rate(self):
+        post = self._stub_post(lambda url, headers, json, timeout: _http_response())
+        scheduler = self._scheduler(requests_per_minute=1)
+        scheduler.chat_completion(_request_body("first"), timeout=5)
+        with self.assertRaises(TimeoutError):
+            scheduler.chat_completion(_request_body("second"), timeout=0.2)
+
+        self.assertEqual(post.call_count, 1)
+
+    def test_token_bucket_refills_over_time(self):
+        bucket = llm_scheduler.TokenBucket(rate_per_minute=60)
+        self.assertEqual(bucket.wait_time(60), 0.0)
+        bucket.consume(60)
+        self.assertAlmostEqual(bucket.wait_time(30), 30.0, delta=0.1)
+
+        bucket.updated -= 30  # 30 seconds pass
+        self.assertAlmostEqual(bucket.wait_time(30), 0.0, delta=0.1)
+        # amounts over the capacity only need a full bucket
+        bucket.updated -= 60
+        self.assertEqual(bucket.wait_time(120), 0.0)
+
+
+def _section(key, text, score, parent_key=None, context=()):
+    return {
+        "index": f"1-{key}.", "title": f"Title {key}.", "text": text, "key": key,
+        "parent_key": parent_key, "score": score, "context": list(context),
+    }
+
+
+def _context(key, text):
+    return {"key": key, "relation": "parent", "title": f"Title {key}.", "text": text}
+
+
+class PackContextTests(SimpleTestCase):
+    def test_section_retrieved_for_several_topics_is_packed_once(self):
+        packed = packing.pack_context([
+            {"topic": "exits", "content": [_section("101", "exit signs", 0.4)]},
+            {"topic": "signs", "content": [_section("102", "sign lighting", 0.5), _section("101", "exit signs", 0.9)]},
+        ])
+
+        self.assertEqual(packed.count("exit signs"), 1)
+        # ordered by the best score of the section over every topic
+        self.assertLess(packed.index("1-101."), packed.index("1-102."))
+
+    def test_child_is_nested_under_its_retrieved_parent(self):
+        packed = packing.pack_context([{"topic": "stairs", "content": [
+            _section("child", "riser height", 0.9, parent_key="parent"),
+            _section("parent", "stairways", 0.5),
+        ]}])
+
+        self.assertIn("- 1-parent.: Title parent. stairways\n  - 1-child.: Title child. riser height\n", packed)
+
+    def test_budget_cuts_texts_but_keeps_every_section(self):
+        long_text = "word " * 500
+        content = [_section(str(i), long_text, 1.0 - i / 10) for i in range(5)]
+        packed = packing.pack_context([{"topic": "fire", "content": content}], token_budget=300)
+
+        for i in range(5):
+            self.assertIn(f"- 1-{i}.: Title {i}.", packed)
+        self.assertLessEqual(packing.count_tokens(packed), 300)
+        self.assertIn("- 1-4.: Title 4. ...\n", packed)
+
+    def test_context_only_gets_the_budget_left_over_by_sections(self):
+        content = [
+            _section("a", "word " * 100, 0.9, context=[_context("p", "word " * 100)]),
+            _section("b", "word " * 100, 0.5),
+        ]
+        sections_only = packing.pack_context([{"topic": "fire", "content": [dict(c, context=[]) for c in content]}])
+        packed = packing.pack_context(
+            [{"topic": "fire", "content": content}], token_budget=packing.count_tokens(sections_only) + 10
+        )
+
+        self.assertEqual(packed, sections_only)
+
+    def test_shared_context_is_shown_once(self):
+        shared = _context("p", "parent text")
+        packed = packing.pack_context([{"topic": "fire", "content": [
+            _section("a", "first", 0.9, context=[shared]),
+            _section("b", "second", 0.5, context=[shared, _context("a", "retrieved itself")]),
+        ]}])
+
+        self.assertEqual(packed.count("parent text"), 1)
+        self.assertLess(packed.index("parent text"), packed.index("1-b."))
+        self.assertNotIn("retrieved itself", packed)
+
+    def test_context_that_does_not_fit_leaves_room_for_smaller_context(self):
+        content = [
+            _section("a", "first", 0.9, context=[_context("big", "word " * 200)]),
+            _section("b", "second", 0.5, context=[_context("small", "small context")]),
+        ]
+        sections_only = packing.pack_context([{"topic": "fire", "content": [dict(c, context=[]) for c in content]}])
+        packed = packing.pack_context(
+            [{"topic": "fire", "content": content}], token_budget=packing.count_tokens(sections_only) + 20
+        )
+
+        self.assertNotIn("word", packed)
+        self.assertIn("  ~ parent: Title small. small context\n", packed)
@@ -0,0 +1,291 @@
+"""Per-request tracing and Prometheus-style metrics for the chat pipeline.
+
+Every chat request gets a Trace holding timed spans for its stages (answer
+cache lookup, query expansion, retrieval, summarization, model and corpus
+loads). Spans also feed process-wide metrics, exported in the Prometheus text
+format by the /chatbot/metrics route:
+
+codequery_requests_total{outcome}              chat requests, by outcome
+codequery_request_seconds                      end-to-end latency histogram
+codequery_stage_seconds{stage}                 per-stage latency histogram
+codequery_stage_errors_total{stage,error}      stages that raised
+codequery_model_loads_total{component,state}   cold (loaded) / warm (reused) loads
+codequery_answer_cache_total{result}           semantic answer cache hits / misses
+codequery_retrieval_seconds{leg}               per-topic search / total latency
+codequery_llm_seconds{stage}                   LLM call latency
+codequery_llm_tokens_total{stage,kind}         prompt / completion tokens
+
+If TRACE_LOG_PATH is set, requests slower than TRACE_SLOW_REQUEST_SECONDS
+(every request, if 0) are appended to it as one json line each, with all of
+their spans, for slow-request analysis.
+"""
+
+import contextlib
+import contextvars
+import json
+import threading
+import time
+import typing
+import uuid
+
+from django.conf import settings
+
+
+DEFAULT_SLOW_REQUEST_SECONDS = 10.0
+# seconds; LLM calls and cold model loads take tens of seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+
+def _label_key(labels: typing.Dict[str, str]) -> typing.Tuple[typing.Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(label_key: typing.Tuple[typing.Tuple[str, str], ...]) -> str:
+    if not label_key:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in label_key
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: typing.Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label key -> (per-bucket counts, sum, count)
+        self._values: typing.Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(_label_key(labels))
+            return state[2] if state else 0
+
+    def render(self) -> typing.List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket_key = key + (("le", _format_value(bound)),)
+                    lines.append(f"{self.name}_bucket{_format_labels(bucket_key)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: typing.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.counter("codequery_requests_total", "Chat requests, by outcome.")
+REQUEST_SECONDS = REGISTRY.histogram("codequery_request_seconds", "End-to-end chat request latency.")
+STAGE_SECONDS = REGISTRY.histogram("codequery_stage_seconds", "Latency of each pipeline stage.")
+STAGE_ERRORS = REGISTRY.counter("codequery_stage_errors_total", "Pipeline stages that raised, by exception type.")
+MODEL_LOADS = REGISTRY.counter("codequery_model_loads_total", "Model and index loads; cold loads hit the disk.")
+ANSWER_CACHE = REGISTRY.counter("codequery_answer_cache_total", "Semantic answer cache lookups, by result.")
+RETRIEVAL_SECONDS = REGISTRY.histogram("codequery_retrieval_seconds", "Per-topic retrieval latency, by leg.")
+LLM_SECONDS = REGISTRY.histogram("codequery_llm_seconds", "LLM call latency, by pipeline stage.")
+LLM_TOKENS = REGISTRY.counter("codequery_llm_tokens_total", "LLM tokens used, by pipeline stage and kind.")
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: typing.List[typing.Dict[str, typing.Any]] = []
+        self.attributes: typing.Dict[str, typing.Any] = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, duration: float, **attributes):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self.start) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                **attributes,
+            })
+
+    def to_dict(self, duration: float) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration_ms": round(duration * 1000, 3),
+                "attributes": dict(self.attributes),
+                "spans": sorted(self.spans, key=lambda span: span["start_ms"]),
+            }
+
+
+# contextvars follow the request into the asyncio tasks of the retrieval
+# fan-out; work handed to thread pools reports back through the caller
+_current_trace: contextvars.ContextVar[typing.Optional[Trace]] = contextvars.ContextVar("codequery_trace", default=None)
+
+
+def current_trace() -> typing.Optional[Trace]:
+    return _current_trace.get()
+
+
+def set_attribute(name: str, value: typing.Any):
+    trace = current_trace()
+    if trace is not None:
+        trace.attributes[name] = value
+
+
+def increment_attribute(name: str, amount: float = 1):
+    trace = current_trace()
+    if trace is not None:
+        with trace._lock:
+            trace.attributes[name] = trace.attributes.get(name, 0) + amount
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the current request (if any) and record it in
+    codequery_stage_seconds."""
+    start = time.perf_counter()
+    try:
+        yield attributes  # callers may add attributes while the span is open
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        STAGE_ERRORS.inc(stage=name, error=type(e).__name__)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=name)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_span(name, start, duration, **attributes)
+
+
+def record_model_load(component: str, cold: bool, seconds: float):
+    MODEL_LOADS.inc(component=component, state="cold" if cold else "warm")
+    trace = current_trace()
+    if trace is not None and cold:
+        trace.add_span(f"load_{component}", time.perf_counter() - seconds, seconds, cold=True)
+
+
+def record_llm_call(stage: str, response: typing.Dict[str, typing.Any], seconds: float):
+    """Latency and token usage of an OpenAI chat completion response."""
+    LLM_SECONDS.observe(seconds, stage=stage)
+    usage = response.get("usage") or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if kind in usage:
+            LLM_TOKENS.inc(usage[kind], stage=stage, kind=kind.replace("_tokens", ""))
+    trace = current_trace()
+    if trace is not None:
+        with trace._lock:
+            tokens = trace.attributes.setdefault("llm_tokens", {})
+            tokens[stage] = tokens.get(stage, 0) + usage.get("total_tokens", 0)
+
+
+def record_retrieval_latency(latency_ms: typing.Dict[str, float]):
+    for leg, milliseconds in latency_ms.items():
+        RETRIEVAL_SECONDS.observe(milliseconds / 1000, leg=leg)
+
+
+_trace_log_lock = threading.Lock()
+
+
+def _write_trace_log(trace: Trace, duration: float):
+    path = getattr(settings, "TRACE_LOG_PATH", None)
+    if not path:
+        return
+    if duration < getattr(settings, "TRACE_SLOW_REQUEST_SECONDS", DEFAULT_SLOW_REQUEST_SECONDS):
+        return
+    line = json.dumps(trace.to_dict(duration), default=str)
+    with _trace_log_lock:
+        with open(path, 'a') as f:
+            f.write(line + "\n")
+
+
+@contextlib.contextmanager
+def request_trace(name: str = "chat"):
+    """Trace one request: sets the current trace, counts it by outcome (the
+    "outcome" attribute, if the request set one) and writes it to the trace
+    log if it was slow."""
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.attributes.setdefault("outcome", "error")
+        raise
+    finally:
+        _current_trace.reset(token)
+        duration = time.perf_counter() - trace.start
+        outcome = trace.attributes.setdefault("outcome", "ok")
+        REQUESTS.inc(outcome=outcome)
+        REQUEST_SECONDS.observe(duration)
+        try:
+            _write_trace_log(trace, duration)
+        except OSError as e:
+            print(f"could not write trace log: {e}")
@@ -3,4 +3,10 @@ from . import views
 
 urlpatterns = [
     path('', views.chat_view, name='chat'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('health', views.health_view, name='health'),
+    path('jobs', views.job_submit_view, name='job_submit'),
+    path('jobs/<uuid:job_id>', views.job_status_view, name='job_status'),
+    path('jobs/<uuid:job_id>/cancel', views.job_cancel_view, name='job_cancel'),
+    path('jobs/<uuid:job_id>/events', views.job_events_view, name='job_events'),
 ]
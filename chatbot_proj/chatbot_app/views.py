@@ -1,81 +1,175 @@
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.views.decorators.http import require_GET, require_POST
 from .forms import ChatForm
-import subprocess
-import shlex
 import json
+import time
+import typing
 
 import sys
 sys.path.append("../")
 from embedding import utils as embedding_utils
+from llm_ledger import llm_ledger
+from prompt_to_query import prompt_to_query
+from queried_results_to_app_response import queried_results_to_app_response
+from . import answer_cache
+from . import conversation_store
+from . import jobs
+from .models import ChatJob
+from . import retrieval
+from . import tracing
+from . import warmup
 
-# from django.http import HttpResponse
 
+def _ledger_append(entry: typing.Dict[str, typing.Any]):
+    ledger_path = getattr(settings, "LLM_LEDGER_PATH", None)
+    if not ledger_path:
+        return
+    trace = tracing.current_trace()
+    entry["request_id"] = trace.trace_id if trace is not None else None
+    try:
+        llm_ledger.get_ledger(ledger_path).append(entry)
+    except OSError as e:
+        print(f"could not write LLM ledger: {e}")
 
-def str_formatter_for_argparse(text: str):
-    """
-    This function takes in a string and formats it for argparse.
-    """
-    text = text.replace("'", "''")
-    text = text.replace('"', '""')
-    return text
+
+def _make_llm_request(
+    stage: str,
+    machine,
+    priority: typing.Optional[int] = None,
+    timeout: typing.Optional[float] = None,
+):
+    """machine.make_request(priority, timeout), recorded in the metrics and
+    the LLM call ledger (llm_ledger/llm_ledger.py), failed calls included."""
+    start = time.perf_counter()
+    try:
+        response = machine.make_request(priority=priority, timeout=timeout)
+    except Exception as e:
+        _ledger_append(llm_ledger.entry_from_response(
+            stage, None, time.perf_counter() - start, machine.last_call_info, error=e
+        ))
+        raise
+    seconds = time.perf_counter() - start
+    tracing.record_llm_call(stage, response, seconds)
+    _ledger_append(llm_ledger.entry_from_response(stage, response, seconds, machine.last_call_info))
+    return response
+
+
+def _cited_sections_text(sections: typing.List[typing.Dict[str, typing.Any]]) -> str:
+    """The sections a cached answer was written from, to show with it."""
+    labels = []
+    for section in sections:
+        index = section["index"]
+        label = " ".join(str(part) for part in index) if isinstance(index, (list, tuple)) else str(index)
+        if label and label not in labels:
+            labels.append(label)
+    if not labels:
+        return ""
+    return "\n\nSections this answer is based on:\n" + "\n".join(f"- {label}" for label in labels)
 
 
 def perform_full_loop(
     user_role: str,
     building_type: str,
     user_message: str,
+    session_key: str = None,
+    progress: typing.Optional[typing.Callable[[str], None]] = None,
+    priority: typing.Optional[int] = None,
+    deadline: typing.Optional[float] = None,
 ):
     """
     This function takes in the user's role, building type, and message, and performs the full loop of the CodeQuery.
+
+    All three stages (query expansion, retrieval, summarization) run in this
+    process. The query expansion sees the session's earlier (bounded) history,
+    see conversation_store.py. Each stage is timed as a span of the
+    request's trace, see tracing.py.
+
+    If given, progress(stage) is called before each stage; background jobs
+    use it to report the stage and to stop (by raising) between stages.
+
+    priority is passed to the LLM scheduler: llm_scheduler.INTERACTIVE
+    (default) or llm_scheduler.BATCH, for offline jobs such as prewarm.py.
+
+    If given, no stage runs past deadline (a time.monotonic() value): the LLM
+    calls and the retrieval get the time left and raise TimeoutError (or come
+    back empty, for retrieval) when it runs out.
     """
-    command_ptq = (
-        f"python3 ../prompt_to_query/prompt_to_query.py "
-        f"--user_role='{str_formatter_for_argparse(user_role)}' "
-        f"--building_type='{str_formatter_for_argparse(building_type)}' "
-        f"--user_message='{str_formatter_for_argparse(user_message)}'"
-    )
-    command_ptq = shlex.split(command_ptq)
-    process = subprocess.Popen(command_ptq, stdout=subprocess.PIPE)
-    output_ptq, error = process.communicate()
-
-    print(output_ptq)
-    output_ptq_list = json.loads(output_ptq.decode("utf-8").split("\n")[0])
-
-    # next, use infer_embedder.py to convert each line of the output to a vector
-    formated_output_ptq = " ".join(output_ptq.decode("utf-8").split("\n"))
-    formated_output_ptq = formated_output_ptq.replace("[", "").replace("]", "").replace(",", "")
-    print(formated_output_ptq)
-
-    command_embed = (
-        f"python3 ../embedding/infer_embedder.py "
-        f"--input_strings {formated_output_ptq} "
-        f"--embedding_model_path='../embedding/models/chapter_1_embedder' "
-        "--local_building_code_data_path '../process_pdf_to_jsonl/building_code_output.jsonl' "
-        "--embedding_path '../embedding/embeddings.json'"
-    )
-    command_embed = shlex.split(command_embed)
-    process = subprocess.Popen(command_embed, stdout=subprocess.PIPE)
-    output_embed, error = process.communicate()
-
-    output_embed = output_embed.decode("utf-8").split("\n")[0]
-    output_embed = json.loads(output_embed)
-    print(output_embed)
-    print(len(output_embed))
-
-    # the output is already queried against pinecone database. We can retrieve
-    # the top 5 results from the database and summarize using the following
-    # python script: queried_results_to_app_response.py
-    # docstring help
-    # GPT-4 assistant for building codes
-    # optional arguments:
-    # -h, --help            show this help message and exit
-    # --user_role USER_ROLE
-    #                         User role (e.g. architect, engineer, etc.)
-    # --building_type BUILDING_TYPE
-    #                         Building type (e.g. residential, commercial, etc.)
-    # --initial_user_message INITIAL_USER_MESSAGE
-    #                         Initial user message (e.g. What are the structural requirements?)
-    # --pinecone_response_list PINECONE_RESPONSE_LIST
+    if progress is None:
+        def progress(stage):
+            pass
+
+    def _time_left() -> typing.Optional[float]:
+        return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+    store = conversation_store.get_store(count_tokens=queried_results_to_app_response.count_tokens)
+    messages_history = store.get_messages(session_key)
+
+    # near-duplicate questions reuse a previous answer (and its cited sections);
+    # follow-up questions depend on the conversation, so they aren't cached
+    cache = None
+    if getattr(settings, "ANSWER_CACHE_ENABLED", False) and not messages_history:
+        cache = answer_cache.get_answer_cache()
+    if cache is not None:
+        progress("answer_cache_lookup")
+        start = time.perf_counter()
+        with tracing.span("answer_cache_lookup"):
+            cached = cache.lookup(user_role, building_type, user_message)
+        tracing.ANSWER_CACHE.inc(result="hit" if cached is not None else "miss")
+        if cached is not None:
+            _ledger_append(llm_ledger.cache_hit_entry("answer_cache", time.perf_counter() - start))
+            print(f"answer cache hit (similarity {cached.similarity:.3f}): {cached.namespace} | {cached.question}")
+            tracing.set_attribute("outcome", "cache_hit")
+            # the turn still goes into the session history, as the query
+            # expansion would have recorded it, so follow-ups have context
+            pm = prompt_to_query.PromptQueryMachine(
+                user_role=user_role,
+                building_type=building_type,
+                messages_history=[],
+            )
+            pm.add_user_message_to_history(user_message)
+            topics = list(dict.fromkeys(section["topic"] for section in cached.sections))
+            store.append(session_key, [pm.messages_history[-1], {"role": "assistant", "content": json.dumps(topics)}])
+            return cached.answer + _cited_sections_text(cached.sections)
+
+    # search the raw message while the expansion runs; the expanded topics
+    # it already covers aren't searched again (see retrieval.py)
+    speculative = None
+    if getattr(settings, "RETRIEVAL_SPECULATIVE", False):
+        speculative = retrieval.start_speculative_retrieval(user_message)
+
+    # first, expand the user message into a list of topics to search for
+    progress("query_expansion")
+    with tracing.span("query_expansion"):
+        pm = prompt_to_query.PromptQueryMachine(
+            user_role=user_role,
+            building_type=building_type,
+            messages_history=messages_history,
+        )
+        pm.add_user_message_to_history(user_message)
+        response_ptq = _make_llm_request("query_expansion", pm, priority, _time_left())
+        output_ptq = response_ptq["choices"][0]["message"]["content"]
+
+        print(output_ptq)
+        output_ptq_list = json.loads(output_ptq.split("\n")[0])
+
+    # only this turn goes into the session history: the user message as the
+    # machine formatted it, and its answer
+    store.append(session_key, pm.messages_history[-2:])
+
+    # next, embed and search every topic in-process and concurrently; every
+    # request shares one loaded model and micro-batching encoder (see
+    # retrieval.py)
+    output_ptq_list = [str(topic) for topic in output_ptq_list]
+    progress("retrieval")
+    with tracing.span("retrieval", topics=len(output_ptq_list), speculative=speculative is not None):
+        if speculative is not None:
+            output_ptq_list, output_embed = retrieval.retrieve_topics_with_speculation(
+                user_message, output_ptq_list, speculative, timeout=_time_left()
+            )
+        else:
+            output_embed = retrieval.retrieve_topics(output_ptq_list, timeout=_time_left())
 
     # {'matches': [{'id': 'subletter$566860', 'score': 0.330594033, 'values': [], 'metadata': {'parent_id': 'subletter$0', 'text': 'bar baz foo foo baz baz bar baz bar bar bar baz', 'title': 'baz bar baz baz'}},
 
@@ -88,35 +182,40 @@ def perform_full_loop(
                     "index": embedding_utils.composite_key_to_tuple(match['id']),
                     "title": match['metadata']['title'],
                     "text": match['metadata']['text'],
+                    "key": match['metadata']['key'],
+                    "parent_key": match['metadata']['parent_key'],
+                    "context": match['metadata'].get('context', []),
+                    "score": match['score'],
                 }
             )
         formatted_output_embed.append(one_topic_ret)
 
+    # finally, summarize the retrieved sections for the user
+    progress("summarization")
+    with tracing.span("context_packing"):
+        gpt_prompt = queried_results_to_app_response.get_gpt_prompt(
+            user_role, building_type, user_message, formatted_output_embed,
+            token_budget=getattr(
+                settings, "CONTEXT_TOKEN_BUDGET", queried_results_to_app_response.DEFAULT_CONTEXT_TOKEN_BUDGET
+            ),
+        )
+    with tracing.span("summarization"):
+        arm = queried_results_to_app_response.AppResponseMachine(user_role, building_type)
+        arm.add_user_message_to_history(gpt_prompt)
+        response_summarize = _make_llm_request("summarization", arm, priority, _time_left())
+        answer = response_summarize["choices"][0]["message"]["content"]
 
-    def serialize_embed_list(embed_list):
-        """
-        input: [{"topic": "water sprinklers", "index": "802.1c", "section_text": "all residential buildings must have 1 sprinkler per household member"}, {"topic": "2 story buildings fire code", "index": "52.1b", "section_text": "New 2-story buildings starting from 1983 must have water sprinklers installed."}]
-        output: "[{\"topic\": \"water sprinklers\", \"index\": \"802.1c\", \"section_text\": \"all residential buildings must have 1 sprinkler per household member\"}, {\"topic\": \"2 story buildings fire code\", \"index\": \"52.1b\", \"section_text\": \"New 2-story buildings starting from 1983 must have water sprinklers installed.\"}]"
-        """
-        return json.dumps(embed_list).replace('"', '\\"')
-
-
-    command_summarize = (
-        f"python3 ../queried_results_to_app_response/queried_results_to_app_response.py "
-        f"--user_role='{str_formatter_for_argparse(user_role)}' "
-        f"--building_type='{str_formatter_for_argparse(building_type)}' "
-        f"--initial_user_message='{str_formatter_for_argparse(user_message)}' "
-        f"--pinecone_response_list '{serialize_embed_list(formatted_output_embed)}' "
-    )
-    print(command_summarize)
+    print(answer)
 
-    command_summarize = shlex.split(command_summarize)
-    process = subprocess.Popen(command_summarize, stdout=subprocess.PIPE)
-    output_summarize, error = process.communicate()
+    if cache is not None and answer.strip():
+        cited_sections = [
+            {"topic": one_topic_ret["topic"], "index": content["index"], "title": content["title"]}
+            for one_topic_ret in formatted_output_embed
+            for content in one_topic_ret["content"]
+        ]
+        cache.store(user_role, building_type, user_message, answer, cited_sections)
 
-    print(output_summarize)
-
-    return output_summarize.decode("utf-8")
+    return answer
 
 
 
@@ -128,11 +227,16 @@ def chat_view(request):
             building_type = form.cleaned_data['building_type']
             user_message = form.cleaned_data['user_message']
 
-            result = perform_full_loop(
-                user_role=user_role,
-                building_type=building_type,
-                user_message=user_message,
-            )
+            if not request.session.session_key:
+                request.session.create()
+
+            with tracing.request_trace("chat"):
+                result = perform_full_loop(
+                    user_role=user_role,
+                    building_type=building_type,
+                    user_message=user_message,
+                    session_key=request.session.session_key,
+                )
 
             # display result back to user!
             return render(request, "chat.html", {'form': form, 'result': result})
@@ -142,4 +246,91 @@ def chat_view(request):
     else:
         form = ChatForm()
 
-    return render(request, "chat.html", {'form': form})
\ No newline at end of file
+    return render(request, "chat.html", {'form': form})
+
+
+def metrics_view(request):
+    """Process metrics in the Prometheus text exposition format."""
+    return HttpResponse(tracing.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def health_view(request):
+    """Readiness: 200 once the models and local indexes are loaded, 503
+    before (see warmup.py)."""
+    return JsonResponse(warmup.status(), status=200 if warmup.is_ready() else 503)
+
+
+def _get_job(request, job_id) -> typing.Optional[ChatJob]:
+    # jobs are only visible to the session that submitted them
+    return ChatJob.objects.filter(pk=job_id, session_key=request.session.session_key or "").first()
+
+
+def _job_response(job: ChatJob, status: int = 200) -> JsonResponse:
+    body = job.to_dict()
+    if job.status == ChatJob.QUEUED:
+        body["queue_position"] = jobs.get_job_queue().queue_position(job)
+    return JsonResponse(body, status=status)
+
+
+@require_POST
+def job_submit_view(request):
+    """Queue a chat request; answers 202 with the job id right away."""
+    form = ChatForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    if not request.session.session_key:
+        request.session.create()
+
+    try:
+        job = jobs.get_job_queue().submit(
+            session_key=request.session.session_key,
+            user_role=form.cleaned_data['user_role'],
+            building_type=form.cleaned_data['building_type'],
+            user_message=form.cleaned_data['user_message'],
+        )
+    except jobs.QueueFull:
+        response = JsonResponse({"error": "too many pending questions, try again shortly"}, status=503)
+        response["Retry-After"] = str(getattr(settings, "JOB_RETRY_AFTER_SECONDS", 10))
+        return response
+    return _job_response(job, status=202)
+
+
+@require_GET
+def job_status_view(request, job_id):
+    job = _get_job(request, job_id)
+    if job is None:
+        return JsonResponse({"error": "no such job"}, status=404)
+    return _job_response(job)
+
+
+@require_POST
+def job_cancel_view(request, job_id):
+    job = _get_job(request, job_id)
+    if job is None:
+        return JsonResponse({"error": "no such job"}, status=404)
+    return _job_response(jobs.get_job_queue().cancel(job))
+
+
+@require_GET
+def job_events_view(request, job_id):
+    """Server-sent events with the job's status, until it finishes."""
+    job = _get_job(request, job_id)
+    if job is None:
+        return JsonResponse({"error": "no such job"}, status=404)
+
+    def _events():
+        last = None
+        deadline = time.monotonic() + getattr(settings, "JOB_TIMEOUT_SECONDS", jobs.DEFAULT_TIMEOUT_SECONDS) * 2
+        while time.monotonic() < deadline:
+            job.refresh_from_db()
+            current = job.to_dict()
+            if current != last:
+                yield f"data: {json.dumps(current)}\n\n"
+                last = current
+            if job.is_finished():
+                return
+            time.sleep(getattr(settings, "JOB_POLL_SECONDS", jobs.DEFAULT_POLL_SECONDS))
+
+    response = StreamingHttpResponse(_events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
@@ -0,0 +1,201 @@
+"""Warm start: load the models, corpus and indexes before the first request.
+
+Warm-up runs in two phases:
+
+- preload (fork-safe): the compact corpus store, lineage table and BM25
+  index, and the query encoder's weights. No threads, no forward pass.
+- worker: per process, start the micro-batching encoder, run a first forward
+  pass and a first vector index query (connection set-up).
+
+By default both phases run in a background thread when the app is ready, and
+/chatbot/health reports "warming" until they are done.
+
+The first vector index query goes to a remote service (pinecone) unless a
+local index is configured. Its failure (a missing API key, a network blip)
+doesn't fail readiness: the worker can still serve, and the probe is retried
+in the background with exponential backoff. Failures of the local components
+do fail it.
+
+With WARM_START_PREFORK, the preload phase runs synchronously in
+AppConfig.ready, i.e. in the master process of a preloading server (gunicorn
+--preload). Workers forked from it share those pages copy-on-write, and each
+runs its worker phase right after the fork. Only use it with a forking
+server: the preloading process itself never becomes ready.
+"""
+
+import gc
+import os
+import sys
+import threading
+import time
+import typing
+
+from django.conf import settings
+
+
+DEFAULT_COMPONENTS = ("corpus", "embedder", "vector_index")
+# remote probes: retried instead of failing readiness
+OPTIONAL_COMPONENTS = ("vector_index",)
+WARM_UP_QUERY = "building code"
+DEFAULT_RETRY_SECONDS = 1.0
+DEFAULT_MAX_RETRIES = 8
+MAX_RETRY_SECONDS = 60.0
+
+_status_lock = threading.Lock()
+_status: typing.Dict[str, typing.Any] = {"state": "cold", "components": {}}
+
+
+def _set_component(name: str, seconds: float, error: typing.Optional[Exception] = None, attempts: int = 1):
+    with _status_lock:
+        _status["components"][name] = {"seconds": round(seconds, 3), "ok": error is None, "attempts": attempts}
+        if error is not None:
+            _status["components"][name]["error"] = f"{type(error).__name__}: {error}"
+
+
+def _run_component(name: str, func: typing.Callable[[], typing.Any], attempts: int = 1) -> bool:
+    start = time.perf_counter()
+    try:
+        func()
+    except Exception as e:
+        print(f"warm start: {name} failed: {e}")
+        _set_component(name, time.perf_counter() - start, e, attempts)
+        return False
+    _set_component(name, time.perf_counter() - start, attempts=attempts)
+    return True
+
+
+def _retry_in_background(name: str, func: typing.Callable[[], typing.Any]):
+    """Retry a failed optional component with exponential backoff, without
+    holding up readiness."""
+    max_retries = getattr(settings, "WARM_START_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+    first_delay = getattr(settings, "WARM_START_RETRY_SECONDS", DEFAULT_RETRY_SECONDS)
+
+    def _run():
+        delay = first_delay
+        for retry in range(1, max_retries + 1):
+            time.sleep(delay)
+            if _run_component(name, func, attempts=retry + 1):
+                return
+            delay = min(delay * 2, MAX_RETRY_SECONDS)
+
+    threading.Thread(target=_run, name=f"warm-start-{name}", daemon=True).start()
+
+
+def _components() -> typing.Tuple[str, ...]:
+    return tuple(getattr(settings, "WARM_START_COMPONENTS", DEFAULT_COMPONENTS))
+
+
+def preload():
+    """Fork-safe loads."""
+    # imported here: management commands shouldn't pay for importing torch
+    from . import retrieval
+
+    components = _components()
+    if "corpus" in components:
+        _run_component("corpus", retrieval.load_corpus)
+    if "embedder" in components:
+        _run_component("embedder_weights", retrieval.load_encoder_model)
+
+
+def _warm_vector_index():
+    from . import retrieval
+
+    vector = retrieval.get_encoder().encode([WARM_UP_QUERY])
+    vector_index = retrieval.current_indexes().vector_index
+    if vector_index is not None:
+        vector_index.query(vector=vector[0], top_k=1)
+    else:
+        retrieval.infer_embedder.query_pinecone(vector, top_k=1)
+
+
+def warm_worker():
+    """Per-process warm-up: encoder thread, first forward pass, first query."""
+    from . import retrieval
+
+    components = _components()
+    if "embedder" in components:
+        _run_component("embedder", lambda: retrieval.get_encoder().encode([WARM_UP_QUERY]))
+    if "vector_index" in components and not _run_component("vector_index", _warm_vector_index):
+        _retry_in_background("vector_index", _warm_vector_index)
+
+
+def _set_state(state: str):
+    with _status_lock:
+        _status["state"] = state
+        _status[f"{state}_at"] = time.time()
+
+
+def _finish():
+    with _status_lock:
+        failed = any(
+            not component["ok"]
+            for name, component in _status["components"].items()
+            if name not in OPTIONAL_COMPONENTS
+        )
+    _set_state("failed" if failed else "ready")
+    print(f"warm start: {status()}")
+
+
+def _warm_up_in_background(phases: typing.List[typing.Callable[[], None]]):
+    def _run():
+        for phase in phases:
+            phase()
+        _finish()
+
+    _set_state("warming")
+    threading.Thread(target=_run, name="warm-start", daemon=True).start()
+
+
+def _after_fork_in_child():
+    # the parent preloaded; the worker phase is per process
+    with _status_lock:
+        _status["components"] = {
+            name: component for name, component in _status["components"].items()
+            if name in ("corpus", "embedder_weights")
+        }
+    _warm_up_in_background([warm_worker])
+
+
+def _is_serving() -> bool:
+    """False for management commands (migrate, shell, ...) and for the file
+    watching parent of the autoreloading development server."""
+    if not sys.argv or os.path.basename(sys.argv[0]) != "manage.py":
+        return True  # e.g. gunicorn/uvicorn importing the wsgi/asgi app
+    if sys.argv[1:2] != ["runserver"]:
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+
+
+def on_app_ready():
+    if not getattr(settings, "WARM_START_ENABLED", False) or not _is_serving():
+        return
+    if getattr(settings, "WARM_START_PREFORK", False):
+        _set_state("warming")
+        preload()
+        # keep the preloaded objects out of the collector, so that collections
+        # in the workers don't touch (and copy) their pages
+        gc.freeze()
+        os.register_at_fork(after_in_child=_after_fork_in_child)
+        # no forward pass here: torch's thread pools don't survive a fork
+        _set_state("preloaded")
+    else:
+        _warm_up_in_background([preload, warm_worker])
+
+
+def status() -> typing.Dict[str, typing.Any]:
+    with _status_lock:
+        return {
+            **_status,
+            "components": {name: dict(component) for name, component in _status["components"].items()},
+            "pid": os.getpid(),
+            "warm_start": getattr(settings, "WARM_START_ENABLED", False),
+        }
+
+
+def is_ready() -> bool:
+    """Ready once warm-up succeeded, or right away if warm start is off (the
+    first requests then load everything themselves)."""
+    if not getattr(settings, "WARM_START_ENABLED", False):
+        return True
+    with _status_lock:
+        return _status["state"] == "ready"
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -78,6 +79,8 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # the chat job queue writes from several threads; wait for the lock
+        "OPTIONS": {"timeout": 20},
     }
 }
 
@@ -122,3 +125,115 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# CodeQuery settings
+
+# Semantic answer cache (chatbot_app/answer_cache.py): near-duplicate
+# questions above this cosine similarity reuse a previous answer
+ANSWER_CACHE_ENABLED = os.getenv("CODEQUERY_ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.92
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_CACHE_MAX_ENTRIES = 5000
+# Shared cache file, filled offline by `python manage.py prewarm_cache`
+# (chatbot_app/prewarm.py); servers reload it when it changes, checked at
+# most every ANSWER_CACHE_RELOAD_SECONDS. Empty: in-memory only
+ANSWER_CACHE_PATH = os.getenv("CODEQUERY_ANSWER_CACHE_PATH", "answer_cache.npz")
+ANSWER_CACHE_RELOAD_SECONDS = 30.0
+# prewarm_cache: questions answered at once, and how often --watch checks
+# for a new corpus version
+PREWARM_CONCURRENCY = 4
+PREWARM_WATCH_SECONDS = 60.0
+
+# Per-topic retrieval fan-out (chatbot_app/retrieval.py)
+RETRIEVAL_MAX_WORKERS = 16
+RETRIEVAL_SEARCH_TIMEOUT_SECONDS = 10.0
+RETRIEVAL_AUGMENT_TIMEOUT_SECONDS = 5.0
+# search the raw question while the query expansion runs; expanded topics at
+# least this similar to the question reuse its results
+RETRIEVAL_SPECULATIVE = True
+RETRIEVAL_SPECULATIVE_COVERAGE_THRESHOLD = 0.8
+RETRIEVAL_SPECULATIVE_WORKERS = 8
+# add each match's parent and nearest siblings (embedding/context_expansion.py),
+# up to this many tokens per match
+RETRIEVAL_CONTEXT_EXPANSION = True
+RETRIEVAL_CONTEXT_TOKENS = 200
+RETRIEVAL_CONTEXT_MAX_SIBLINGS = 4
+# rerank each topic's RETRIEVAL_RERANK_CANDIDATES search results with a
+# cross-encoder (embedding/rerank.py), keeping the best top_k
+RETRIEVAL_RERANK = False
+RETRIEVAL_RERANK_CANDIDATES = 30
+RETRIEVAL_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RETRIEVAL_RERANK_TIMEOUT_SECONDS = 5.0
+# Sharded vector index (embedding/sharded_index.py): one local shard per book
+# (a directory of .npz shards, hot reloaded when they change), or several
+# namespaces of the hosted index. Neither set: the single hosted namespace
+RETRIEVAL_SHARD_DIR = os.getenv("CODEQUERY_SHARD_DIR") or None
+RETRIEVAL_SHARD_NAMESPACES = [
+    namespace for namespace in os.getenv("CODEQUERY_SHARD_NAMESPACES", "").split(",") if namespace
+]
+RETRIEVAL_SHARD_MAX_WORKERS = 8
+RETRIEVAL_SHARD_RELOAD_SECONDS = 30.0
+# Coarse-to-fine local index (embedding/hierarchical_index.py), used when no
+# shards are set: scores section centroids, then the clauses of the best
+# sections. None: the probe count the index was built with
+RETRIEVAL_HIERARCHICAL_INDEX_PATH = os.getenv("CODEQUERY_HIERARCHICAL_INDEX") or None
+RETRIEVAL_HIERARCHICAL_PROBE_SECTIONS = None
+# Versioned index snapshots (embedding/index_snapshot.py): serve the corpus
+# and indexes from the snapshot named in <dir>/CURRENT, and hot swap to a new
+# one when it changes. Unset: the build artifacts at their usual paths
+RETRIEVAL_SNAPSHOT_DIR = os.getenv("CODEQUERY_SNAPSHOT_DIR") or None
+RETRIEVAL_SNAPSHOT_POLL_SECONDS = 10.0
+
+# Prompt tokens of retrieved sections (and their context) for the summary
+# (queried_results_to_app_response.pack_context). Every section keeps its
+# label line; texts past the budget are truncated
+CONTEXT_TOKEN_BUDGET = 6000
+
+# Per-session conversation history for the query machines
+# (chatbot_app/conversation_store.py). Set the backend to "django_cache" to
+# keep conversations in CACHES[CONVERSATION_CACHE_ALIAS] instead of per-process
+# memory, e.g. a DatabaseCache in db.sqlite3 (run `manage.py createcachetable`).
+CONVERSATION_STORE_BACKEND = "memory"
+CONVERSATION_CACHE_ALIAS = "default"
+CONVERSATION_MAX_HISTORY_TOKENS = 1000
+CONVERSATION_KEEP_RECENT_MESSAGES = 4
+CONVERSATION_SUMMARY_MAX_TOKENS = 300
+CONVERSATION_IDLE_SECONDS = 30 * 60
+CONVERSATION_MAX_SESSIONS = 10000
+
+# Request tracing (chatbot_app/tracing.py); metrics are served at
+# /chatbot/metrics. Requests slower than TRACE_SLOW_REQUEST_SECONDS are
+# appended to TRACE_LOG_PATH (json lines) when it is set.
+TRACE_LOG_PATH = os.getenv("CODEQUERY_TRACE_LOG_PATH")
+TRACE_SLOW_REQUEST_SECONDS = float(os.getenv("CODEQUERY_TRACE_SLOW_REQUEST_SECONDS", "10.0"))
+# Every LLM call (stage, model, tokens, latency, cache status, retries) is
+# appended to this json lines ledger; report with llm_ledger/llm_ledger.py.
+# Empty: no ledger
+LLM_LEDGER_PATH = os.getenv("CODEQUERY_LLM_LEDGER_PATH", "llm_ledger.jsonl")
+
+# Warm start (chatbot_app/warmup.py): load the corpus, indexes and query
+# encoder when the app starts instead of on the first requests; readiness is
+# reported at /chatbot/health. Set WARM_START_PREFORK with preloading, forking
+# servers (gunicorn --preload) so workers share the loaded pages.
+WARM_START_ENABLED = os.getenv("CODEQUERY_WARM_START", "1") == "1"
+WARM_START_PREFORK = os.getenv("CODEQUERY_WARM_START_PREFORK", "0") == "1"
+WARM_START_COMPONENTS = ("corpus", "embedder", "vector_index")
+# a failed first vector index query (remote) is retried in the background,
+# backing off from WARM_START_RETRY_SECONDS; it doesn't fail readiness
+WARM_START_RETRY_SECONDS = 1.0
+WARM_START_MAX_RETRIES = 8
+
+# Background chat jobs (chatbot_app/jobs.py): the page submits questions to
+# /chatbot/jobs and polls for the answer. At most JOB_MAX_PENDING jobs are
+# queued or running (across processes) before submits get a 503.
+JOB_MAX_WORKERS = 4
+JOB_MAX_PENDING = 100
+JOB_TIMEOUT_SECONDS = 120.0
+JOB_POLL_SECONDS = 1.0
+# running jobs' heartbeats are refreshed every JOB_HEARTBEAT_SECONDS; jobs
+# without one for JOB_REAP_GRACE_SECONDS lost their worker
+JOB_HEARTBEAT_SECONDS = 10.0
+JOB_REAP_GRACE_SECONDS = 60.0
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+JOB_RETRY_AFTER_SECONDS = 10
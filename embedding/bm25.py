@@ -0,0 +1,281 @@
+"""Lexical (BM25) retrieval over the building code corpus.
+
+Dense embeddings are weak on exact tokens like "1-412", "R-3 occupancy" or
+"sprinkler", so we keep an inverted index next to the vector index and fuse
+the two result lists with reciprocal-rank fusion (see `reciprocal_rank_fusion`).
+
+The postings are stored CSR-style in flat numpy arrays: term t's postings are
+doc_ids[term_offsets[t]:term_offsets[t + 1]] with matching term frequencies in
+tfs. This keeps the whole index a handful of contiguous arrays instead of a
+dict of lists per term.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage (build and save the index):
+poetry run python embedding/bm25.py
+
+Query it:
+poetry run python embedding/bm25.py --query "R-3 occupancy sprinkler"
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import typing
+
+import numpy as np
+
+import utils
+from dedup import DEFAULT_DUPLICATE_MAP_PATH, load_duplicate_map
+from filter_index import FilterIndex, node_filter_fields
+
+
+DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
+DEFAULT_LEXICAL_INDEX_PATH = "embedding/bm25_index.npz"
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+DEFAULT_RRF_K = 60
+
+# keep code references like "1-412", "13-412.1" or "r-3" together as one token
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or shall that the this to which with".split()
+)
+
+
+def tokenize(text: str) -> typing.List[str]:
+    """Lowercase and split into tokens. Hyphenated/dotted tokens are kept whole
+    and also emitted as their parts, so "r-3" matches both "r-3" and "r"/"3"."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        parts = re.split(r"[-.]", token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part and part not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    def __init__(
+        self,
+        doc_keys: typing.List[str],
+        vocab: typing.Dict[str, int],
+        term_offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = DEFAULT_K1,
+        b: float = DEFAULT_B,
+        filter_fields: typing.Optional[typing.List[typing.Dict[str, typing.Any]]] = None,
+    ):
+        """filter_fields[i] holds the filterable fields (see filter_index) of
+        document i, so queries can be restricted with a metadata filter."""
+        self.doc_keys = doc_keys
+        self.vocab = vocab
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.filter_fields = filter_fields or [{} for _ in doc_keys]
+        self.filter_index = FilterIndex(self.filter_fields)
+
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        doc_freqs = np.diff(term_offsets).astype(np.float32)
+        n_docs = len(doc_keys)
+        self.idf = np.log(1.0 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        # the length normalization part of the BM25 denominator only depends
+        # on the document, so compute it once
+        self._length_norm = (
+            k1 * (1.0 - b + b * doc_lengths / max(self.avg_doc_length, 1e-9))
+        ).astype(np.float32)
+
+    @classmethod
+    def from_nodes(
+        cls,
+        nodes: typing.Iterable[typing.Dict[str, typing.Any]],
+        filter_fields_by_key: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None,
+        **kwargs,
+    ) -> "BM25Index":
+        """Build from parsed nodes ({"id", "title", "text", ...}), indexing
+        title + text under the node's composite key."""
+        filter_fields_by_key = filter_fields_by_key or {}
+        doc_keys = []
+        doc_lengths = []
+        vocab: typing.Dict[str, int] = {}
+        term_postings: typing.List[typing.List[typing.Tuple[int, int]]] = []
+        for node in nodes:
+            doc_id = len(doc_keys)
+            doc_keys.append(utils.tuple_to_composite_key(node["id"]))
+            tokens = tokenize(node["title"] + " " + node["text"])
+            doc_lengths.append(len(tokens))
+            for term, tf in collections.Counter(tokens).items():
+                if term not in vocab:
+                    vocab[term] = len(vocab)
+                    term_postings.append([])
+                term_postings[vocab[term]].append((doc_id, tf))
+
+        term_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(postings) for postings in term_postings])
+        doc_ids = np.empty(term_offsets[-1], dtype=np.int32)
+        tfs = np.empty(term_offsets[-1], dtype=np.uint16)
+        for term_id, postings in enumerate(term_postings):
+            start = term_offsets[term_id]
+            for i, (doc_id, tf) in enumerate(postings):
+                doc_ids[start + i] = doc_id
+                tfs[start + i] = min(tf, np.iinfo(np.uint16).max)
+
+        return cls(
+            doc_keys,
+            vocab,
+            term_offsets,
+            doc_ids,
+            tfs,
+            np.asarray(doc_lengths, dtype=np.float32),
+            filter_fields=[filter_fields_by_key.get(key, {}) for key in doc_keys],
+            **kwargs,
+        )
+
+    @classmethod
+    def from_jsonl(
+        cls,
+        data_path: str = DEFAULT_TEXT_DATA_PATH,
+        duplicate_map: typing.Optional[typing.Dict[str, str]] = None,
+        **kwargs,
+    ) -> "BM25Index":
+        """Build from building_code_output.jsonl, skipping the same
+        uninformative and near-duplicate nodes that create_embedding.py
+        skips."""
+        nodes = []
+        with open(data_path, 'r') as f:
+            for line in f:
+                nodes.append(json.loads(line))
+        duplicate_map = duplicate_map or {}
+        return cls.from_nodes(
+            [
+                d for d in nodes
+                if utils.is_informative(d) and utils.tuple_to_composite_key(d["id"]) not in duplicate_map
+            ],
+            filter_fields_by_key=node_filter_fields(nodes),
+            **kwargs,
+        )
+
+    def save(self, path: str = DEFAULT_LEXICAL_INDEX_PATH):
+        header = {
+            "doc_keys": self.doc_keys,
+            "vocab": self.vocab,
+            "k1": self.k1,
+            "b": self.b,
+            "filter_fields": self.filter_fields,
+        }
+        np.savez(
+            path,
+            header=np.array(json.dumps(header)),
+            term_offsets=self.term_offsets,
+            doc_ids=self.doc_ids,
+            tfs=self.tfs,
+            doc_lengths=self.doc_lengths,
+        )
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_LEXICAL_INDEX_PATH) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as npz:
+            header = json.loads(str(npz["header"]))
+            return cls(
+                header["doc_keys"],
+                header["vocab"],
+                npz["term_offsets"],
+                npz["doc_ids"],
+                npz["tfs"],
+                npz["doc_lengths"],
+                k1=header["k1"],
+                b=header["b"],
+                filter_fields=header.get("filter_fields"),
+            )
+
+    def scores(self, query: str, filter: typing.Optional[typing.Dict[str, typing.Any]] = None) -> np.ndarray:
+        """BM25 score of every document. Documents excluded by the metadata
+        filter score 0."""
+        scores = np.zeros(len(self.doc_keys), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end].astype(np.float32)
+            # doc ids are unique within one term's postings, so plain fancy
+            # indexing is safe here (no need for np.add.at)
+            scores[docs] += self.idf[term_id] * tf * (self.k1 + 1.0) / (tf + self._length_norm[docs])
+        if filter:
+            scores[~self.filter_index.mask(filter)] = 0.0
+        return scores
+
+    def query(
+        self,
+        query: str,
+        top_k: int = 10,
+        filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """Return the top_k matches in the same shape as a vector index query."""
+        scores = self.scores(query, filter=filter)
+        top_k = min(int(top_k), int(np.count_nonzero(scores)))
+        if top_k == 0:
+            return {"matches": []}
+        top_docs = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_docs = top_docs[np.argsort(-scores[top_docs])]
+        return {
+            "matches": [
+                {"id": self.doc_keys[doc], "score": float(scores[doc]), "values": []}
+                for doc in top_docs
+            ]
+        }
+
+
+def reciprocal_rank_fusion(
+    results: typing.List[typing.Dict[str, typing.Any]],
+    top_k: int = 10,
+    k: int = DEFAULT_RRF_K,
+) -> typing.Dict[str, typing.Any]:
+    """Merge ranked match lists by summing 1 / (k + rank) per id.
+
+    RRF only looks at ranks, so the cosine scores of the dense leg and the
+    unbounded BM25 scores don't need to be calibrated against each other."""
+    fused_scores: typing.Dict[str, float] = collections.defaultdict(float)
+    first_seen: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for result in results:
+        for rank, match in enumerate(result["matches"], start=1):
+            fused_scores[match["id"]] += 1.0 / (k + rank)
+            first_seen.setdefault(match["id"], match)
+
+    ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:top_k]
+    matches = []
+    for match_id in ranked_ids:
+        match = dict(first_seen[match_id])
+        match["score"] = fused_scores[match_id]
+        matches.append(match)
+    return {"matches": matches}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build (or query) the BM25 index.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file.')
+    parser.add_argument('--index_path', default=DEFAULT_LEXICAL_INDEX_PATH, help='Path to save/load the BM25 index.')
+    parser.add_argument('--duplicate_map_path', default=DEFAULT_DUPLICATE_MAP_PATH, help='Near-duplicates to leave out (see dedup.py), if the file exists.')
+    parser.add_argument('--query', default=None, help='Query the saved index instead of building it.')
+    parser.add_argument('--top_k', type=int, default=10, help='Number of results to return.')
+    args = parser.parse_args()
+
+    if args.query is None:
+        duplicate_map = load_duplicate_map(args.duplicate_map_path) if os.path.exists(args.duplicate_map_path) else None
+        index = BM25Index.from_jsonl(args.data_path, duplicate_map=duplicate_map)
+        index.save(args.index_path)
+        print(f"BM25 index: {len(index.doc_keys)} docs, {len(index.vocab)} terms, {len(index.doc_ids)} postings")
+    else:
+        index = BM25Index.load(args.index_path)
+        print(json.dumps(index.query(args.query, args.top_k)))
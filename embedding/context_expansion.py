@@ -0,0 +1,107 @@
+"""Tree-aware context for retrieved nodes.
+
+A matched clause ("(3) the fee is doubled") often means little without the
+section it belongs to or the items around it. After augmentation, each match
+gets a "context" list of nearby nodes, read from the corpus store's adjacency
+arrays (parent, previous/next sibling) with O(1) lookups:
+
+- the parent first, or the nearest ancestor with some text if the parent
+  is a bare label ("(a)"); never a chapter or article, whose headings are
+  already in the readable section
+- then siblings, nearest first, alternating previous and next
+
+Nodes are added until the match's token budget is used up. Nodes that are
+matches of the same result themselves are skipped, since they are in the
+prompt anyway.
+
+Example usage:
+    results = augment_results_with_local_embeddings(results, corpus=store, ...)
+    expand_context(results, store, token_budget=200)
+"""
+
+import typing
+
+import corpus_store
+
+
+DEFAULT_TOKEN_BUDGET = 200
+DEFAULT_MAX_SIBLINGS = 4
+# chapters and articles are only headings, already in the readable section
+PARENT_MIN_LEVEL = 3
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token, like the prompt packer without tiktoken
+    return (len(text) + 3) // 4
+
+
+def _context_entry(node: corpus_store.NodeView, relation: str) -> typing.Dict[str, typing.Any]:
+    return {"key": node.key, "relation": relation, "title": node.title, "text": node.text}
+
+
+def context_for(
+    store: corpus_store.CorpusStore,
+    key: str,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    max_siblings: int = DEFAULT_MAX_SIBLINGS,
+    exclude: typing.Collection[str] = (),
+    count_tokens: typing.Callable[[str], int] = estimate_tokens,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Parent and nearby siblings of one node, within token_budget."""
+    node = store.get(key)
+    if node is None:
+        return []
+
+    candidates = []
+    # the nearest ancestor with some text: a clause's parent is often just
+    # its "(a)" label
+    for ancestor in node.ancestors():
+        if ancestor.level < PARENT_MIN_LEVEL:
+            break
+        if ancestor.text.strip():
+            candidates.append((ancestor, "parent"))
+            break
+    previous, following = node.previous_sibling, node.next_sibling
+    while len(candidates) < max_siblings + 1 and (previous is not None or following is not None):
+        if previous is not None:
+            candidates.append((previous, "previous"))
+            previous = previous.previous_sibling
+        if following is not None:
+            candidates.append((following, "next"))
+            following = following.next_sibling
+
+    context, remaining = [], token_budget
+    for candidate, relation in candidates:
+        if candidate.key in exclude:
+            continue
+        tokens = count_tokens(candidate.title + " " + candidate.text)
+        if tokens > remaining:
+            # a sibling further out may still fit, but then the context would
+            # skip over one; stop at the first that doesn't
+            break
+        context.append(_context_entry(candidate, relation))
+        remaining -= tokens
+    return context
+
+
+def expand_context(
+    results: typing.List[typing.Dict[str, typing.Any]],
+    store: corpus_store.CorpusStore,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    max_siblings: int = DEFAULT_MAX_SIBLINGS,
+    count_tokens: typing.Callable[[str], int] = estimate_tokens,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Add metadata["context"] to every augmented match (in place); the
+    token budget is per match."""
+    for result in results:
+        matched_keys = {match["metadata"]["key"] for match in result["matches"]}
+        for match in result["matches"]:
+            match["metadata"]["context"] = context_for(
+                store,
+                match["metadata"]["key"],
+                token_budget=token_budget,
+                max_siblings=max_siblings,
+                exclude=matched_keys,
+                count_tokens=count_tokens,
+            )
+    return results
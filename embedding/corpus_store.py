@@ -0,0 +1,415 @@
+"""Compact, array-backed in-memory corpus.
+
+Holding the parsed nodes as a list of dicts costs a few hundred bytes of
+object overhead per node (the dict, the id/parent_id lists, the boxed ints,
+one str per title and text), and every lookup by composite key
+("level_5$60000123") splits or joins strings. `CorpusStore` keeps the same
+nodes in a handful of arrays instead:
+
+- ids / parent_ids: int64, the level packed into the high bits of the node
+  number (pack_node_id), so a composite key is one int
+- parent_rows: int32 row of each node's parent (-1 for the roots), so tree
+  walks are array indexing
+- adjacency: each node's children in order (CSR arrays) and its previous and
+  next sibling, so neighbourhood lookups are O(1) too
+- levels, book_rows: small ints; book names are kept once in `books`
+- titles and texts: one utf-8 arena, with (start, length) arrays per field.
+  Equal strings are stored once (headings like "GENERAL" repeat a lot)
+
+Keys are looked up with a binary search over the sorted ids. Nodes are read
+through `NodeView`, a two-slot view that also answers node["title"] etc., so
+code written against the dicts keeps working.
+
+Composite keys must be unique across the whole corpus (books get disjoint
+node number ranges at ingestion).
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python embedding/corpus_store.py --data_path process_pdf_to_jsonl/building_code_output.jsonl
+"""
+
+import argparse
+import json
+import sys
+import typing
+
+import numpy as np
+
+import utils
+
+
+DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
+DEFAULT_CORPUS_STORE_PATH = "process_pdf_to_jsonl/building_code_corpus.npz"
+DEFAULT_BOOK = "ca_administrative_2022"
+LEVEL_PREFIX = "level_"
+
+LEVEL_SHIFT = 48
+NUMBER_MASK = (1 << LEVEL_SHIFT) - 1
+NO_ROW = -1
+
+
+def pack_node_id(level: int, number: int) -> int:
+    return (level << LEVEL_SHIFT) | number
+
+
+def unpack_node_id(packed: int) -> typing.Tuple[int, int]:
+    """(level, node number)"""
+    return packed >> LEVEL_SHIFT, packed & NUMBER_MASK
+
+
+def pack_id(node_id: typing.Sequence[typing.Any]) -> int:
+    """["level_5", 60000123] -> packed int"""
+    node_type, number = node_id
+    return pack_node_id(int(node_type[len(LEVEL_PREFIX):]), int(number))
+
+
+def pack_composite_key(key: str) -> int:
+    """"level_5$60000123" -> packed int"""
+    node_type, _, number = key.partition(utils.COMPOSITE_SPLITTER)
+    if not node_type.startswith(LEVEL_PREFIX):
+        raise ValueError(f"not a node key: {key!r}")
+    return pack_node_id(int(node_type[len(LEVEL_PREFIX):]), int(number))
+
+
+def composite_key(packed: int) -> str:
+    level, number = unpack_node_id(packed)
+    return f"{LEVEL_PREFIX}{level}{utils.COMPOSITE_SPLITTER}{number}"
+
+
+def pack_key(key: typing.Union[str, int, typing.Sequence[typing.Any]]) -> int:
+    """A composite key, an ["level_N", id] pair or an already packed id ->
+    packed int"""
+    if isinstance(key, str):
+        return pack_composite_key(key)
+    if isinstance(key, (int, np.integer)):
+        return int(key)
+    return pack_id(key)
+
+
+class NodeView:
+    """A read-only view of one row of a CorpusStore. Also readable like the
+    original node dict (view["title"], view.get("book"))."""
+
+    __slots__ = ("_store", "row")
+
+    FIELDS = ("id", "parent_id", "text", "title", "book")
+
+    def __init__(self, store: "CorpusStore", row: int):
+        self._store = store
+        self.row = row
+
+    @property
+    def packed_id(self) -> int:
+        return int(self._store.ids[self.row])
+
+    @property
+    def key(self) -> str:
+        return composite_key(self.packed_id)
+
+    @property
+    def id(self) -> typing.List[typing.Any]:
+        level, number = unpack_node_id(self.packed_id)
+        return [f"{LEVEL_PREFIX}{level}", number]
+
+    @property
+    def parent_key(self) -> str:
+        return composite_key(int(self._store.parent_ids[self.row]))
+
+    @property
+    def parent_id(self) -> typing.List[typing.Any]:
+        level, number = unpack_node_id(int(self._store.parent_ids[self.row]))
+        return [f"{LEVEL_PREFIX}{level}", number]
+
+    @property
+    def level(self) -> int:
+        return int(self._store.levels[self.row])
+
+    @property
+    def title(self) -> str:
+        return self._store.title(self.row)
+
+    @property
+    def text(self) -> str:
+        return self._store.text(self.row)
+
+    @property
+    def book(self) -> str:
+        return self._store.books[self._store.book_rows[self.row]]
+
+    @property
+    def parent(self) -> typing.Optional["NodeView"]:
+        parent_row = int(self._store.parent_rows[self.row])
+        return None if parent_row == NO_ROW else NodeView(self._store, parent_row)
+
+    @property
+    def previous_sibling(self) -> typing.Optional["NodeView"]:
+        sibling_row = int(self._store.prev_sibling_rows[self.row])
+        return None if sibling_row == NO_ROW else NodeView(self._store, sibling_row)
+
+    @property
+    def next_sibling(self) -> typing.Optional["NodeView"]:
+        sibling_row = int(self._store.next_sibling_rows[self.row])
+        return None if sibling_row == NO_ROW else NodeView(self._store, sibling_row)
+
+    def children(self) -> typing.List["NodeView"]:
+        return [NodeView(self._store, int(row)) for row in self._store.children(self.row)]
+
+    def ancestors(self) -> typing.List["NodeView"]:
+        """Nearest first."""
+        return [NodeView(self._store, row) for row in self._store.ancestor_rows(self.row)]
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __getitem__(self, field: str):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field: str, default=None):
+        return getattr(self, field) if field in self.FIELDS else default
+
+    def __eq__(self, other):
+        return isinstance(other, NodeView) and other._store is self._store and other.row == self.row
+
+    def __hash__(self):
+        return hash((id(self._store), self.row))
+
+    def __repr__(self):
+        return f"NodeView({self.key!r}, title={self.title!r})"
+
+
+class CorpusStore:
+    def __init__(
+        self,
+        ids: np.ndarray,
+        parent_ids: np.ndarray,
+        book_rows: np.ndarray,
+        books: typing.List[str],
+        arena: bytes,
+        title_starts: np.ndarray,
+        title_lengths: np.ndarray,
+        text_starts: np.ndarray,
+        text_lengths: np.ndarray,
+    ):
+        self.ids = ids
+        self.parent_ids = parent_ids
+        self.book_rows = book_rows
+        self.books = books
+        self.arena = arena
+        self.title_starts = title_starts
+        self.title_lengths = title_lengths
+        self.text_starts = text_starts
+        self.text_lengths = text_lengths
+
+        self.levels = (ids >> LEVEL_SHIFT).astype(np.uint8)
+        self._sorted_rows = np.argsort(ids, kind="stable").astype(np.int32)
+        self._sorted_ids = ids[self._sorted_rows]
+        self.parent_rows = self.rows_of(parent_ids)
+        self._build_adjacency()
+
+    def _build_adjacency(self):
+        """Children of every row in file order (CSR: child_rows[child_offsets[r]:
+        child_offsets[r + 1]]), and every row's previous/next sibling, i.e. the
+        nodes with the same parent id (chapters are siblings under the root
+        even though the root isn't a node)."""
+        n = len(self.ids)
+        rows = np.arange(n, dtype=np.int32)
+        by_parent = np.lexsort((rows, self.parent_ids)).astype(np.int32)
+        same_parent = self.parent_ids[by_parent[1:]] == self.parent_ids[by_parent[:-1]]
+        self.prev_sibling_rows = np.full(n, NO_ROW, dtype=np.int32)
+        self.next_sibling_rows = np.full(n, NO_ROW, dtype=np.int32)
+        self.next_sibling_rows[by_parent[:-1][same_parent]] = by_parent[1:][same_parent]
+        self.prev_sibling_rows[by_parent[1:][same_parent]] = by_parent[:-1][same_parent]
+
+        with_parent = by_parent[self.parent_rows[by_parent] != NO_ROW]
+        with_parent = with_parent[np.argsort(self.parent_rows[with_parent], kind="stable")]
+        self.child_rows = with_parent
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        self.child_offsets[1:] = np.cumsum(np.bincount(self.parent_rows[with_parent], minlength=n))
+
+    @classmethod
+    def from_nodes(cls, nodes: typing.Iterable[typing.Dict[str, typing.Any]], book: str = DEFAULT_BOOK) -> "CorpusStore":
+        """Build from parsed nodes ({"id", "parent_id", "title", "text",
+        optionally "book"}). Nodes without a book get `book`."""
+        ids, parent_ids, book_rows = [], [], []
+        books: typing.Dict[str, int] = {}
+        arena = bytearray()
+        interned: typing.Dict[str, typing.Tuple[int, int]] = {}
+        spans = {"title": ([], []), "text": ([], [])}
+
+        for node in nodes:
+            ids.append(pack_id(node["id"]))
+            parent_ids.append(pack_id(node["parent_id"]))
+            book_rows.append(books.setdefault(node.get("book", book), len(books)))
+            for field, (starts, lengths) in spans.items():
+                value = node[field]
+                if value not in interned:
+                    encoded = value.encode("utf-8")
+                    interned[value] = (len(arena), len(encoded))
+                    arena.extend(encoded)
+                start, length = interned[value]
+                starts.append(start)
+                lengths.append(length)
+
+        return cls(
+            np.array(ids, dtype=np.int64),
+            np.array(parent_ids, dtype=np.int64),
+            np.array(book_rows, dtype=np.uint16),
+            list(books),
+            bytes(arena),
+            np.array(spans["title"][0], dtype=np.int64),
+            np.array(spans["title"][1], dtype=np.int32),
+            np.array(spans["text"][0], dtype=np.int64),
+            np.array(spans["text"][1], dtype=np.int32),
+        )
+
+    @classmethod
+    def from_jsonl(cls, data_path: str = DEFAULT_TEXT_DATA_PATH, book: str = DEFAULT_BOOK) -> "CorpusStore":
+        with open(data_path, 'r') as f:
+            return cls.from_nodes((json.loads(line) for line in f), book=book)
+
+    def save(self, path: str = DEFAULT_CORPUS_STORE_PATH):
+        np.savez(
+            path,
+            header=np.array(json.dumps({"books": self.books})),
+            ids=self.ids,
+            parent_ids=self.parent_ids,
+            book_rows=self.book_rows,
+            arena=np.frombuffer(self.arena, dtype=np.uint8),
+            title_starts=self.title_starts,
+            title_lengths=self.title_lengths,
+            text_starts=self.text_starts,
+            text_lengths=self.text_lengths,
+        )
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CORPUS_STORE_PATH) -> "CorpusStore":
+        with np.load(path, allow_pickle=False) as npz:
+            header = json.loads(str(npz["header"]))
+            return cls(
+                npz["ids"],
+                npz["parent_ids"],
+                npz["book_rows"],
+                header["books"],
+                npz["arena"].tobytes(),
+                npz["title_starts"],
+                npz["title_lengths"],
+                npz["text_starts"],
+                npz["text_lengths"],
+            )
+
+    def rows_of(self, packed_ids: np.ndarray) -> np.ndarray:
+        """Row of each packed id, NO_ROW for ids not in the corpus."""
+        packed_ids = np.asarray(packed_ids, dtype=np.int64)
+        if not len(self._sorted_ids):
+            return np.full(packed_ids.shape, NO_ROW, dtype=np.int32)
+        positions = np.searchsorted(self._sorted_ids, packed_ids)
+        positions = np.minimum(positions, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == packed_ids
+        return np.where(found, self._sorted_rows[positions], NO_ROW).astype(np.int32)
+
+    def row_of(self, key: typing.Union[str, int, typing.Sequence[typing.Any]]) -> int:
+        """Row of a composite key, packed id or ["level_N", id] pair; NO_ROW
+        if it isn't in the corpus."""
+        try:
+            packed = pack_key(key)
+        except ValueError:
+            return NO_ROW
+        position = int(np.searchsorted(self._sorted_ids, packed))
+        if position < len(self._sorted_ids) and self._sorted_ids[position] == packed:
+            return int(self._sorted_rows[position])
+        return NO_ROW
+
+    def _decode(self, start: int, length: int) -> str:
+        return self.arena[start:start + length].decode("utf-8")
+
+    def title(self, row: int) -> str:
+        return self._decode(self.title_starts[row], self.title_lengths[row])
+
+    def text(self, row: int) -> str:
+        return self._decode(self.text_starts[row], self.text_lengths[row])
+
+    def key(self, row: int) -> str:
+        return composite_key(int(self.ids[row]))
+
+    def children(self, row: int) -> np.ndarray:
+        """Rows of the node's children, in file order."""
+        return self.child_rows[self.child_offsets[row]:self.child_offsets[row + 1]]
+
+    def ancestor_rows(self, row: int) -> typing.List[int]:
+        """Rows of the ancestors that are in the corpus, nearest first."""
+        ancestors = []
+        parent_row = int(self.parent_rows[row])
+        # bounded, in case a malformed corpus has a cycle
+        while parent_row != NO_ROW and len(ancestors) < len(self.ids):
+            ancestors.append(parent_row)
+            parent_row = int(self.parent_rows[parent_row])
+        return ancestors
+
+    def node(self, row: int) -> NodeView:
+        return NodeView(self, row)
+
+    def get(self, key, default=None) -> typing.Optional[NodeView]:
+        row = self.row_of(key)
+        return default if row == NO_ROW else NodeView(self, row)
+
+    def __getitem__(self, key) -> NodeView:
+        row = self.row_of(key)
+        if row == NO_ROW:
+            raise KeyError(key)
+        return NodeView(self, row)
+
+    def __contains__(self, key) -> bool:
+        return self.row_of(key) != NO_ROW
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> typing.Iterator[NodeView]:
+        return (NodeView(self, row) for row in range(len(self.ids)))
+
+    def keys(self) -> typing.List[str]:
+        return [composite_key(int(packed)) for packed in self.ids]
+
+    def to_dicts(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        return [node.to_dict() for node in self]
+
+    def nbytes(self) -> int:
+        arrays = (
+            self.ids, self.parent_ids, self.parent_rows, self.levels, self.book_rows,
+            self.title_starts, self.title_lengths, self.text_starts, self.text_lengths,
+            self._sorted_ids, self._sorted_rows,
+            self.prev_sibling_rows, self.next_sibling_rows, self.child_rows, self.child_offsets,
+        )
+        return len(self.arena) + sum(array.nbytes for array in arrays)
+
+
+def _deep_sizeof(obj, seen=None) -> int:
+    """Rough size of a tree of dicts/lists/strings, for the comparison below."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the compact corpus store.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file.')
+    parser.add_argument('--corpus_store_path', default=DEFAULT_CORPUS_STORE_PATH, help='Where to write the store (.npz).')
+    parser.add_argument('--book', default=DEFAULT_BOOK, help='Book of the nodes that have none.')
+    args = parser.parse_args()
+
+    with open(args.data_path, 'r') as f:
+        nodes = [json.loads(line) for line in f]
+    store = CorpusStore.from_nodes(nodes, book=args.book)
+    store.save(args.corpus_store_path)
+    print(f"Corpus store: {len(store)} nodes -> {args.corpus_store_path}")
+    print(f"  list of dicts: {_deep_sizeof(nodes) / 1e6:.1f} MB, store: {store.nbytes() / 1e6:.1f} MB")
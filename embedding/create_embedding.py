@@ -5,6 +5,9 @@ Run from one level up (not from embedding directory, but from bobbuildergpt)
 
 Example usage:
 poetry run python embedding/create_embedding.py
+
+Upload to a local stand-in index instead of pinecone:
+poetry run python embedding/create_embedding.py --bypass_encoding --vector_store local
 """
 
 import json
@@ -15,6 +18,11 @@ import argparse
 
 import pinecone
 
+from dedup import DEFAULT_DUPLICATE_MAP_PATH, load_duplicate_map
+from filter_index import FILTER_FIELDS, node_filter_fields
+from local_index import LocalIndex, DEFAULT_LOCAL_INDEX_PATH
+from upsert_engine import UpsertEngine, DEFAULT_MAX_WORKERS
+
 
 DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
 DEFAULT_EMBEDDING_MODEL_PATH = "embedding/models/chapter_1_embedder"
@@ -24,16 +32,23 @@ DEFAULT_MODEL_TYPE = "roberta-base-nli-mean-tokens"
 DEFAULT_PINECONE_ENVIRONMENT = "asia-southeast1-gcp-free"
 
 # Load and parse the structured text data
-data = []
+all_nodes = []
 with open(DEFAULT_TEXT_DATA_PATH, 'r') as f:
     for line in f:
-        d = json.loads(line)
-        # if d is not informative, skip it
-        if (
-            (len(d['title'].split(" ")) < 5 and len(d['text'].split(" ")) < 10)
-        ):
-            continue
-        data.append(d)
+        all_nodes.append(json.loads(line))
+
+# filterable fields (level, chapter, article, book) need the full lineage,
+# including the uninformative chapter/article headings skipped below
+filter_fields = node_filter_fields(all_nodes)
+
+# if d is not informative, skip it
+data = [d for d in all_nodes if utils.is_informative(d)]
+
+# near-duplicates (see dedup.py) are represented by their cluster's first
+# node, so only that one gets embedded
+if os.path.exists(DEFAULT_DUPLICATE_MAP_PATH):
+    duplicate_map = load_duplicate_map(DEFAULT_DUPLICATE_MAP_PATH)
+    data = [d for d in data if utils.tuple_to_composite_key(d['id']) not in duplicate_map]
 
 # Extract title and text for vectorization
 titles = [item['title'] for item in data]
@@ -55,6 +70,23 @@ if __name__ == "__main__":
         action="store_true",
         help="Bypass encoding and just load the embeddings from a file.",
     )
+    parser.add_argument(
+        "--vector_store",
+        choices=["pinecone", "local"],
+        default="pinecone",
+        help="Upload to the hosted pinecone index, or to a local stand-in index saved to --local_index_path.",
+    )
+    parser.add_argument(
+        "--local_index_path",
+        default=DEFAULT_LOCAL_INDEX_PATH,
+        help="Where to save the local index when --vector_store=local.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="Number of concurrent upsert requests.",
+    )
 
     args = parser.parse_args()
 
@@ -77,6 +109,7 @@ if __name__ == "__main__":
         #       "id": "node_type_node_id" <-- this is a composite key (str)
         #       "metadata": {
         #         "parent_id": "node_type_node_id",  <-- also a composite key (str)
+        #         "level": 3, "chapter": 1, "article": 1, "book": "..."  <-- filterable
         #       },
         #       "values": [
         #         0.3129859419524348,
@@ -95,6 +128,7 @@ if __name__ == "__main__":
                         "parent_id": utils.tuple_to_composite_key(item['parent_id']),  # "node_type_node_id
                         "title": item['title'],
                         "text": item['text'],  # too large, we'll just refer it later using the old fashion way
+                        **filter_fields[utils.tuple_to_composite_key(item['id'])],
                     },
                     "values": embedding.tolist(),
                 }
@@ -135,22 +169,24 @@ if __name__ == "__main__":
         model = SentenceTransformer(DEFAULT_EMBEDDING_MODEL_PATH)
 
 
-    # also, use pinecone API to upload the embedding
-
-    # loop through the embeddings, delete all metadata
-    for item in id_to_embedding:
-        del item["metadata"]
-
-    # create a pinecone client
-    pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=DEFAULT_PINECONE_ENVIRONMENT)
-
-    # use existing index
-    index = pinecone.Index(index_name="california-codes")
-
-    # upload the embedding
-    # note that there's a limit of 1000 records per call
-    batch_size = 50
-    index.upsert(
-        vectors=id_to_embedding,
-        batch_size=batch_size,
-    )
+    # also, upload the embedding to the vector store
+    if args.vector_store == "local":
+        index = LocalIndex()
+    else:
+        # create a pinecone client
+        pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=DEFAULT_PINECONE_ENVIRONMENT)
+
+        # use existing index
+        index = pinecone.Index(index_name="california-codes")
+
+    # batches are sized by payload (pinecone allows 2MB / 1000 records per
+    # call) and sent concurrently; only the small filterable metadata fields
+    # are uploaded, without touching id_to_embedding
+    engine = UpsertEngine(index, max_workers=args.max_workers)
+    report = engine.upsert(id_to_embedding, metadata_fields=FILTER_FIELDS)
+    print(report)
+    if report.failed_batches:
+        print(f"Failed to upsert {len(report.failed_ids)} vectors: {report.failed_ids}")
+
+    if args.vector_store == "local":
+        index.save(args.local_index_path)
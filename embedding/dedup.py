@@ -0,0 +1,192 @@
+"""Near-duplicate detection over the parsed corpus, before embedding.
+
+The parsed code repeats itself: amendment notes ("Approved by the California
+Building Standards Commission on ..."), "Reserved" sections, boilerplate
+exceptions, and text shared by the Administrative and Building editions.
+Every copy would be embedded, indexed and searched, and the copies crowd
+each other out of the top_k.
+
+This stage sits between process_pdf_to_jsonl and create_embedding:
+
+- each informative node becomes a set of character shingles of its
+  title + text with the whitespace removed (the PDF extraction splits and
+  joins words at random: "th e office", "commissionon")
+- MinHash signatures (NUM_PERM permutations) estimate the Jaccard
+  similarity of two nodes; LSH banding (BANDS bands of ROWS rows) finds the
+  candidate pairs without comparing every pair
+- candidates whose estimated similarity is at least the threshold, and
+  whose numbers are the same (a "Class 2" and a "Class 4" inspector differ
+  by one shingle, but aren't duplicates), are clustered with union-find;
+  the first node of each cluster in file order is its representative
+
+The result is a sidecar map from every duplicate to its representative.
+create_embedding.py and the BM25 index skip the duplicates, so only the
+representatives get embedded and searched, and search results list the
+duplicates of each match (metadata "duplicate_keys").
+
+By default only nodes with the same book, chapter and article are
+clustered (DEFAULT_PARTITION_BY): a duplicate dropped in favour of a node
+from another article would be missed by a filter on its own article or
+chapter, and cited by the representative's section number. Pass an empty
+--partition_by to also cluster across them (e.g. the editions shared by the
+Administrative and Building books).
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python embedding/dedup.py
+"""
+
+import argparse
+import json
+import re
+import typing
+import zlib
+
+import numpy as np
+
+import utils
+from filter_index import node_filter_fields
+
+
+DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
+DEFAULT_DUPLICATE_MAP_PATH = "process_pdf_to_jsonl/building_code_duplicates.json"
+DEFAULT_THRESHOLD = 0.85
+DEFAULT_PARTITION_BY = ("book", "chapter", "article")
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SEED = 1
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def _compact(text: str) -> str:
+    return "".join(text.lower().split())
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> typing.Set[bytes]:
+    compact = _compact(text).encode("utf-8")
+    if len(compact) <= size:
+        return {compact}
+    return {compact[i:i + size] for i in range(len(compact) - size + 1)}
+
+
+def numbers(text: str) -> typing.Tuple[str, ...]:
+    return tuple(re.findall(r"\d+", _compact(text)))
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = SEED):
+        rng = np.random.RandomState(seed)
+        # a*h + b stays below 2**64 for 32-bit a, b and h
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set: typing.Set[bytes]) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(shingle) for shingle in shingle_set), dtype=np.uint64, count=len(shingle_set))
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+def _find(parents: typing.List[int], i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def find_duplicates(
+    nodes: typing.List[typing.Dict[str, typing.Any]],
+    threshold: float = DEFAULT_THRESHOLD,
+    partition_keys: typing.Optional[typing.List[typing.Any]] = None,
+) -> typing.Dict[str, str]:
+    """Composite key of every near-duplicate node -> key of its cluster's
+    representative (the cluster's first node). Representatives aren't in the
+    map. Nodes only cluster with nodes of the same partition key, if given."""
+    keys = [utils.tuple_to_composite_key(node["id"]) for node in nodes]
+    texts = [node["title"] + " " + node["text"] for node in nodes]
+    hasher = MinHasher()
+    signatures = np.vstack([hasher.signature(shingles(text)) for text in texts]) if nodes else None
+
+    # LSH: nodes whose signatures agree on all the rows of any band are
+    # candidates
+    candidates = set()
+    for band in range(BANDS):
+        buckets: typing.Dict[typing.Tuple[typing.Any, bytes], typing.List[int]] = {}
+        for i in range(len(nodes)):
+            partition = partition_keys[i] if partition_keys is not None else None
+            bucket = (partition, signatures[i, band * ROWS:(band + 1) * ROWS].tobytes())
+            buckets.setdefault(bucket, []).append(i)
+        for members in buckets.values():
+            for j in members[1:]:
+                candidates.add((members[0], j))
+
+    parents = list(range(len(nodes)))
+    for i, j in candidates:
+        if np.mean(signatures[i] == signatures[j]) >= threshold and numbers(texts[i]) == numbers(texts[j]):
+            root_i, root_j = _find(parents, i), _find(parents, j)
+            # the earlier node stays the root, so it is the representative
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    return {keys[i]: keys[_find(parents, i)] for i in range(len(nodes)) if _find(parents, i) != i}
+
+
+def duplicate_groups(duplicate_map: typing.Dict[str, str]) -> typing.Dict[str, typing.List[str]]:
+    """Representative -> its duplicates."""
+    groups: typing.Dict[str, typing.List[str]] = {}
+    for member, representative in duplicate_map.items():
+        groups.setdefault(representative, []).append(member)
+    return groups
+
+
+def load_duplicate_map(duplicate_map_path: str = DEFAULT_DUPLICATE_MAP_PATH) -> typing.Dict[str, str]:
+    with open(duplicate_map_path, 'r') as f:
+        return json.load(f)["duplicates"]
+
+
+def write_duplicate_map(
+    data_path: str = DEFAULT_TEXT_DATA_PATH,
+    duplicate_map_path: str = DEFAULT_DUPLICATE_MAP_PATH,
+    threshold: float = DEFAULT_THRESHOLD,
+    partition_by: typing.Sequence[str] = DEFAULT_PARTITION_BY,
+) -> typing.Dict[str, str]:
+    with open(data_path, 'r') as f:
+        all_nodes = [json.loads(line) for line in f]
+    # only the nodes that would be embedded
+    nodes = [node for node in all_nodes if utils.is_informative(node)]
+    partition_keys = None
+    if partition_by:
+        fields_by_key = node_filter_fields(all_nodes)
+        partition_keys = [
+            tuple(fields_by_key[utils.tuple_to_composite_key(node["id"])].get(field) for field in partition_by)
+            for node in nodes
+        ]
+
+    duplicate_map = find_duplicates(nodes, threshold, partition_keys)
+    with open(duplicate_map_path, 'w') as f:
+        json.dump(
+            {
+                "threshold": threshold,
+                "partition_by": list(partition_by),
+                "nodes": len(nodes),
+                "duplicates": duplicate_map,
+            },
+            f,
+        )
+    return duplicate_map
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find near-duplicate nodes, so only one of each gets embedded.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file.')
+    parser.add_argument('--duplicate_map_path', default=DEFAULT_DUPLICATE_MAP_PATH, help='Where to write the duplicate -> representative map.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Minimum estimated Jaccard similarity of duplicates.')
+    parser.add_argument('--partition_by', nargs='*', default=DEFAULT_PARTITION_BY, help='Only cluster nodes that share these filter fields; none to cluster across the whole corpus.')
+    args = parser.parse_args()
+
+    duplicate_map = write_duplicate_map(args.data_path, args.duplicate_map_path, args.threshold, args.partition_by)
+    groups = duplicate_groups(duplicate_map)
+    print(f"Duplicates: {len(duplicate_map)} nodes in {len(groups)} clusters -> {args.duplicate_map_path}")
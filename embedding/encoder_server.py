@@ -0,0 +1,196 @@
+"""Shared, micro-batching query encoder.
+
+Under concurrent chat traffic every request used to run its own tiny
+`model.encode` call, so the CPU spent most of its time on per-call overhead.
+`MicroBatchingEncoder` runs one worker thread per model. The worker collects
+the texts that arrive within a short window (max_wait_ms, or until
+max_batch_size texts are waiting), encodes them in one forward pass and
+resolves each caller's future.
+
+At low concurrency a request waits at most max_wait_ms before its batch runs;
+at high concurrency many requests share one forward pass.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage (benchmark direct vs micro-batched encoding):
+poetry run python embedding/encoder_server.py --concurrency 32 --num_requests 512
+"""
+
+import argparse
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+import typing
+
+from sentence_transformers import SentenceTransformer
+
+
+DEFAULT_EMBEDDING_MODEL_PATH = "embedding/models/chapter_1_embedder"
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 5.0
+
+_STOP = object()
+
+
+def configure_torch_threads(num_threads: typing.Optional[int] = None):
+    """Use num_threads intra-op threads (default: all cores) and a single
+    inter-op thread. One batched forward pass at a time keeps all cores busy,
+    so extra inter-op threads only add contention."""
+    import torch
+
+    torch.set_num_threads(num_threads or os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work has started
+        pass
+
+
+class MicroBatchingEncoder:
+    def __init__(
+        self,
+        model: SentenceTransformer,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.batch_count = 0
+        self.item_count = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="query-encoder", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> concurrent.futures.Future:
+        """Queue one (already preprocessed) text; the future resolves to its
+        embedding as a list of floats."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((text, future))
+        return future
+
+    def encode(self, texts: typing.List[str]) -> typing.List[typing.List[float]]:
+        """Blocking convenience wrapper around submit()."""
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _collect_batch(self, first_item):
+        batch = [first_item]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # finish this batch, then stop
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = self._collect_batch(item)
+            # drop requests whose caller already gave up
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                embeddings = self.model.encode(
+                    [text for text, _ in batch],
+                    batch_size=len(batch),
+                    show_progress_bar=False,
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batch_count += 1
+            self.item_count += len(batch)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding.tolist())
+
+
+_shared_models: typing.Dict[str, SentenceTransformer] = {}
+_shared_encoders: typing.Dict[str, MicroBatchingEncoder] = {}
+_shared_encoders_lock = threading.Lock()
+
+
+def load_shared_model(
+    embedding_model_path: str = DEFAULT_EMBEDDING_MODEL_PATH,
+    num_threads: typing.Optional[int] = None,
+) -> SentenceTransformer:
+    """Load the model weights once per process. Safe to call before forking
+    workers (no threads, no forward pass), so they share the pages."""
+    with _shared_encoders_lock:
+        if embedding_model_path not in _shared_models:
+            configure_torch_threads(num_threads)
+            _shared_models[embedding_model_path] = SentenceTransformer(embedding_model_path, device="cpu")
+        return _shared_models[embedding_model_path]
+
+
+def get_shared_encoder(
+    embedding_model_path: str = DEFAULT_EMBEDDING_MODEL_PATH,
+    num_threads: typing.Optional[int] = None,
+    **kwargs,
+) -> MicroBatchingEncoder:
+    """One encoder (model + worker thread) per model path per process."""
+    model = load_shared_model(embedding_model_path, num_threads)
+    with _shared_encoders_lock:
+        if embedding_model_path not in _shared_encoders:
+            _shared_encoders[embedding_model_path] = MicroBatchingEncoder(model, **kwargs)
+        return _shared_encoders[embedding_model_path]
+
+
+def _reset_after_fork():
+    # worker threads don't survive a fork, and a lock held by one of them would
+    # stay locked forever: keep the (shared) weights, rebuild the rest
+    global _shared_encoders_lock
+    _shared_encoders_lock = threading.Lock()
+    _shared_encoders.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark direct vs micro-batched query encoding.')
+    parser.add_argument('--embedding_model_path', default=DEFAULT_EMBEDDING_MODEL_PATH, help='Path to embedding model.')
+    parser.add_argument('--concurrency', type=int, default=32, help='Number of concurrent callers.')
+    parser.add_argument('--num_requests', type=int, default=512, help='Total number of queries to encode.')
+    parser.add_argument('--max_batch_size', type=int, default=DEFAULT_MAX_BATCH_SIZE, help='Max texts per forward pass.')
+    parser.add_argument('--max_wait_ms', type=float, default=DEFAULT_MAX_WAIT_MS, help='Max time to wait for a batch to fill.')
+    args = parser.parse_args()
+
+    encoder = get_shared_encoder(
+        args.embedding_model_path,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    texts = [f"fire sprinklers in hospital hallways {i}" for i in range(args.num_requests)]
+
+    def _bench(encode_one):
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(encode_one, texts))
+        return args.num_requests / (time.perf_counter() - start)
+
+    direct = _bench(lambda text: encoder.model.encode([text], show_progress_bar=False))
+    batched = _bench(lambda text: encoder.submit(text).result())
+    print(f"direct: {direct:.1f} queries/s")
+    print(f"micro-batched: {batched:.1f} queries/s "
+          f"(avg batch size {encoder.item_count / max(encoder.batch_count, 1):.1f})")
+    encoder.close()
@@ -0,0 +1,181 @@
+"""Metadata pre-filtering by book, chapter, article and node level.
+
+Every node gets a few small filterable fields, derived once from its composite
+id and its lineage:
+
+- level: the N in "level_N"
+- chapter: number of the "CHAPTER N" ancestor
+- article: number of the "ARTICLE N" ancestor
+- book: which code book the node comes from
+
+`FilterIndex` keeps one sorted posting list (row ids) per field value, so a
+filter like "level >= 3 in chapters 7-10" becomes a union of a few posting
+lists per field and an AND across fields, and only the surviving rows are
+scored. Filters use the pinecone metadata filter syntax, so the same filter
+can be sent to the hosted index (where the fields are stored as metadata).
+
+Example usage:
+    flt = build_filter(min_level=3, chapters=range(7, 11))
+    index.query(vector=vector, top_k=5, filter=flt)
+"""
+
+import re
+import typing
+
+import numpy as np
+
+from corpus_store import CorpusStore, NO_ROW, pack_composite_key, unpack_node_id
+
+
+FILTER_FIELDS = ("level", "chapter", "article", "book")
+
+CHAPTER_LEVEL = 1
+ARTICLE_LEVEL = 2
+
+
+def node_level(composite_key: str) -> int:
+    return unpack_node_id(pack_composite_key(composite_key))[0]
+
+
+def _heading_number(title: str) -> typing.Optional[int]:
+    # "CHAPTER 13" -> 13, "ARTICLE 4" -> 4
+    match = re.search(r"\d+", title)
+    return int(match.group()) if match else None
+
+
+def node_filter_fields(
+    nodes: typing.Union[CorpusStore, typing.Iterable[typing.Dict[str, typing.Any]]],
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """Composite key -> filter fields for every node. Fields that don't apply
+    (e.g. article of a chapter node) are left out rather than set to None,
+    since pinecone metadata can't hold nulls."""
+    store = nodes if isinstance(nodes, CorpusStore) else CorpusStore.from_nodes(nodes)
+
+    fields_by_key = {}
+    for row in range(len(store)):
+        fields = {"level": int(store.levels[row]), "book": store.books[store.book_rows[row]]}
+        ancestor_row = row
+        while ancestor_row != NO_ROW:
+            ancestor_level = int(store.levels[ancestor_row])
+            if ancestor_level == CHAPTER_LEVEL:
+                fields["chapter"] = _heading_number(store.title(ancestor_row))
+            elif ancestor_level == ARTICLE_LEVEL:
+                fields["article"] = _heading_number(store.title(ancestor_row))
+            if ancestor_level <= CHAPTER_LEVEL:
+                break
+            ancestor_row = int(store.parent_rows[ancestor_row])
+        fields_by_key[store.key(row)] = {name: value for name, value in fields.items() if value is not None}
+    return fields_by_key
+
+
+def build_filter(
+    min_level: typing.Optional[int] = None,
+    max_level: typing.Optional[int] = None,
+    chapters: typing.Optional[typing.Iterable[int]] = None,
+    articles: typing.Optional[typing.Iterable[int]] = None,
+    books: typing.Optional[typing.Iterable[str]] = None,
+) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Build a pinecone-style filter; returns None if nothing is restricted."""
+    flt: typing.Dict[str, typing.Any] = {}
+    level = {}
+    if min_level is not None:
+        level["$gte"] = min_level
+    if max_level is not None:
+        level["$lte"] = max_level
+    if level:
+        flt["level"] = level
+    if chapters is not None:
+        flt["chapter"] = {"$in": list(chapters)}
+    if articles is not None:
+        flt["article"] = {"$in": list(articles)}
+    if books is not None:
+        flt["book"] = {"$in": list(books)}
+    return flt or None
+
+
+def parse_int_ranges(spec: str) -> typing.List[int]:
+    """"7-10,12" -> [7, 8, 9, 10, 12]"""
+    values = []
+    for part in spec.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-")
+            values.extend(range(int(start), int(end) + 1))
+        elif part:
+            values.append(int(part))
+    return values
+
+
+_COMPARISONS = {
+    "$gt": lambda value, target: value > target,
+    "$gte": lambda value, target: value >= target,
+    "$lt": lambda value, target: value < target,
+    "$lte": lambda value, target: value <= target,
+}
+
+
+class FilterIndex:
+    """Posting lists per (field, value) over rows 0..n-1.
+
+    rows[i] holds the filter fields of row i of whatever we are filtering
+    (a vector index namespace, the BM25 documents, ...)."""
+
+    def __init__(self, rows: typing.List[typing.Dict[str, typing.Any]]):
+        self.n_rows = len(rows)
+        postings: typing.Dict[str, typing.Dict[typing.Any, typing.List[int]]] = {}
+        for row, fields in enumerate(rows):
+            for name, value in fields.items():
+                if name in FILTER_FIELDS:
+                    postings.setdefault(name, {}).setdefault(value, []).append(row)
+        self.postings = {
+            name: {value: np.asarray(rows, dtype=np.int32) for value, rows in values.items()}
+            for name, values in postings.items()
+        }
+
+    def _field_mask(self, name: str, condition) -> np.ndarray:
+        values = self.postings.get(name, {})
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+
+        # rows without the field never match, same as pinecone
+        selected = set(values)
+        for op, target in condition.items():
+            if op == "$eq":
+                selected &= {target}
+            elif op == "$in":
+                selected &= set(target)
+            elif op == "$ne":
+                selected -= {target}
+            elif op == "$nin":
+                selected -= set(target)
+            elif op in _COMPARISONS:
+                selected = {value for value in selected if _COMPARISONS[op](value, target)}
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+
+        mask = np.zeros(self.n_rows, dtype=bool)
+        for value in selected:
+            mask[values[value]] = True
+        return mask
+
+    def mask(self, flt: typing.Optional[typing.Dict[str, typing.Any]]) -> np.ndarray:
+        """Boolean mask of the rows matching a pinecone-style filter."""
+        mask = np.ones(self.n_rows, dtype=bool)
+        if not flt:
+            return mask
+        for name, condition in flt.items():
+            if name == "$and":
+                for sub_filter in condition:
+                    mask &= self.mask(sub_filter)
+            elif name == "$or":
+                any_mask = np.zeros(self.n_rows, dtype=bool)
+                for sub_filter in condition:
+                    any_mask |= self.mask(sub_filter)
+                mask &= any_mask
+            else:
+                mask &= self._field_mask(name, condition)
+        return mask
+
+    def candidates(self, flt: typing.Optional[typing.Dict[str, typing.Any]]) -> np.ndarray:
+        """Row ids matching the filter, in ascending order."""
+        return np.flatnonzero(self.mask(flt))
@@ -0,0 +1,345 @@
+"""Coarse-to-fine vector index over the node tree.
+
+A flat index scores every node of every book for every query. The nodes
+aren't independent though: most of them are clauses of one section, and a
+query that is far from a section is far from its clauses too.
+`HierarchicalIndex` searches in two stages, behind the same query interface
+as `LocalIndex`:
+
+- each node is grouped under its section (its nearest ancestor, or itself,
+  at section_level or above; chapters and articles are their own groups),
+  and each group gets a centroid: the normalized mean of its members'
+  normalized vectors, i.e. of the section's whole subtree
+- a query first scores the centroids, then only the members of the
+  probe_sections best sections (more if those don't hold top_k members)
+
+So a query scores #sections + a few hundred members instead of every node,
+and adding a book mostly adds sections. Like any such pruning it is
+approximate: a clause that is far from the rest of its section can be
+missed. Use --evaluate to check the recall against an exact search for a
+given probe_sections.
+
+Members are stored grouped by section (CSR offsets), so a probed section is
+one contiguous slice of the member matrix. Metadata filters are applied to
+the members with the same posting lists as LocalIndex, and sections without
+a matching member aren't probed. Scores are cosine similarities, the same
+as our hosted index.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python embedding/hierarchical_index.py --embedding_path embedding/embeddings.json
+
+Compare against an exact search:
+poetry run python embedding/hierarchical_index.py --embedding_path embedding/embeddings.json --evaluate 200
+"""
+
+import argparse
+import json
+import os
+import threading
+import typing
+
+import numpy as np
+
+from corpus_store import CorpusStore, NO_ROW, DEFAULT_CORPUS_STORE_PATH, DEFAULT_TEXT_DATA_PATH
+from filter_index import FilterIndex, FILTER_FIELDS
+
+
+DEFAULT_HIERARCHICAL_INDEX_PATH = "embedding/hierarchical_index.npz"
+INDEX_KIND = "hierarchical"
+# level_3 nodes are the numbered sections ("4-316. Designation of
+# responsibilities."), level_1 and level_2 the chapters and articles
+DEFAULT_SECTION_LEVEL = 3
+DEFAULT_PROBE_SECTIONS = 16
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+def section_key(store: CorpusStore, key: str, section_level: int = DEFAULT_SECTION_LEVEL) -> str:
+    """Composite key of the section a node is grouped under: its nearest
+    ancestor-or-self at section_level or above. Nodes that aren't in the
+    corpus are their own section."""
+    row = store.row_of(key)
+    if row == NO_ROW or store.levels[row] <= section_level:
+        return key
+    for ancestor_row in store.ancestor_rows(row):
+        if store.levels[ancestor_row] <= section_level:
+            return store.key(ancestor_row)
+    return key
+
+
+class HierarchicalIndex:
+    """Section centroids over section-grouped member vectors. Read-only once
+    built: rebuild (or reload) it to change the vectors."""
+
+    def __init__(
+        self,
+        ids: typing.List[str],
+        vectors: np.ndarray,
+        metadata: typing.List[typing.Dict[str, typing.Any]],
+        section_keys: typing.List[str],
+        section_offsets: np.ndarray,
+        section_level: int = DEFAULT_SECTION_LEVEL,
+        probe_sections: int = DEFAULT_PROBE_SECTIONS,
+    ):
+        # members of section s are rows section_offsets[s]:section_offsets[s + 1]
+        self.ids = ids
+        self.vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        self.metadata = metadata
+        self.section_keys = section_keys
+        self.section_offsets = np.asarray(section_offsets, dtype=np.int64)
+        self.section_level = section_level
+        self.probe_sections = probe_sections
+
+        if len(self.ids):
+            self.centroids = _normalize(np.add.reduceat(self.vectors, self.section_offsets[:-1], axis=0))
+        else:
+            self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.id_to_row = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        self._filter_index = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_vectors(
+        cls,
+        vectors: typing.Iterable[typing.Dict[str, typing.Any]],
+        store: CorpusStore,
+        section_level: int = DEFAULT_SECTION_LEVEL,
+        probe_sections: int = DEFAULT_PROBE_SECTIONS,
+    ) -> "HierarchicalIndex":
+        """Group {"id", "values", "metadata"} vectors (as in embeddings.json)
+        by section, using the corpus tree."""
+        by_section: typing.Dict[str, typing.List[typing.Dict[str, typing.Any]]] = {}
+        for vector in vectors:
+            by_section.setdefault(section_key(store, vector["id"], section_level), []).append(vector)
+
+        ids, values, metadata, section_keys, section_offsets = [], [], [], [], [0]
+        for key, members in by_section.items():
+            section_keys.append(key)
+            for vector in members:
+                ids.append(vector["id"])
+                values.append(vector["values"])
+                # only the filterable fields, the same as the hosted upload
+                metadata.append({name: value for name, value in vector.get("metadata", {}).items() if name in FILTER_FIELDS})
+            section_offsets.append(len(ids))
+        return cls(
+            ids,
+            np.asarray(values, dtype=np.float32),
+            metadata,
+            section_keys,
+            np.asarray(section_offsets),
+            section_level=section_level,
+            probe_sections=probe_sections,
+        )
+
+    @classmethod
+    def from_embeddings_file(cls, embedding_path: str, store: CorpusStore, **kwargs) -> "HierarchicalIndex":
+        with open(embedding_path, 'r') as f:
+            embeddings = json.load(f)
+        return cls.from_vectors(embeddings["vectors"], store, **kwargs)
+
+    def filter_index(self) -> FilterIndex:
+        with self._lock:
+            if self._filter_index is None:
+                self._filter_index = FilterIndex(self.metadata)
+            return self._filter_index
+
+    def _probe(
+        self,
+        section_scores: np.ndarray,
+        top_k: int,
+        probe_sections: int,
+        member_mask: typing.Optional[np.ndarray],
+    ) -> np.ndarray:
+        """Sections to search, best first: probe_sections of them, or as many
+        as it takes to hold top_k (matching) members."""
+        sizes = np.diff(self.section_offsets)
+        if member_mask is not None:
+            sizes = np.add.reduceat(member_mask.astype(np.int64), self.section_offsets[:-1])
+        n_sections = int(np.count_nonzero(sizes))
+        probe = min(max(int(probe_sections), 1), n_sections)
+        if probe == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        section_scores = np.where(sizes > 0, section_scores, -np.inf)
+        top = np.argpartition(-section_scores, probe - 1)[:probe]
+        if sizes[top].sum() < top_k and probe < n_sections:
+            # rare (few, small sections): fall back to ranking them all
+            order = np.argsort(-section_scores)[:n_sections]
+            needed = int(np.searchsorted(np.cumsum(sizes[order]), top_k)) + 1
+            return order[:max(probe, min(needed, n_sections))]
+        return top[np.argsort(-section_scores[top])]
+
+    def query(
+        self,
+        vector: typing.List[float],
+        top_k: int = 10,
+        namespace: typing.Optional[str] = None,
+        include_metadata: bool = False,
+        include_values: bool = False,
+        filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        probe_sections: typing.Optional[int] = None,
+        **kwargs,
+    ) -> typing.Dict[str, typing.Any]:
+        """Top_k members of the best sections. The result also lists the
+        probed sections, best first. namespace is ignored."""
+        if not len(self.ids):
+            return {"matches": [], "namespace": namespace or "", "sections": []}
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        member_mask = self.filter_index().mask(filter) if filter else None
+
+        sections = self._probe(
+            self.centroids @ query,
+            int(top_k),
+            probe_sections if probe_sections is not None else self.probe_sections,
+            member_mask,
+        )
+        if len(sections):
+            rows = np.concatenate(
+                [np.arange(self.section_offsets[s], self.section_offsets[s + 1]) for s in sections]
+            )
+        else:
+            rows = np.zeros(0, dtype=np.int64)
+        if member_mask is not None:
+            rows = rows[member_mask[rows]]
+        result = {
+            "matches": [],
+            "namespace": namespace or "",
+            "sections": [self.section_keys[s] for s in sections],
+        }
+        if not len(rows):
+            return result
+
+        scores = self.vectors[rows] @ query
+        top_k = min(int(top_k), len(rows))
+        # argpartition first so we only sort top_k scores
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        for i in top:
+            row = int(rows[i])
+            match = {
+                "id": self.ids[row],
+                "score": float(scores[i]),
+                "values": self.vectors[row].tolist() if include_values else [],
+            }
+            if include_metadata:
+                match["metadata"] = self.metadata[row]
+            result["matches"].append(match)
+        return result
+
+    def fetch(self, ids: typing.List[str], namespace: typing.Optional[str] = None):
+        vectors = {
+            vector_id: {
+                "id": vector_id,
+                "values": self.vectors[self.id_to_row[vector_id]].tolist(),
+                "metadata": self.metadata[self.id_to_row[vector_id]],
+            }
+            for vector_id in ids if vector_id in self.id_to_row
+        }
+        return {"vectors": vectors, "namespace": namespace or ""}
+
+    def describe_index_stats(self):
+        return {
+            "namespaces": {"": {"vector_count": len(self.ids)}},
+            "total_vector_count": len(self.ids),
+            "section_count": len(self.section_keys),
+        }
+
+    def save(self, path: str = DEFAULT_HIERARCHICAL_INDEX_PATH):
+        """Save as one .npz: a json manifest (kind, ids, metadata, sections)
+        plus the member vectors and section offsets. Centroids are
+        recomputed on load."""
+        manifest = {
+            "kind": INDEX_KIND,
+            "ids": self.ids,
+            "metadata": self.metadata,
+            "section_keys": self.section_keys,
+            "section_level": self.section_level,
+            "probe_sections": self.probe_sections,
+        }
+        np.savez(
+            path,
+            manifest=np.array(json.dumps(manifest)),
+            vectors=self.vectors,
+            section_offsets=self.section_offsets,
+        )
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_HIERARCHICAL_INDEX_PATH, probe_sections: typing.Optional[int] = None) -> "HierarchicalIndex":
+        with np.load(path, allow_pickle=False) as npz:
+            manifest = json.loads(str(npz["manifest"]))
+            return cls(
+                manifest["ids"],
+                npz["vectors"],
+                manifest["metadata"],
+                manifest["section_keys"],
+                npz["section_offsets"],
+                section_level=manifest["section_level"],
+                probe_sections=probe_sections if probe_sections is not None else manifest["probe_sections"],
+            )
+
+
+def is_hierarchical_index_file(path: str) -> bool:
+    with np.load(path, allow_pickle=False) as npz:
+        return json.loads(str(npz["manifest"])).get("kind") == INDEX_KIND
+
+
+def evaluate(
+    index: HierarchicalIndex,
+    n_queries: int = 200,
+    top_k: int = 10,
+    noise: float = 0.5,
+    seed: int = 0,
+) -> typing.Dict[str, float]:
+    """Recall@top_k against an exact search over all members, and the share
+    of vectors scored per query, for queries made from stored vectors plus
+    gaussian noise (noise * the per-dimension spread of the vectors)."""
+    rng = np.random.RandomState(seed)
+    rows = rng.choice(len(index.ids), size=min(n_queries, len(index.ids)), replace=False)
+    spread = index.vectors.std(axis=0)
+    section_sizes = dict(zip(index.section_keys, np.diff(index.section_offsets)))
+    recalls, scored = [], []
+    for row in rows:
+        query = index.vectors[row] + rng.normal(size=index.vectors.shape[1]) * spread * noise
+        exact = np.argsort(-(index.vectors @ _normalize(query)))[:top_k]
+        result = index.query(query, top_k=top_k)
+        found = {match["id"] for match in result["matches"]}
+        recalls.append(np.mean([index.ids[i] in found for i in exact]))
+        probed = sum(section_sizes[key] for key in result["sections"])
+        scored.append((len(index.section_keys) + probed) / len(index.ids))
+    return {"recall": float(np.mean(recalls)), "scored_fraction": float(np.mean(scored))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the section-grouped (coarse-to-fine) vector index.')
+    parser.add_argument('--embedding_path', default="embedding/embeddings.json", help='Path to embedding json file.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file (for the node tree).')
+    parser.add_argument('--corpus_store_path', default=DEFAULT_CORPUS_STORE_PATH, help='Compact corpus store, used instead of the jsonl if it exists.')
+    parser.add_argument('--index_path', default=DEFAULT_HIERARCHICAL_INDEX_PATH, help='Where to write the index.')
+    parser.add_argument('--section_level', type=int, default=DEFAULT_SECTION_LEVEL, help='Nodes are grouped under their ancestor at this level.')
+    parser.add_argument('--probe_sections', type=int, default=DEFAULT_PROBE_SECTIONS, help='Sections searched per query.')
+    parser.add_argument('--evaluate', type=int, default=0, help='Report recall against an exact search over this many sample queries.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.corpus_store_path):
+        store = CorpusStore.load(args.corpus_store_path)
+    else:
+        store = CorpusStore.from_jsonl(args.data_path)
+    index = HierarchicalIndex.from_embeddings_file(
+        args.embedding_path, store, section_level=args.section_level, probe_sections=args.probe_sections
+    )
+    # written next to the old file and renamed over it, so a loading server
+    # never reads half an index
+    tmp_path = args.index_path[:-len(".npz")] + ".tmp.npz"
+    index.save(tmp_path)
+    os.replace(tmp_path, args.index_path)
+    print(f"Hierarchical index: {len(index.ids)} vectors in {len(index.section_keys)} sections -> {args.index_path}")
+
+    if args.evaluate:
+        report = evaluate(index, n_queries=args.evaluate)
+        print(f"Recall@10: {report['recall']:.3f}, vectors scored per query: {report['scored_fraction']:.1%}")
@@ -0,0 +1,460 @@
+"""Immutable, versioned snapshots of the search artifacts.
+
+Rebuilding the corpus store, the BM25 index or the vector index in place
+while the app is serving means a request can read a new corpus with an old
+index, or half a file. Instead, every build is frozen into a snapshot
+directory that never changes once written:
+
+    <snapshot_dir>/<version>/manifest.json      version, previous version,
+                                                and each artifact's size and
+                                                sha256
+    <snapshot_dir>/<version>/corpus.npz         CorpusStore
+    <snapshot_dir>/<version>/lineage.json       lineage table
+    <snapshot_dir>/<version>/bm25_index.npz     lexical index
+    <snapshot_dir>/<version>/duplicates.json    near-duplicate map (optional)
+    <snapshot_dir>/<version>/vector_index.npz   LocalIndex or HierarchicalIndex
+    <snapshot_dir>/CURRENT                      the version to serve
+
+A snapshot is written to a temporary directory and renamed into place, and
+CURRENT is replaced atomically, so readers only ever see complete versions.
+Rolling back points CURRENT at the previous version again. The vector index
+is part of every snapshot: the hosted index is updated in place, so its
+vectors couldn't be versioned (or rolled back) with the corpus.
+
+In the server, `SnapshotManager` watches CURRENT: a new version is loaded
+(and its checksums verified) in the background while the old one keeps
+serving, then swapped in with one reference assignment. Requests take the
+current snapshot once and use it throughout, so in-flight requests finish on
+the version they started with. The previous version stays loaded for an
+instant rollback.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage (snapshot the current build artifacts and serve them):
+poetry run python embedding/index_snapshot.py --create --vector_index_path embedding/hierarchical_index.npz
+
+List versions, roll back, or serve a given version:
+poetry run python embedding/index_snapshot.py
+poetry run python embedding/index_snapshot.py --rollback
+poetry run python embedding/index_snapshot.py --activate 20261019T120000-1a2b3c4d
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+import typing
+import weakref
+
+import bm25
+import dedup
+import lineage_table
+import utils
+from corpus_store import CorpusStore, DEFAULT_CORPUS_STORE_PATH, DEFAULT_TEXT_DATA_PATH
+from filter_index import node_filter_fields
+from sharded_index import load_index_file
+
+
+DEFAULT_SNAPSHOT_DIR = "embedding/snapshots"
+DEFAULT_POLL_INTERVAL_SECONDS = 10.0
+DEFAULT_KEEP_VERSIONS = 5
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+
+# artifact name -> file name in the snapshot
+ARTIFACT_FILES = {
+    "corpus": "corpus.npz",
+    "lineage": "lineage.json",
+    "lexical_index": "bm25_index.npz",
+    "duplicates": "duplicates.json",
+    "vector_index": "vector_index.npz",
+}
+# where the build scripts write them
+DEFAULT_SOURCES = {
+    "corpus": DEFAULT_CORPUS_STORE_PATH,
+    "lineage": lineage_table.DEFAULT_LINEAGE_TABLE_PATH,
+    "lexical_index": bm25.DEFAULT_LEXICAL_INDEX_PATH,
+    "duplicates": dedup.DEFAULT_DUPLICATE_MAP_PATH,
+}
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomic(path: str, content: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def snapshot_path(snapshot_dir: str, version: str) -> str:
+    return os.path.join(snapshot_dir, version)
+
+
+def read_manifest(path: str) -> typing.Dict[str, typing.Any]:
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def current_version(snapshot_dir: str = DEFAULT_SNAPSHOT_DIR) -> typing.Optional[str]:
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE), 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_current(snapshot_dir: str, version: str):
+    """Serve version from now on (atomically replaces CURRENT)."""
+    if not os.path.exists(os.path.join(snapshot_path(snapshot_dir, version), MANIFEST_FILE)):
+        raise ValueError(f"no snapshot {version} in {snapshot_dir}")
+    _write_atomic(os.path.join(snapshot_dir, CURRENT_FILE), version + "\n")
+
+
+def list_versions(snapshot_dir: str = DEFAULT_SNAPSHOT_DIR) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Manifests of every complete snapshot, oldest first."""
+    if not os.path.isdir(snapshot_dir):
+        return []
+    manifests = []
+    for name in os.listdir(snapshot_dir):
+        if os.path.exists(os.path.join(snapshot_dir, name, MANIFEST_FILE)):
+            manifests.append(read_manifest(os.path.join(snapshot_dir, name)))
+    return sorted(manifests, key=lambda manifest: manifest["created_at"])
+
+
+def create_snapshot(
+    snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+    sources: typing.Optional[typing.Dict[str, str]] = None,
+    data_path: str = DEFAULT_TEXT_DATA_PATH,
+    activate: bool = True,
+) -> str:
+    """Freeze the build artifacts at sources (artifact name -> path, see
+    ARTIFACT_FILES) into a new version. The corpus store, lineage table and
+    BM25 index are built from data_path if their source is missing; the
+    duplicate map is optional; the vector index is required. Returns the
+    version."""
+    sources = dict(DEFAULT_SOURCES if sources is None else sources)
+    if not sources.get("vector_index") or not os.path.exists(sources["vector_index"]):
+        raise ValueError(
+            "a snapshot needs its vector index (a LocalIndex or HierarchicalIndex .npz): "
+            "the hosted index isn't versioned with the corpus"
+        )
+    os.makedirs(snapshot_dir, exist_ok=True)
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    tmp_path = os.path.join(snapshot_dir, f".build-{os.getpid()}-{created_at.strftime('%Y%m%dT%H%M%S%f')}")
+    os.makedirs(tmp_path)
+    try:
+        for name, source in sources.items():
+            if source and os.path.exists(source):
+                shutil.copyfile(source, os.path.join(tmp_path, ARTIFACT_FILES[name]))
+
+        def _artifact(name):
+            path = os.path.join(tmp_path, ARTIFACT_FILES[name])
+            return path if os.path.exists(path) else None
+
+        if _artifact("corpus"):
+            store = CorpusStore.load(_artifact("corpus"))
+        else:
+            store = CorpusStore.from_jsonl(data_path)
+            store.save(os.path.join(tmp_path, ARTIFACT_FILES["corpus"]))
+        if not _artifact("lineage"):
+            with open(os.path.join(tmp_path, ARTIFACT_FILES["lineage"]), 'w') as f:
+                json.dump(lineage_table.build_lineage_table(store), f)
+        if not _artifact("lexical_index"):
+            duplicate_map = dedup.load_duplicate_map(_artifact("duplicates")) if _artifact("duplicates") else {}
+            bm25.BM25Index.from_nodes(
+                [node for node in store if utils.is_informative(node) and node.key not in duplicate_map],
+                filter_fields_by_key=node_filter_fields(store),
+            ).save(os.path.join(tmp_path, ARTIFACT_FILES["lexical_index"]))
+
+        artifacts = {}
+        for name, file_name in ARTIFACT_FILES.items():
+            path = os.path.join(tmp_path, file_name)
+            if os.path.exists(path):
+                artifacts[name] = {
+                    "file": file_name,
+                    "bytes": os.path.getsize(path),
+                    "sha256": _sha256(path),
+                    "source": sources.get(name),
+                }
+        # content-addressed suffix, so two builds of the same artifacts are
+        # recognizably the same
+        digest = hashlib.sha256("".join(artifacts[name]["sha256"] for name in sorted(artifacts)).encode()).hexdigest()
+        version = f"{created_at.strftime('%Y%m%dT%H%M%S')}-{digest[:8]}"
+        manifest = {
+            "version": version,
+            "created_at": created_at.isoformat(),
+            "previous": current_version(snapshot_dir),
+            "artifacts": artifacts,
+        }
+        with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        for file_name in os.listdir(tmp_path):
+            os.chmod(os.path.join(tmp_path, file_name), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+        final_path = snapshot_path(snapshot_dir, version)
+        if os.path.exists(final_path):
+            raise ValueError(f"snapshot {version} already exists")
+        os.rename(tmp_path, final_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    if activate:
+        set_current(snapshot_dir, version)
+    return version
+
+
+def verify_snapshot(path: str) -> typing.Dict[str, typing.Any]:
+    """Check every artifact's size and checksum against the manifest; raises
+    ValueError on a mismatch. Returns the manifest."""
+    manifest = read_manifest(path)
+    for name, artifact in manifest["artifacts"].items():
+        artifact_path = os.path.join(path, artifact["file"])
+        if not os.path.exists(artifact_path) or os.path.getsize(artifact_path) != artifact["bytes"]:
+            raise ValueError(f"snapshot {manifest['version']}: {name} is missing or truncated")
+        if _sha256(artifact_path) != artifact["sha256"]:
+            raise ValueError(f"snapshot {manifest['version']}: {name} checksum mismatch")
+    return manifest
+
+
+def rollback(snapshot_dir: str = DEFAULT_SNAPSHOT_DIR) -> str:
+    """Serve the version that was current before the current one. Returns it."""
+    version = current_version(snapshot_dir)
+    if version is None:
+        raise ValueError(f"no current snapshot in {snapshot_dir}")
+    previous = read_manifest(snapshot_path(snapshot_dir, version)).get("previous")
+    if previous is None:
+        raise ValueError(f"snapshot {version} has no previous version")
+    set_current(snapshot_dir, previous)
+    return previous
+
+
+def prune(snapshot_dir: str = DEFAULT_SNAPSHOT_DIR, keep: int = DEFAULT_KEEP_VERSIONS) -> typing.List[str]:
+    """Delete all but the newest `keep` versions; never the current one or
+    its previous version. Returns the deleted versions."""
+    current = current_version(snapshot_dir)
+    protected = {current}
+    if current is not None:
+        protected.add(read_manifest(snapshot_path(snapshot_dir, current)).get("previous"))
+    versions = [manifest["version"] for manifest in list_versions(snapshot_dir)]
+    deleted = []
+    for version in versions[:max(len(versions) - keep, 0)]:
+        if version not in protected:
+            path = snapshot_path(snapshot_dir, version)
+            # the artifacts are read-only; their directory isn't
+            shutil.rmtree(path)
+            deleted.append(version)
+    return deleted
+
+
+class IndexSnapshot:
+    """One loaded version: everything a search reads, from the same build."""
+
+    def __init__(self, path: str, verify: bool = True):
+        self.path = path
+        self.manifest = verify_snapshot(path) if verify else read_manifest(path)
+        self.version = self.manifest["version"]
+        artifacts = self.manifest["artifacts"]
+
+        def _path(name):
+            return os.path.join(path, artifacts[name]["file"]) if name in artifacts else None
+
+        self.corpus = CorpusStore.load(_path("corpus"))
+        self.lineage = lineage_table.load_lineage_table(_path("lineage"))
+        self.lexical_index = bm25.BM25Index.load(_path("lexical_index"))
+        duplicate_map = dedup.load_duplicate_map(_path("duplicates")) if _path("duplicates") else {}
+        self.duplicate_groups = dedup.duplicate_groups(duplicate_map)
+        if not _path("vector_index"):
+            raise ValueError(f"snapshot {self.version} has no vector index; create a new one with it")
+        self.vector_index = load_index_file(_path("vector_index"))
+        self.loaded_at = time.time()
+
+
+_managers: "weakref.WeakSet[SnapshotManager]" = weakref.WeakSet()
+
+
+class SnapshotManager:
+    """Serves the CURRENT snapshot of snapshot_dir and hot swaps to a new
+    version when CURRENT changes."""
+
+    def __init__(
+        self,
+        snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+        poll_interval_seconds: typing.Optional[float] = DEFAULT_POLL_INTERVAL_SECONDS,
+        loader: typing.Callable[[str], IndexSnapshot] = IndexSnapshot,
+    ):
+        self.snapshot_dir = snapshot_dir
+        self.poll_interval_seconds = poll_interval_seconds
+        self.loader = loader
+        self._current: typing.Optional[IndexSnapshot] = None
+        self._previous: typing.Optional[IndexSnapshot] = None
+        # a version that failed to load isn't retried until CURRENT changes
+        self._failed_version: typing.Optional[str] = None
+        self._lock = threading.Lock()
+        # one load at a time (watcher and explicit rollback)
+        self._update_lock = threading.Lock()
+        self._watcher = None
+        self._watcher_pid = None
+        _managers.add(self)
+
+    def _reset_after_fork(self):
+        # a lock held by another thread (e.g. the watcher, mid load) at fork
+        # time would never be released in the child
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._watcher = None
+        self._watcher_pid = None
+
+    def _load(self, version: str) -> IndexSnapshot:
+        start = time.perf_counter()
+        snapshot = self.loader(snapshot_path(self.snapshot_dir, version))
+        print(f"index snapshot {version}: loaded in {time.perf_counter() - start:.1f}s")
+        return snapshot
+
+    def _swap(self, snapshot: IndexSnapshot):
+        with self._lock:
+            if self._current is not None and self._current.version != snapshot.version:
+                self._previous = self._current
+            self._current = snapshot
+
+    def current(self) -> IndexSnapshot:
+        """The snapshot to serve this request from. The first call loads
+        CURRENT (blocking); later versions are loaded in the background."""
+        self._ensure_watcher()
+        snapshot = self._current
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._current is None:
+                version = current_version(self.snapshot_dir)
+                if version is None:
+                    raise ValueError(f"no current snapshot in {self.snapshot_dir}")
+                self._current = self._load(version)
+            return self._current
+
+    @property
+    def version(self) -> typing.Optional[str]:
+        snapshot = self._current
+        return snapshot.version if snapshot is not None else None
+
+    def check_for_update(self) -> bool:
+        """Load and swap in CURRENT if it is a different version than the one
+        served. A version that fails to load (or verify) is skipped and the
+        old one keeps serving. Returns whether it swapped."""
+        with self._update_lock:
+            version = current_version(self.snapshot_dir)
+            if version is None or version == self.version or version == self._failed_version:
+                return False
+            if self._previous is not None and self._previous.version == version:
+                # rolled back to the version we still hold
+                self._swap(self._previous)
+                print(f"index snapshot {version}: swapped back in")
+                return True
+            try:
+                snapshot = self._load(version)
+            except Exception as e:
+                self._failed_version = version
+                print(f"index snapshot {version}: load failed, keeping {self.version}: {e!r}")
+                return False
+            self._failed_version = None
+            self._swap(snapshot)
+            return True
+
+    def rollback(self) -> str:
+        """Serve the previous version again, here (instantly, if it is still
+        loaded) and in every other process watching snapshot_dir."""
+        version = rollback(self.snapshot_dir)
+        self.check_for_update()
+        return version
+
+    def _ensure_watcher(self):
+        # the watcher thread doesn't survive a fork: start one per process
+        if not self.poll_interval_seconds or self._watcher_pid == os.getpid():
+            return
+
+        def _run():
+            while True:
+                time.sleep(self.poll_interval_seconds)
+                try:
+                    self.check_for_update()
+                except Exception as e:
+                    print(f"index snapshot watcher: {e!r}")
+
+        with self._lock:
+            if self._watcher_pid != os.getpid():
+                self._watcher = threading.Thread(target=_run, name="index-snapshot-watcher", daemon=True)
+                self._watcher.start()
+                self._watcher_pid = os.getpid()
+
+
+def _reset_after_fork():
+    for manager in list(_managers):
+        manager._reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create, list, activate and roll back index snapshots.')
+    parser.add_argument('--snapshot_dir', default=DEFAULT_SNAPSHOT_DIR, help='Where the snapshots live.')
+    parser.add_argument('--create', action='store_true', help='Snapshot the current build artifacts and serve them.')
+    parser.add_argument('--no_activate', action='store_true', help='With --create: don\'t serve the new snapshot yet.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file, for artifacts that have to be built.')
+    parser.add_argument('--corpus_store_path', default=DEFAULT_SOURCES["corpus"], help='Compact corpus store to snapshot.')
+    parser.add_argument('--lineage_table_path', default=DEFAULT_SOURCES["lineage"], help='Lineage table to snapshot.')
+    parser.add_argument('--lexical_index_path', default=DEFAULT_SOURCES["lexical_index"], help='BM25 index to snapshot.')
+    parser.add_argument('--duplicate_map_path', default=DEFAULT_SOURCES["duplicates"], help='Near-duplicate map to snapshot.')
+    parser.add_argument('--vector_index_path', default=None, help='LocalIndex or HierarchicalIndex .npz to snapshot (required with --create).')
+    parser.add_argument('--activate', default=None, help='Serve this version.')
+    parser.add_argument('--rollback', action='store_true', help='Serve the previous version again.')
+    parser.add_argument('--prune', type=int, default=None, help='Delete all but this many of the newest versions.')
+    parser.add_argument('--verify', default=None, help='Check the checksums of this version.')
+    args = parser.parse_args()
+    if args.create and not args.vector_index_path:
+        parser.error("--create needs --vector_index_path: the hosted index isn't versioned with the corpus")
+
+    if args.create:
+        version = create_snapshot(
+            args.snapshot_dir,
+            sources={
+                "corpus": args.corpus_store_path,
+                "lineage": args.lineage_table_path,
+                "lexical_index": args.lexical_index_path,
+                "duplicates": args.duplicate_map_path,
+                "vector_index": args.vector_index_path,
+            },
+            data_path=args.data_path,
+            activate=not args.no_activate,
+        )
+        print(f"Created snapshot {version}")
+    if args.activate:
+        set_current(args.snapshot_dir, args.activate)
+    if args.rollback:
+        print(f"Rolled back to {rollback(args.snapshot_dir)}")
+    if args.verify:
+        verify_snapshot(snapshot_path(args.snapshot_dir, args.verify))
+        print(f"Snapshot {args.verify}: OK")
+    if args.prune is not None:
+        for version in prune(args.snapshot_dir, args.prune):
+            print(f"Deleted snapshot {version}")
+
+    current = current_version(args.snapshot_dir)
+    for manifest in list_versions(args.snapshot_dir):
+        marker = "*" if manifest["version"] == current else " "
+        names = ", ".join(sorted(manifest["artifacts"]))
+        print(f"{marker} {manifest['version']}  (previous: {manifest['previous']})  {names}")
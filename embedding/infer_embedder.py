@@ -3,6 +3,8 @@ query it on pinecone.
 
 Requirements:
 pinecone api key: set as environment variable PINECONE_API_KEY
+optionally, PINECONE_INDEX_HOST (e.g. "https://california-codes-abc123.svc.asia-southeast1-gcp-free.pinecone.io"
+or the stand-in server of load_test/mock_servers.py) to query the index's REST API directly
 
 Example usage: (use foo bar baz)
 poetry run python embedding/infer_embedder.py --input_strings "foo" "bar foo" "baz foo bar"
@@ -10,18 +12,39 @@ poetry run python embedding/infer_embedder.py --input_strings "foo" "bar foo" "b
 More relevant example:
 poetry run python embedding/infer_embedder.py --input_strings "hospital sprinklers"
 
+Rerank a wider candidate set with a cross-encoder, keeping the best 5:
+poetry run python embedding/infer_embedder.py --input_strings "hospital sprinklers" --top_k 5 --rerank
+
+Only search level 3+ nodes in chapters 7 to 10:
+poetry run python embedding/infer_embedder.py --input_strings "hospital sprinklers" --min_level 3 --chapters 7-10
+
+Dense search only (no BM25 leg):
+poetry run python embedding/infer_embedder.py --input_strings "hospital sprinklers" --retrieval_mode dense
+
 """
 
 import argparse
+import concurrent.futures
 import copy
 import json
 import os
+import time
 import typing
 
 from sentence_transformers import SentenceTransformer
 import pinecone
+import requests
 
 import utils
+import bm25
+import corpus_store
+import dedup
+import filter_index
+import hierarchical_index
+import jsonl_reader
+import lineage_table
+import rerank
+import sharded_index
 
 import sys
 sys.path.append("../")
@@ -32,17 +55,25 @@ DEFAULT_EMBEDDING_PATH = "embedding/embeddings.json"
 PINECONE_INDEX_NAME = "california-codes"
 PINECONE_ENVIRONMENT = "asia-southeast1-gcp-free"
 PINECONE_NAMESPACE = None
+PINECONE_INDEX_HOST = os.getenv("PINECONE_INDEX_HOST")
+DEFAULT_LEXICAL_INDEX_PATH = bm25.DEFAULT_LEXICAL_INDEX_PATH
+DEFAULT_LINEAGE_TABLE_PATH = lineage_table.DEFAULT_LINEAGE_TABLE_PATH
 
 
 # Convert list of strings to vectorized queries
 def vectorize_queries(
     input_strings: typing.List[str],
     embedding_model_path: str = DEFAULT_EMBEDDING_MODEL_PATH,
+    encoder=None,
 ):
+    """Encode with the given shared encoder (see encoder_server), or load the
+    model for this one call."""
+    preprocessed_texts = [text.lower() for text in input_strings]
+    if encoder is not None:
+        return encoder.encode(preprocessed_texts)
+
     # Load the embedding model
     model = SentenceTransformer(embedding_model_path)
-
-    preprocessed_texts = [text.lower() for text in input_strings]
     embeddings = model.encode(preprocessed_texts)
     return embeddings.tolist()
 
@@ -52,7 +83,13 @@ def query_pinecone(
     index_name: str = PINECONE_INDEX_NAME,
     namespace: str = PINECONE_NAMESPACE,
     top_k: int = 5,
+    filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    timeout: typing.Optional[float] = None,
 ):
+    """timeout: seconds each query request may take (default: no limit)."""
+    if PINECONE_INDEX_HOST:
+        return query_index_host(vectorized_queries, PINECONE_INDEX_HOST, namespace, top_k, filter, timeout)
+
     # Query pinecone
     pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=environment)
     index = pinecone.Index(index_name=index_name)
@@ -64,107 +101,245 @@ def query_pinecone(
                 top_k=top_k,
                 namespace=namespace,
                 include_metadata=True,
+                filter=filter,
+                _request_timeout=timeout,
             )
         )
     return results
 
 
+def query_index_host(
+    vectorized_queries: typing.List[typing.List[float]],
+    index_host: str,
+    namespace: str = PINECONE_NAMESPACE,
+    top_k: int = 5,
+    filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    timeout: typing.Optional[float] = None,
+):
+    """Same as query_pinecone, through the index's REST query endpoint."""
+    results = []
+    for vectorized_query in vectorized_queries:
+        request_body = {"vector": vectorized_query, "topK": top_k, "includeMetadata": True}
+        if namespace:
+            request_body["namespace"] = namespace
+        if filter:
+            request_body["filter"] = filter
+        response = requests.post(
+            index_host.rstrip("/") + "/query",
+            headers={"Api-Key": os.getenv("PINECONE_API_KEY", ""), "Content-Type": "application/json"},
+            json=request_body,
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        results.append(response.json())
+    return results
+
+
+class IndexHost:
+    """pinecone.Index-like client of an index's REST query endpoint."""
+
+    def __init__(self, index_host: str):
+        self.index_host = index_host
+
+    def query(self, vector, top_k: int = 5, namespace: str = PINECONE_NAMESPACE, filter=None, _request_timeout=None, **kwargs):
+        return query_index_host([vector], self.index_host, namespace, top_k, filter, _request_timeout)[0]
+
+
+def sharded_pinecone_index(
+    namespaces: typing.List[str],
+    environment: str = PINECONE_ENVIRONMENT,
+    index_name: str = PINECONE_INDEX_NAME,
+    **kwargs,
+) -> sharded_index.ShardedIndex:
+    """One shard per namespace of the hosted index."""
+    if PINECONE_INDEX_HOST:
+        index = IndexHost(PINECONE_INDEX_HOST)
+    else:
+        pinecone.init(api_key=os.environ["PINECONE_API_KEY"], environment=environment)
+        index = pinecone.Index(index_name=index_name)
+    sharded = sharded_index.ShardedIndex(**kwargs)
+    for namespace in namespaces:
+        sharded.add_shard(namespace, sharded_index.NamespaceShard(index, namespace))
+    return sharded
+
+
+def search(
+    input_strings: typing.List[str],
+    embedding_model_path: str = DEFAULT_EMBEDDING_MODEL_PATH,
+    environment: str = PINECONE_ENVIRONMENT,
+    index_name: str = PINECONE_INDEX_NAME,
+    namespace: str = PINECONE_NAMESPACE,
+    top_k: int = 5,
+    lexical_index: typing.Optional[bm25.BM25Index] = None,
+    filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    encoder=None,
+    vector_index=None,
+    shards: typing.Optional[typing.List[str]] = None,
+    timeout: typing.Optional[float] = None,
+):
+    """Vector search for each input string. If a lexical index is given, a
+    BM25 search runs alongside it and the two are merged by reciprocal-rank
+    fusion. The metadata filter (see filter_index.build_filter) restricts
+    both legs before scoring.
+
+    The vector search goes to the hosted index, or to vector_index if given
+    (a LocalIndex, a hierarchical_index.HierarchicalIndex, or a
+    sharded_index.ShardedIndex, which also takes the shards to query).
+    timeout limits each request to the hosted index (as pinecone's
+    _request_timeout, which the local indexes ignore), so a hung backend
+    doesn't hold the calling thread past it.
+
+    Returns one serializable result per input string. Each result carries a
+    "latency_ms" dict with the wall time of each leg."""
+
+    def _dense_leg():
+        start = time.perf_counter()
+        vectorized_queries = vectorize_queries(input_strings, embedding_model_path, encoder=encoder)
+        if vector_index is not None:
+            query_kwargs = {"shards": shards} if shards is not None else {}
+            if timeout is not None:
+                query_kwargs["_request_timeout"] = timeout
+            results = [
+                vector_index.query(
+                    vector=vectorized_query,
+                    top_k=top_k,
+                    namespace=namespace,
+                    include_metadata=True,
+                    filter=filter,
+                    **query_kwargs,
+                )
+                for vectorized_query in vectorized_queries
+            ]
+        else:
+            results = query_pinecone(
+                vectorized_queries=vectorized_queries,
+                environment=environment,
+                index_name=index_name,
+                namespace=namespace,
+                top_k=top_k,
+                filter=filter,
+                timeout=timeout,
+            )
+        results = [result.to_dict() if hasattr(result, "to_dict") else result for result in results]
+        return results, (time.perf_counter() - start) * 1000
+
+    def _lexical_leg():
+        start = time.perf_counter()
+        results = [lexical_index.query(input_string, top_k=top_k, filter=filter) for input_string in input_strings]
+        return results, (time.perf_counter() - start) * 1000
+
+    if lexical_index is None:
+        dense_results, dense_ms = _dense_leg()
+        for result in dense_results:
+            result["latency_ms"] = {"dense": dense_ms}
+        return dense_results
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        dense_future = executor.submit(_dense_leg)
+        lexical_future = executor.submit(_lexical_leg)
+        dense_results, dense_ms = dense_future.result()
+        lexical_results, lexical_ms = lexical_future.result()
+
+    start = time.perf_counter()
+    results = []
+    for dense_result, lexical_result in zip(dense_results, lexical_results):
+        result = bm25.reciprocal_rank_fusion([dense_result, lexical_result], top_k=top_k)
+        result["namespace"] = dense_result.get("namespace", "")
+        results.append(result)
+    fusion_ms = (time.perf_counter() - start) * 1000
+
+    for result in results:
+        result["latency_ms"] = {"dense": dense_ms, "lexical": lexical_ms, "fusion": fusion_ms}
+    return results
+
+
+def load_local_data(local_building_code_data_path: str):
+    """Load the parsed building code nodes used to build readable sections."""
+    global data
+    data = []
+    with open(local_building_code_data_path, 'r') as f:
+        for line in f:
+            data.append(json.loads(line))
+    return data
+
+
 NODE_TYPES = ["root", "chapter", "article", "section", "subsection", "number", "letter", "subletter", "roman_numeral"]
 
+_lineage_table = None
+
+
+def get_lineage_table():
+    """Lineage table built from the loaded `data`, on first use. Prefer
+    loading the precomputed sidecar table (lineage_table.load_lineage_table)."""
+    global _lineage_table
+    if _lineage_table is None:
+        _lineage_table = lineage_table.build_lineage_table(data)
+    return _lineage_table
+
+
 def component_key_to_readable_section(
     component_id: str,  # composite key
+    table: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None,
 ):
-    """Recursively find the parent, append all levels and titles together to
-    get a readable section."""
-
-    # derive from `data`
-    id_to_embedding = []
-    for d in data:
-        id_to_embedding.append(
-            {
-                "id": utils.tuple_to_composite_key(d["id"]),
-                "metadata": {
-                    "title": d["title"],
-                    "text": d["text"],
-                    "parent_id": utils.tuple_to_composite_key(d["parent_id"]),
-                },
-            }
-        )
+    """Readable section (e.g. "Chapter 13, Article 4, 13-412. ...") of a node:
+    a single lookup in the precomputed lineage table."""
+    if table is None:
+        table = get_lineage_table()
+    return lineage_table.readable_section(table, component_id)
+
 
-    def _get_parent_id_recursive(component_id_list: typing.List[str]):
-        """Recursively get the parent id."""
-        # find the parent id of the component
-        # id_to_embedding is a list of dicts
-        for ref_comp in id_to_embedding:
-            if ref_comp["id"] == component_id_list[-1]:
-                # hack: only return something if it's a subsection or below; don't display the root, chapter, or article
-                comp_type = utils.composite_key_to_tuple(ref_comp["id"])[0]  # this is like "level_2" etc
-                comp_type_int = int(comp_type.split("_")[1])
-                if comp_type_int >= 4:
-                    return (
-                        component_id_list
-                        + _get_parent_id_recursive([ref_comp["metadata"]["parent_id"]])
-                    )
-                else:
-                    return component_id_list
-
-        return component_id_list
-
-    lineage = list(reversed(_get_parent_id_recursive([component_id])))
-
-    # get all the titles
-    readable_section = []
-    for component_id in lineage:
-        for ref_comp in id_to_embedding:
-            if ref_comp["id"] == component_id:
-                if len((ref_title := ref_comp["metadata"]["title"]).split(" ")) <= 10:
-                    readable_section.append(ref_title)
-                break
-
-    ret = " ".join(readable_section)
-
-    # the first item in lineage is section (e.g. "13-412") -- 13 represents the chapter, 4 represents the article. The section is the full "13-412"
-    # Let's add "Chapter 13, Article 4," to the beginning of the string
-    try:
-        chapter = readable_section[0].split("-")[0]
-        article = readable_section[0].split("-")[1]
-        # here article could be "710.", "2104."
-        # what we need: "7", "21"
-        article = article.split(".")[0][0:-2]
-        ret = f"Chapter {chapter}, Article {article}, " + ret
-    except:
-        pass
-
-    return ret
 
+def load_local_embeddings(embedding_path: str = DEFAULT_EMBEDDING_PATH):
+    """Mapping from composite key to the local embedding record (with the
+    text, title and parent_id metadata)."""
+    # load the embeddings from file
+    with open(embedding_path, 'r') as f:
+        id_to_embedding = json.load(f)["vectors"]
+
+    # create a mapping from id to embedding
+    return {item["id"]: item for item in id_to_embedding}
 
 
 def augment_results_with_local_embeddings(
     results: typing.List[typing.Dict[str, typing.Any]],
     embedding_path: str = DEFAULT_EMBEDDING_PATH,
+    id_to_embedding: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    table: typing.Optional[typing.Dict[str, typing.Dict[str, typing.Any]]] = None,
+    corpus: typing.Optional[typing.Union[corpus_store.CorpusStore, jsonl_reader.JsonlReader]] = None,
+    duplicate_groups: typing.Optional[typing.Dict[str, typing.List[str]]] = None,
 ):
     """Results are missing crucial information like the text, title, and
-    parent_id. We'll augment the results with the local embeddings file."""
-    # load the embeddings from file
-    with open(embedding_path, 'r') as f:
-        id_to_embedding = json.load(f)["vectors"]
-
-    # create a mapping from id to embedding
-    id_to_embedding = {item["id"]: item for item in id_to_embedding}
+    parent_id. We'll augment the results with the local embeddings file
+    (or an already loaded id_to_embedding mapping, or the nodes themselves
+    from the compact corpus store or the jsonl reader, which need no
+    embeddings) and the lineage table. With duplicate_groups (see
+    dedup.duplicate_groups), each match also lists the near-duplicates it
+    stands for."""
+    if corpus is None and id_to_embedding is None:
+        id_to_embedding = load_local_embeddings(embedding_path)
 
     # augment the results with the local embeddings
 
     for result in results:
         for item in result["matches"]:
             original_composite_key = copy.copy(item["id"])
-            readable_lineage_itself = component_key_to_readable_section(original_composite_key)
-            readable_lineage_parent = component_key_to_readable_section(id_to_embedding[original_composite_key]["metadata"]["parent_id"])
-            item["id"] = readable_lineage_itself
+            if corpus is not None:
+                node = corpus[original_composite_key]
+                text, title, parent_key = node["text"], node["title"], utils.tuple_to_composite_key(node["parent_id"])
+            else:
+                metadata = id_to_embedding[original_composite_key]["metadata"]
+                text, title, parent_key = metadata["text"], metadata["title"], metadata["parent_id"]
+            item["id"] = component_key_to_readable_section(original_composite_key, table)
             item["metadata"] = {
-                "text": id_to_embedding[original_composite_key]["metadata"]["text"],
-                "title": id_to_embedding[original_composite_key]["metadata"]["title"],
-                "parent_id": readable_lineage_parent,
+                "text": text,
+                "title": title,
+                "parent_id": component_key_to_readable_section(parent_key, table),
+                # keep the composite keys too, so callers can dedupe/merge nodes
+                "key": original_composite_key,
+                "parent_key": parent_key,
             }
+            if duplicate_groups is not None:
+                item["metadata"]["duplicate_keys"] = duplicate_groups.get(original_composite_key, [])
 
     return results
 
@@ -179,32 +354,99 @@ if __name__ == "__main__":
     parser.add_argument('--pinecone_index_name', default=PINECONE_INDEX_NAME, help='Name of pinecone index to query.')
     parser.add_argument('--pinecone_environment', default=PINECONE_ENVIRONMENT, help='Name of pinecone environment to query.')
     parser.add_argument('--pinecone_namespace', default=PINECONE_NAMESPACE, help='Name of pinecone namespace to query.')
+    parser.add_argument('--pinecone_namespaces', nargs='+', default=None, help='Query these namespaces of the pinecone index as shards, in parallel.')
+    parser.add_argument('--shard_dir', default=None, help='Query the local index shards in this directory (see sharded_index.py) instead of pinecone.')
+    parser.add_argument('--hierarchical_index_path', default=None, help='Query this section-grouped local index (see hierarchical_index.py) instead of pinecone.')
+    parser.add_argument('--shards', nargs='+', default=None, help='Only query these shards (default: all, or those of --books).')
     parser.add_argument('--top_k', default=10, help='Number of results to return.')
+    parser.add_argument('--retrieval_mode', choices=['dense', 'hybrid'], default='hybrid', help='Dense vector search only, or dense + BM25 fused by reciprocal rank.')
+    parser.add_argument('--rerank', action='store_true', help='Rerank a wider candidate set with a cross-encoder before keeping top_k.')
+    parser.add_argument('--rerank_candidates', type=int, default=30, help='Number of candidates to fetch for reranking.')
+    parser.add_argument('--rerank_model', default=rerank.DEFAULT_RERANK_MODEL, help='Cross-encoder model used for reranking.')
+    parser.add_argument('--min_level', type=int, default=None, help='Only search nodes at this level or deeper.')
+    parser.add_argument('--max_level', type=int, default=None, help='Only search nodes at this level or shallower.')
+    parser.add_argument('--chapters', default=None, help='Only search these chapters, e.g. "7-10,12".')
+    parser.add_argument('--articles', default=None, help='Only search these articles, e.g. "1-3".')
+    parser.add_argument('--books', nargs='+', default=None, help='Only search these books.')
+    parser.add_argument('--lineage_table_path', default=DEFAULT_LINEAGE_TABLE_PATH, help='Path to the precomputed lineage table (built from the local data file if missing).')
+    parser.add_argument('--duplicate_map_path', default=dedup.DEFAULT_DUPLICATE_MAP_PATH, help='Near-duplicate map (see dedup.py); matches list the duplicates they stand for.')
+    parser.add_argument('--lexical_index_path', default=DEFAULT_LEXICAL_INDEX_PATH, help='Path to the BM25 index (built from the local data file if missing).')
 
     args = parser.parse_args()
 
-    with open(args.local_building_code_data_path, 'r') as f:
-        data = []
-        for line in f:
-            d = json.loads(line)
-            data.append(d)
+    # random access by id: only the nodes we return get read and decoded
+    reader = jsonl_reader.JsonlReader(args.local_building_code_data_path)
+    if os.path.exists(args.lineage_table_path):
+        _lineage_table = lineage_table.load_lineage_table(args.lineage_table_path)
+    else:
+        _lineage_table = lineage_table.build_lineage_table(list(reader.iter_nodes()))
+
+    duplicate_map = dedup.load_duplicate_map(args.duplicate_map_path) if os.path.exists(args.duplicate_map_path) else {}
 
     # HACK: combine input strings into just one string
     combined_input_string = " ".join(args.input_strings)
-    vectorized_queries = vectorize_queries([combined_input_string], args.embedding_model_path)
-    results = query_pinecone(
-        vectorized_queries=vectorized_queries,
+
+    lexical_index = None
+    if args.retrieval_mode == "hybrid":
+        if os.path.exists(args.lexical_index_path):
+            lexical_index = bm25.BM25Index.load(args.lexical_index_path)
+        else:
+            data = list(reader.iter_nodes())
+            lexical_index = bm25.BM25Index.from_nodes(
+                [
+                    d for d in data
+                    if utils.is_informative(d) and utils.tuple_to_composite_key(d["id"]) not in duplicate_map
+                ],
+                filter_fields_by_key=filter_index.node_filter_fields(data),
+            )
+
+    metadata_filter = filter_index.build_filter(
+        min_level=args.min_level,
+        max_level=args.max_level,
+        chapters=filter_index.parse_int_ranges(args.chapters) if args.chapters else None,
+        articles=filter_index.parse_int_ranges(args.articles) if args.articles else None,
+        books=args.books,
+    )
+
+    vector_index = None
+    if args.shard_dir:
+        vector_index = sharded_index.ShardedIndex.from_directory(args.shard_dir)
+    elif args.hierarchical_index_path:
+        vector_index = hierarchical_index.HierarchicalIndex.load(args.hierarchical_index_path)
+    elif args.pinecone_namespaces:
+        vector_index = sharded_pinecone_index(args.pinecone_namespaces, args.pinecone_environment, args.pinecone_index_name)
+
+    top_k = int(args.top_k)
+    results_serializable = search(
+        [combined_input_string],
+        embedding_model_path=args.embedding_model_path,
         environment=args.pinecone_environment,
         index_name=args.pinecone_index_name,
         namespace=args.pinecone_namespace,
-        top_k=args.top_k,
+        top_k=max(top_k, args.rerank_candidates) if args.rerank else top_k,
+        lexical_index=lexical_index,
+        filter=metadata_filter,
+        vector_index=vector_index,
+        shards=args.shards,
     )
 
-    # output in stdout is serialized json
-    results_serializable = []
-    for result in results:
-        results_serializable.append(result.to_dict())
-
-    augmented_results = augment_results_with_local_embeddings(results_serializable, args.embedding_path)
+    if args.rerank:
+        start = time.perf_counter()
+        reranker = rerank.CrossEncoderReranker(reader.section_texts(), model_name=args.rerank_model)
+        results_serializable = reranker.rerank([combined_input_string], results_serializable, top_n=top_k)
+        rerank_ms = (time.perf_counter() - start) * 1000
+        for result in results_serializable:
+            result["latency_ms"]["rerank"] = rerank_ms
+    # stdout is reserved for the json results, so report latency on stderr
+    for result in results_serializable:
+        print(f"retrieval latency (ms): {result['latency_ms']}", file=sys.stderr)
+
+    augmented_results = augment_results_with_local_embeddings(
+        results_serializable,
+        args.embedding_path,
+        corpus=reader,
+        duplicate_groups=dedup.duplicate_groups(duplicate_map),
+    )
 
+    # output in stdout is serialized json
     print(json.dumps(augmented_results))
@@ -0,0 +1,251 @@
+"""Random access to building_code_output.jsonl by node id.
+
+Resolving a handful of search results used to mean reading and json.loads-ing
+every line of the corpus. Instead, a sidecar offset index maps each node id to
+the byte offset and length of its line, and `JsonlReader` mmaps the jsonl and
+decodes only the records it is asked for, keeping the most recently used
+decoded nodes in an LRU.
+
+The offset index is an open-addressing hash table saved as a .npy file
+(rows of packed node id, offset, length; see corpus_store.pack_node_id), so
+it is mmapped rather than read at startup, and a lookup probes a slot or two
+whatever the size of the corpus. It is rebuilt when it is missing or older
+than the jsonl.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python embedding/jsonl_reader.py --data_path process_pdf_to_jsonl/building_code_output.jsonl
+
+Look up nodes:
+poetry run python embedding/jsonl_reader.py --keys 'level_3$60000002' 'level_8$60000003'
+"""
+
+import argparse
+import collections
+import collections.abc
+import json
+import mmap
+import os
+import threading
+import typing
+
+import numpy as np
+
+import corpus_store
+
+
+DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
+OFFSET_INDEX_SUFFIX = ".offsets.npy"
+DEFAULT_CACHE_SIZE = 4096
+
+EMPTY_SLOT = -1
+# the table is kept at most half full, so probe sequences stay short
+LOAD_FACTOR = 0.5
+_SLOT_DTYPE = np.dtype([("id", "<i8"), ("offset", "<i8"), ("length", "<i8")])
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK_64 = (1 << 64) - 1
+
+
+def offset_index_path(data_path: str) -> str:
+    return data_path + OFFSET_INDEX_SUFFIX
+
+
+def _slot(packed_id: int, mask: int) -> int:
+    # fibonacci hashing: packed ids are mostly sequential, which a plain
+    # modulo would cluster
+    return ((packed_id * _HASH_MULTIPLIER) & _MASK_64) >> 32 & mask
+
+
+def build_offset_index(data_path: str = DEFAULT_TEXT_DATA_PATH, index_path: typing.Optional[str] = None) -> int:
+    """Scan the jsonl once and write its offset index. Returns the number of
+    records."""
+    index_path = index_path or offset_index_path(data_path)
+    records = []
+    with open(data_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                records.append((corpus_store.pack_id(json.loads(line)["id"]), offset, len(line)))
+            offset += len(line)
+
+    size = 1
+    while size * LOAD_FACTOR < max(len(records), 1):
+        size *= 2
+    table = np.zeros(size, dtype=_SLOT_DTYPE)
+    table["id"] = EMPTY_SLOT
+    mask = size - 1
+    for packed_id, offset, length in records:
+        slot = _slot(packed_id, mask)
+        while table["id"][slot] not in (EMPTY_SLOT, packed_id):
+            slot = (slot + 1) & mask
+        # a repeated id points at its last line, like the dicts built from it
+        table[slot] = (packed_id, offset, length)
+
+    # written next to the old index and renamed over it, so concurrent
+    # readers never see half a table
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, table)
+    os.replace(tmp_path, index_path)
+    return len(records)
+
+
+def _is_stale(data_path: str, index_path: str) -> bool:
+    try:
+        return os.stat(index_path).st_mtime_ns < os.stat(data_path).st_mtime_ns
+    except FileNotFoundError:
+        return True
+
+
+class JsonlReader(collections.abc.Mapping):
+    """Composite key (or ["level_N", id] pair, or packed id) -> node dict,
+    decoded on demand. Decoded nodes are shared with the LRU: don't modify
+    them."""
+
+    def __init__(
+        self,
+        data_path: str = DEFAULT_TEXT_DATA_PATH,
+        index_path: typing.Optional[str] = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self.data_path = data_path
+        self.index_path = index_path or offset_index_path(data_path)
+        self.cache_size = cache_size
+        if _is_stale(data_path, self.index_path):
+            build_offset_index(data_path, self.index_path)
+
+        self._table = np.load(self.index_path, mmap_mode="r")
+        self._mask = len(self._table) - 1
+        self._file = open(data_path, 'rb')
+        # mmap can't map an empty file
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self._file.fileno()).st_size else b""
+        self._length = None
+
+        self._cache: typing.OrderedDict[int, typing.Dict[str, typing.Any]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _locate(self, packed_id: int) -> typing.Optional[typing.Tuple[int, int]]:
+        slot = _slot(packed_id, self._mask)
+        while True:
+            slot_id, offset, length = self._table[slot]
+            if slot_id == packed_id:
+                return int(offset), int(length)
+            if slot_id == EMPTY_SLOT:
+                return None
+            slot = (slot + 1) & self._mask
+
+    def _get_packed(self, packed_id: int) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        with self._lock:
+            node = self._cache.get(packed_id)
+            if node is not None:
+                self._cache.move_to_end(packed_id)
+                self.hits += 1
+                return node
+            self.misses += 1
+
+        location = self._locate(packed_id)
+        if location is None:
+            return None
+        offset, length = location
+        node = json.loads(self._data[offset:offset + length])
+
+        with self._lock:
+            self._cache[packed_id] = node
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return node
+
+    def get(self, key, default=None):
+        try:
+            packed_id = corpus_store.pack_key(key)
+        except (ValueError, TypeError):
+            return default
+        node = self._get_packed(packed_id)
+        return default if node is None else node
+
+    def __getitem__(self, key) -> typing.Dict[str, typing.Any]:
+        node = self.get(key)
+        if node is None:
+            raise KeyError(key)
+        return node
+
+    def __contains__(self, key) -> bool:
+        try:
+            return self._locate(corpus_store.pack_key(key)) is not None
+        except (ValueError, TypeError):
+            return False
+
+    def __len__(self) -> int:
+        if self._length is None:
+            self._length = int(np.count_nonzero(self._table["id"] != EMPTY_SLOT))
+        return self._length
+
+    def __iter__(self) -> typing.Iterator[str]:
+        """Composite keys, in table (not file) order."""
+        for packed_id in self._table["id"]:
+            if packed_id != EMPTY_SLOT:
+                yield corpus_store.composite_key(int(packed_id))
+
+    def iter_nodes(self) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """Every node, in file order, bypassing the LRU (for full scans)."""
+        start = 0
+        while start < len(self._data):
+            end = self._data.find(b"\n", start)
+            end = len(self._data) if end == -1 else end + 1
+            line = self._data[start:end]
+            if line.strip():
+                yield json.loads(line)
+            start = end
+
+    def section_texts(self) -> "SectionTexts":
+        return SectionTexts(self)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SectionTexts(collections.abc.Mapping):
+    """Composite key -> title + " " + text, as the reranker scores it."""
+
+    def __init__(self, reader: JsonlReader):
+        self.reader = reader
+
+    def __getitem__(self, key) -> str:
+        node = self.reader[key]
+        return node["title"] + " " + node["text"]
+
+    def __contains__(self, key) -> bool:
+        return key in self.reader
+
+    def __len__(self) -> int:
+        return len(self.reader)
+
+    def __iter__(self):
+        return iter(self.reader)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the offset index of a jsonl corpus, or look nodes up in it.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file.')
+    parser.add_argument('--index_path', default=None, help='Where to write the offset index (default: next to the data file).')
+    parser.add_argument('--keys', nargs='+', default=None, help='Composite keys to look up.')
+    args = parser.parse_args()
+
+    if args.keys:
+        with JsonlReader(args.data_path, args.index_path) as reader:
+            for key in args.keys:
+                print(json.dumps(reader.get(key)))
+    else:
+        count = build_offset_index(args.data_path, args.index_path)
+        print(f"Offset index: {count} records -> {args.index_path or offset_index_path(args.data_path)}")
@@ -0,0 +1,130 @@
+"""Precomputed lineage and breadcrumb table for every node of the corpus.
+
+The tree is static between ingestions, so instead of rebuilding readable
+lineage strings ("Chapter 13, Article 4, 13-412. ...") at query time, we
+compute them once per node and store them in a sidecar json table next to
+building_code_output.jsonl:
+
+{
+  "level_5$60000123": {
+    "ancestors": ["level_3$60000100", "level_2$60000099", ...],  <-- nearest first
+    "chapter": 13,            <-- from the CHAPTER ancestor, if any
+    "article": 4,             <-- from the ARTICLE ancestor, if any
+    "breadcrumb": "Chapter 13, Article 4, 13-412. Fire alarms. (a)"
+  },
+  ...
+}
+
+Query-time augmentation is then a single dict lookup per node.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python embedding/lineage_table.py
+"""
+
+import argparse
+import json
+import re
+import typing
+
+from corpus_store import CorpusStore, NO_ROW
+from filter_index import node_filter_fields
+
+
+DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
+DEFAULT_LINEAGE_TABLE_PATH = "process_pdf_to_jsonl/building_code_lineage.json"
+
+# breadcrumbs start at the section: root, chapter and article titles are
+# replaced by the "Chapter N, Article M, " prefix
+BREADCRUMB_MIN_LEVEL = 4
+BREADCRUMB_SECTION_LEVEL = BREADCRUMB_MIN_LEVEL - 1
+BREADCRUMB_MAX_TITLE_WORDS = 10
+# "13-412." -> chapter 13, article 4 (the last two digits number the section)
+SECTION_NUMBER_PATTERN = re.compile(r"^(\d+)-(\d*)(\d\d)\b")
+
+
+def _breadcrumb(
+    store: CorpusStore,
+    row: int,
+    fields: typing.Dict[str, typing.Any],
+) -> str:
+    # walk up from the node to its section (the first ancestor shallower than
+    # BREADCRUMB_MIN_LEVEL), then read the short titles top-down
+    lineage = [row]
+    while lineage[-1] != NO_ROW and store.levels[lineage[-1]] >= BREADCRUMB_MIN_LEVEL:
+        lineage.append(int(store.parent_rows[lineage[-1]]))
+
+    readable_section = []
+    for lineage_row in reversed(lineage):
+        if lineage_row != NO_ROW:
+            title = store.title(lineage_row).strip()
+            if title and len(title.split(" ")) <= BREADCRUMB_MAX_TITLE_WORDS:
+                readable_section.append(title)
+
+    breadcrumb = " ".join(readable_section)
+    if not readable_section:
+        return breadcrumb
+    # prefer the section number; fall back to the CHAPTER/ARTICLE ancestors
+    # when the title isn't a well-formed section number
+    match = SECTION_NUMBER_PATTERN.match(readable_section[0])
+    if match:
+        return f"Chapter {match.group(1)}, Article {match.group(2)}, " + breadcrumb
+    # the section node itself gets the same prefix as the nodes below it
+    if "chapter" in fields and "article" in fields and store.levels[row] >= BREADCRUMB_SECTION_LEVEL:
+        return f"Chapter {fields['chapter']}, Article {fields['article']}, " + breadcrumb
+    return breadcrumb
+
+
+def build_lineage_table(
+    nodes: typing.Union[CorpusStore, typing.List[typing.Dict[str, typing.Any]]],
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    store = nodes if isinstance(nodes, CorpusStore) else CorpusStore.from_nodes(nodes)
+    fields_by_key = node_filter_fields(store)
+
+    table = {}
+    for row in range(len(store)):
+        key = store.key(row)
+        entry = {
+            "ancestors": [store.key(ancestor_row) for ancestor_row in store.ancestor_rows(row)],
+            "breadcrumb": _breadcrumb(store, row, fields_by_key[key]),
+        }
+        for field in ("chapter", "article"):
+            if field in fields_by_key[key]:
+                entry[field] = fields_by_key[key][field]
+        table[key] = entry
+    return table
+
+
+def load_lineage_table(lineage_table_path: str = DEFAULT_LINEAGE_TABLE_PATH):
+    with open(lineage_table_path, 'r') as f:
+        return json.load(f)
+
+
+def readable_section(
+    lineage_table: typing.Dict[str, typing.Dict[str, typing.Any]],
+    component_id: str,
+) -> str:
+    """Readable breadcrumb of a node; empty for unknown ids (e.g. the root)."""
+    entry = lineage_table.get(component_id)
+    return entry["breadcrumb"] if entry else ""
+
+
+def write_lineage_table(
+    data_path: str = DEFAULT_TEXT_DATA_PATH,
+    lineage_table_path: str = DEFAULT_LINEAGE_TABLE_PATH,
+):
+    table = build_lineage_table(CorpusStore.from_jsonl(data_path))
+    with open(lineage_table_path, 'w') as f:
+        json.dump(table, f)
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the lineage/breadcrumb sidecar table.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file.')
+    parser.add_argument('--lineage_table_path', default=DEFAULT_LINEAGE_TABLE_PATH, help='Where to write the table.')
+    args = parser.parse_args()
+
+    table = write_lineage_table(args.data_path, args.lineage_table_path)
+    print(f"Lineage table: {len(table)} nodes -> {args.lineage_table_path}")
@@ -0,0 +1,245 @@
+"""A local, in-memory stand-in for the Pinecone index.
+
+Only the part of the Pinecone API that we actually use is implemented:
+upsert, query (including metadata filters on the fields in
+`filter_index.FILTER_FIELDS`), fetch, delete and describe_index_stats. Query results are plain
+dicts shaped like pinecone's `QueryResponse.to_dict()`, so callers don't need
+to care which store they are talking to.
+
+Useful for bulk-load testing, offline development and small corpora that fit
+in memory.
+
+Example usage:
+    index = LocalIndex.from_embeddings_file("embedding/embeddings.json")
+    index.query(vector=[0.1, ...], top_k=5, include_metadata=True)
+"""
+
+import json
+import threading
+import typing
+
+import numpy as np
+
+from filter_index import FilterIndex, FILTER_FIELDS
+
+
+DEFAULT_LOCAL_INDEX_PATH = "embedding/local_index.npz"
+
+
+class _Namespace:
+    """Vectors of one namespace. Rows are appended and overwritten by id, and
+    the dense matrix used for scoring is rebuilt lazily after writes."""
+
+    def __init__(self):
+        self.ids: typing.List[str] = []
+        self.id_to_row: typing.Dict[str, int] = {}
+        self.rows: typing.List[np.ndarray] = []
+        self.metadata: typing.List[typing.Dict[str, typing.Any]] = []
+        self._matrix = None
+        self._normalized = None
+        self._filter_index = None
+
+    def _invalidate(self):
+        self._matrix = None
+        self._normalized = None
+        self._filter_index = None
+
+    def upsert(self, vector_id, values, metadata):
+        values = np.asarray(values, dtype=np.float32)
+        if vector_id in self.id_to_row:
+            row = self.id_to_row[vector_id]
+            self.rows[row] = values
+            self.metadata[row] = metadata
+        else:
+            self.id_to_row[vector_id] = len(self.ids)
+            self.ids.append(vector_id)
+            self.rows.append(values)
+            self.metadata.append(metadata)
+        self._invalidate()
+
+    def delete(self, ids):
+        ids = set(ids)
+        keep = [row for row, vector_id in enumerate(self.ids) if vector_id not in ids]
+        self.ids = [self.ids[row] for row in keep]
+        self.rows = [self.rows[row] for row in keep]
+        self.metadata = [self.metadata[row] for row in keep]
+        self.id_to_row = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        self._invalidate()
+
+    def matrix(self, normalized: bool = False) -> np.ndarray:
+        if self._matrix is None:
+            if self.rows:
+                self._matrix = np.vstack(self.rows)
+            else:
+                self._matrix = np.zeros((0, 0), dtype=np.float32)
+        if not normalized:
+            return self._matrix
+        if self._normalized is None:
+            norms = np.linalg.norm(self._matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self._normalized = self._matrix / norms
+        return self._normalized
+
+    def filter_index(self) -> FilterIndex:
+        if self._filter_index is None:
+            self._filter_index = FilterIndex(
+                [{name: value for name, value in metadata.items() if name in FILTER_FIELDS} for metadata in self.metadata]
+            )
+        return self._filter_index
+
+
+class LocalIndex:
+    """Brute-force vector index with a pinecone-like interface.
+
+    metric: "cosine" (default, same as our hosted index) or "dotproduct".
+    """
+
+    def __init__(self, metric: str = "cosine"):
+        if metric not in ("cosine", "dotproduct"):
+            raise ValueError(f"Unsupported metric: {metric}")
+        self.metric = metric
+        self.namespaces: typing.Dict[str, _Namespace] = {}
+        self._lock = threading.RLock()
+
+    def _namespace(self, namespace: typing.Optional[str]) -> _Namespace:
+        # pinecone treats None and "" as the default namespace
+        return self.namespaces.setdefault(namespace or "", _Namespace())
+
+    def upsert(
+        self,
+        vectors: typing.Iterable[typing.Any],
+        namespace: typing.Optional[str] = None,
+        **kwargs,
+    ):
+        """Upsert vectors given as dicts ({"id", "values", "metadata"}) or as
+        (id, values[, metadata]) tuples. Upserting an existing id overwrites
+        it, so retrying a batch is always safe."""
+        count = 0
+        with self._lock:
+            ns = self._namespace(namespace)
+            for vector in vectors:
+                if isinstance(vector, dict):
+                    vector_id, values, metadata = vector["id"], vector["values"], vector.get("metadata") or {}
+                else:
+                    vector_id, values = vector[0], vector[1]
+                    metadata = vector[2] if len(vector) > 2 else {}
+                ns.upsert(vector_id, values, metadata)
+                count += 1
+        return {"upserted_count": count}
+
+    def query(
+        self,
+        vector: typing.List[float],
+        top_k: int = 10,
+        namespace: typing.Optional[str] = None,
+        include_metadata: bool = False,
+        include_values: bool = False,
+        filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        **kwargs,
+    ) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            ns = self._namespace(namespace)
+            matrix = ns.matrix(normalized=self.metric == "cosine")
+            ids, metadata = ns.ids, ns.metadata
+            # pre-filter: only the rows that pass the filter get scored
+            candidate_rows = ns.filter_index().candidates(filter) if filter else None
+        if candidate_rows is not None:
+            matrix = matrix[candidate_rows]
+        if matrix.shape[0] == 0:
+            return {"matches": [], "namespace": namespace or ""}
+
+        query = np.asarray(vector, dtype=np.float32)
+        if self.metric == "cosine":
+            norm = np.linalg.norm(query)
+            query = query / norm if norm else query
+        scores = matrix @ query
+
+        top_k = min(int(top_k), matrix.shape[0])
+        # argpartition first so we only sort top_k scores, not the full namespace
+        top_rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_rows = top_rows[np.argsort(-scores[top_rows])]
+
+        matches = []
+        for row in top_rows:
+            index_row = candidate_rows[row] if candidate_rows is not None else row
+            match = {
+                "id": ids[index_row],
+                "score": float(scores[row]),
+                "values": matrix[row].tolist() if include_values else [],
+            }
+            if include_metadata:
+                match["metadata"] = metadata[index_row]
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace or ""}
+
+    def fetch(self, ids: typing.List[str], namespace: typing.Optional[str] = None):
+        with self._lock:
+            ns = self._namespace(namespace)
+            vectors = {}
+            for vector_id in ids:
+                if vector_id in ns.id_to_row:
+                    row = ns.id_to_row[vector_id]
+                    vectors[vector_id] = {
+                        "id": vector_id,
+                        "values": ns.rows[row].tolist(),
+                        "metadata": ns.metadata[row],
+                    }
+        return {"vectors": vectors, "namespace": namespace or ""}
+
+    def delete(self, ids: typing.List[str], namespace: typing.Optional[str] = None):
+        with self._lock:
+            self._namespace(namespace).delete(ids)
+        return {}
+
+    def describe_index_stats(self):
+        with self._lock:
+            return {
+                "namespaces": {
+                    name: {"vector_count": len(ns.ids)} for name, ns in self.namespaces.items()
+                },
+                "total_vector_count": sum(len(ns.ids) for ns in self.namespaces.values()),
+            }
+
+    def save(self, path: str = DEFAULT_LOCAL_INDEX_PATH):
+        """Save as one .npz: a json manifest (ids, metadata) plus one float32
+        matrix per namespace."""
+        with self._lock:
+            manifest = {"metric": self.metric, "namespaces": []}
+            arrays = {}
+            for i, (name, ns) in enumerate(self.namespaces.items()):
+                manifest["namespaces"].append({"name": name, "ids": ns.ids, "metadata": ns.metadata})
+                arrays[f"values_{i}"] = ns.matrix()
+        np.savez(path, manifest=np.array(json.dumps(manifest)), **arrays)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_LOCAL_INDEX_PATH) -> "LocalIndex":
+        with np.load(path, allow_pickle=False) as npz:
+            manifest = json.loads(str(npz["manifest"]))
+            index = cls(metric=manifest["metric"])
+            for i, ns_manifest in enumerate(manifest["namespaces"]):
+                values = npz[f"values_{i}"]
+                index.upsert(
+                    [
+                        {"id": vector_id, "values": values[row], "metadata": metadata}
+                        for row, (vector_id, metadata) in enumerate(zip(ns_manifest["ids"], ns_manifest["metadata"]))
+                    ],
+                    namespace=ns_manifest["name"],
+                )
+        return index
+
+    @classmethod
+    def from_embeddings_file(
+        cls,
+        embedding_path: str,
+        namespace: typing.Optional[str] = None,
+        metric: str = "cosine",
+    ) -> "LocalIndex":
+        """Build from the embeddings.json written by create_embedding.py.
+
+        Vectors go to the default namespace unless one is given, the same as
+        the hosted upload in create_embedding.py."""
+        with open(embedding_path, 'r') as f:
+            embeddings = json.load(f)
+        index = cls(metric=metric)
+        index.upsert(embeddings["vectors"], namespace=namespace)
+        return index
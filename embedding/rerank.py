@@ -0,0 +1,121 @@
+"""Cross-encoder reranking of retrieved sections.
+
+Vector (and BM25) search is cheap but coarse, so we fetch a wider candidate set
+and let a small cross-encoder score each (query, section) pair, keeping only
+the best top_n for the GPT-4 prompt. All uncached pairs of a call are scored in
+a single batched forward pass on CPU, and pair scores are cached since the
+same sections come back for similar questions.
+
+Example usage:
+    reranker = CrossEncoderReranker(texts_by_id)
+    results = reranker.rerank(["hospital sprinklers"], results, top_n=5)
+"""
+
+import collections
+import threading
+import typing
+
+from sentence_transformers import CrossEncoder
+
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+DEFAULT_CACHE_SIZE = 50000
+DEFAULT_MAX_LENGTH = 256  # tokens per (query, section) pair; sections are truncated
+
+
+class ScoreCache:
+    """Thread-safe LRU of (query, section id) -> cross-encoder score."""
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._scores: typing.OrderedDict[typing.Tuple[str, str], float] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._scores:
+                self._scores.move_to_end(key)
+                self.hits += 1
+                return self._scores[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, score: float):
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_size:
+                self._scores.popitem(last=False)
+
+    def clear(self):
+        """Drop every score, e.g. once the section texts changed."""
+        with self._lock:
+            self._scores.clear()
+
+
+class CrossEncoderReranker:
+    def __init__(
+        self,
+        texts_by_id: typing.Optional[typing.Mapping[str, str]] = None,
+        model_name: str = DEFAULT_RERANK_MODEL,
+        max_length: int = DEFAULT_MAX_LENGTH,
+        cache: typing.Optional[ScoreCache] = None,
+    ):
+        """texts_by_id: composite key -> section text (title + text) to score
+        against the query; or pass it to every rerank call instead (e.g. the
+        texts of the corpus a request searched)."""
+        self.texts_by_id = texts_by_id if texts_by_id is not None else {}
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+        self.cache = cache if cache is not None else ScoreCache()
+
+    def score(
+        self,
+        pairs: typing.List[typing.Tuple[str, str]],
+        texts_by_id: typing.Optional[typing.Mapping[str, str]] = None,
+    ) -> typing.List[float]:
+        """Score (query, section id) pairs, running the model once over all
+        the pairs that aren't cached yet. texts_by_id overrides the texts
+        given to the constructor for this call."""
+        if texts_by_id is None:
+            texts_by_id = self.texts_by_id
+        scores: typing.List[typing.Optional[float]] = [self.cache.get(pair) for pair in pairs]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            model_inputs = [
+                [pairs[i][0], texts_by_id.get(pairs[i][1], "")] for i in missing
+            ]
+            predictions = self.model.predict(model_inputs, batch_size=len(model_inputs), show_progress_bar=False)
+            for i, prediction in zip(missing, predictions):
+                scores[i] = float(prediction)
+                self.cache.put(pairs[i], scores[i])
+        return scores
+
+    def rerank(
+        self,
+        queries: typing.List[str],
+        results: typing.List[typing.Dict[str, typing.Any]],
+        top_n: int = 5,
+        texts_by_id: typing.Optional[typing.Mapping[str, str]] = None,
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Reorder each result's matches by cross-encoder score and keep the
+        best top_n. results[i] holds the candidates for queries[i]."""
+        pairs = [
+            (query, match["id"])
+            for query, result in zip(queries, results)
+            for match in result["matches"]
+        ]
+        scores = iter(self.score(pairs, texts_by_id))
+
+        reranked = []
+        for result in results:
+            matches = []
+            for match in result["matches"]:
+                match = dict(match)
+                match["retrieval_score"] = match["score"]
+                match["score"] = next(scores)
+                matches.append(match)
+            matches.sort(key=lambda match: match["score"], reverse=True)
+            reranked.append({**result, "matches": matches[:top_n]})
+        return reranked
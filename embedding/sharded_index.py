@@ -0,0 +1,368 @@
+"""Sharded vector index: one shard per namespace or book.
+
+As the corpus grows past one chapter (every chapter, several jurisdictions and
+code years), one flat index makes every search scan everything and every
+rebuild re-embed everything. `ShardedIndex` keeps one shard per book (or per
+namespace of the hosted index) behind the same query interface as
+`LocalIndex`:
+
+- a query goes to the selected shards only (explicitly, or from the "book"
+  condition of the metadata filter), in parallel
+- each shard returns its own top_k, sorted; the lists are merged with a heap
+  (heapq.merge) and cut at top_k
+- a shard that fails or times out is left out and reported under
+  "shard_errors", the same way a timed out topic comes back empty in
+  retrieval; only when every shard fails does the query raise
+- a single shard can be rebuilt or reloaded from disk while the others keep
+  serving; in-flight queries finish on the shard they started with
+
+Local shards are LocalIndex .npz files, one per book, in a shard directory,
+or with --hierarchical, section-grouped HierarchicalIndex files (see
+hierarchical_index.py), so a query to a shard scores its sections first.
+
+Run from one level up (not from embedding directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python embedding/sharded_index.py --embedding_path embedding/embeddings.json --shard_dir embedding/shards
+
+Hierarchical shards:
+poetry run python embedding/sharded_index.py --embedding_path embedding/embeddings.json --shard_dir embedding/shards --hierarchical
+
+Rebuild one shard only:
+poetry run python embedding/sharded_index.py --embedding_path embedding/embeddings.json --shard_dir embedding/shards --rebuild ca_administrative_2022
+"""
+
+import argparse
+import concurrent.futures
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import typing
+
+from corpus_store import CorpusStore, DEFAULT_CORPUS_STORE_PATH, DEFAULT_TEXT_DATA_PATH
+from filter_index import FILTER_FIELDS
+from hierarchical_index import HierarchicalIndex, is_hierarchical_index_file
+from local_index import LocalIndex
+
+
+DEFAULT_SHARD_DIR = "embedding/shards"
+DEFAULT_SHARD_FIELD = "book"
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_SHARD_TIMEOUT_SECONDS = 10.0
+DEFAULT_RELOAD_INTERVAL_SECONDS = 30.0
+SHARD_FILE_SUFFIX = ".npz"
+TMP_SHARD_FILE_SUFFIX = ".tmp" + SHARD_FILE_SUFFIX  # build_shards' partial writes
+
+
+class NamespaceShard:
+    """One namespace of a pinecone-like index (the hosted index, a
+    LocalIndex, ...) used as a shard."""
+
+    def __init__(self, index, namespace: typing.Optional[str] = None):
+        self.index = index
+        self.namespace = namespace
+
+    def query(self, vector, top_k: int = 10, **kwargs):
+        result = self.index.query(vector=vector, top_k=top_k, namespace=self.namespace, **kwargs)
+        return result.to_dict() if hasattr(result, "to_dict") else result
+
+
+class _Shard:
+    __slots__ = ("name", "index", "loader", "path", "mtime_ns", "loaded_at")
+
+    def __init__(self, name, index, loader=None, path=None, mtime_ns=None):
+        self.name = name
+        self.index = index
+        self.loader = loader
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.loaded_at = time.time()
+
+
+def _mtime_ns(path: str) -> typing.Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_index_file(path: str):
+    """A LocalIndex or HierarchicalIndex saved at path, whichever it is."""
+    if is_hierarchical_index_file(path):
+        return HierarchicalIndex.load(path)
+    return LocalIndex.load(path)
+
+
+def shards_in_filter(flt: typing.Optional[typing.Dict[str, typing.Any]], shard_field: str = DEFAULT_SHARD_FIELD):
+    """Shard names a filter restricts the query to ({"book": "x"},
+    {"book": {"$eq": "x"}} or {"book": {"$in": [...]}}, also inside a
+    top-level "$and"), or None if it doesn't restrict them."""
+    if not flt:
+        return None
+    conditions = [flt] + list(flt.get("$and", []))
+    selected = None
+    for condition in conditions:
+        if shard_field not in condition:
+            continue
+        value = condition[shard_field]
+        if not isinstance(value, dict):
+            names = {value}
+        elif "$eq" in value:
+            names = {value["$eq"]}
+        elif "$in" in value:
+            names = set(value["$in"])
+        else:
+            continue
+        selected = names if selected is None else selected & names
+    return selected
+
+
+class ShardedIndex:
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        timeout_seconds: float = DEFAULT_SHARD_TIMEOUT_SECONDS,
+        shard_field: str = DEFAULT_SHARD_FIELD,
+    ):
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+        self.shard_field = shard_field
+        self._shards: typing.Dict[str, _Shard] = {}
+        self._lock = threading.RLock()
+        self._executor = None
+        self._executor_pid = None
+        self._reloader = None
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # the pool's threads don't survive a fork, so each process makes its own
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="shard-query"
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def add_shard(self, name: str, index, loader: typing.Optional[typing.Callable[[], typing.Any]] = None):
+        """Add (or replace) a shard. loader() rebuilds it, see rebuild_shard."""
+        with self._lock:
+            self._shards[name] = _Shard(name, index, loader=loader)
+
+    def add_shard_file(self, name: str, path: str):
+        """A LocalIndex (or HierarchicalIndex) shard saved at path; reloaded
+        when the file changes."""
+        mtime_ns = _mtime_ns(path)
+        index = load_index_file(path)
+        with self._lock:
+            self._shards[name] = _Shard(name, index, loader=lambda: load_index_file(path), path=path, mtime_ns=mtime_ns)
+
+    def remove_shard(self, name: str):
+        with self._lock:
+            self._shards.pop(name, None)
+
+    def shard_names(self) -> typing.List[str]:
+        with self._lock:
+            return sorted(self._shards)
+
+    def rebuild_shard(self, name: str, index=None):
+        """Swap in a new version of one shard: the given index, or a fresh one
+        from its loader. The other shards keep serving meanwhile."""
+        with self._lock:
+            shard = self._shards[name]
+        mtime_ns = _mtime_ns(shard.path) if shard.path else None
+        if index is None:
+            if shard.loader is None:
+                raise ValueError(f"shard {name} has no loader")
+            index = shard.loader()
+        with self._lock:
+            self._shards[name] = _Shard(name, index, loader=shard.loader, path=shard.path, mtime_ns=mtime_ns)
+
+    def reload_changed_shards(self) -> typing.List[str]:
+        """Reload the file-backed shards whose file changed since they were
+        loaded. A shard that fails to load keeps its old version."""
+        with self._lock:
+            changed = [
+                shard.name for shard in self._shards.values()
+                if shard.path and _mtime_ns(shard.path) not in (None, shard.mtime_ns)
+            ]
+        reloaded = []
+        for name in changed:
+            try:
+                self.rebuild_shard(name)
+                reloaded.append(name)
+            except Exception as e:
+                print(f"shard {name}: reload failed, keeping the old version: {e!r}")
+        return reloaded
+
+    def start_reloader(self, interval_seconds: float = DEFAULT_RELOAD_INTERVAL_SECONDS):
+        """Hot reload: check the shard files every interval_seconds."""
+        def _run():
+            while True:
+                time.sleep(interval_seconds)
+                for name in self.reload_changed_shards():
+                    print(f"shard {name}: reloaded")
+
+        with self._lock:
+            if self._reloader is None or not self._reloader.is_alive():
+                self._reloader = threading.Thread(target=_run, name="shard-reloader", daemon=True)
+                self._reloader.start()
+
+    def select_shards(
+        self,
+        shards: typing.Optional[typing.Iterable[str]] = None,
+        filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """Shard name -> shard index to query: the given shards, or those the
+        filter restricts the query to, or all of them."""
+        names = set(shards) if shards is not None else shards_in_filter(filter, self.shard_field)
+        with self._lock:
+            if names is None:
+                return {name: shard.index for name, shard in self._shards.items()}
+            return {name: self._shards[name].index for name in names if name in self._shards}
+
+    def query(
+        self,
+        vector: typing.List[float],
+        top_k: int = 10,
+        shards: typing.Optional[typing.Iterable[str]] = None,
+        filter: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        include_metadata: bool = False,
+        namespace: typing.Optional[str] = None,
+        **kwargs,
+    ) -> typing.Dict[str, typing.Any]:
+        """Top_k over the selected shards. Each match says which shard it came
+        from. namespace is ignored: each shard is its own namespace."""
+        selected = self.select_shards(shards, filter)
+        if not selected:
+            return {"matches": [], "namespace": "", "shards": []}
+
+        def _query_shard(name, index):
+            result = index.query(vector=vector, top_k=top_k, filter=filter, include_metadata=include_metadata, **kwargs)
+            result = result.to_dict() if hasattr(result, "to_dict") else result
+            return [dict(match, shard=name) for match in result["matches"]]
+
+        executor = self._get_executor()
+        futures = {executor.submit(_query_shard, name, index): name for name, index in selected.items()}
+        done, not_done = concurrent.futures.wait(futures, timeout=self.timeout_seconds)
+
+        shard_matches, shard_errors = [], {}
+        for future in not_done:
+            future.cancel()
+            shard_errors[futures[future]] = "timed out"
+        for future in done:
+            try:
+                shard_matches.append(future.result())
+            except Exception as e:
+                shard_errors[futures[future]] = f"{type(e).__name__}: {e}"
+        if shard_errors and not shard_matches:
+            raise RuntimeError(f"every shard failed: {shard_errors}")
+
+        # each shard's matches are sorted by score, so a k-way heap merge only
+        # looks at the first top_k of them
+        merged = heapq.merge(*shard_matches, key=lambda match: match["score"], reverse=True)
+        result = {
+            "matches": list(itertools.islice(merged, int(top_k))),
+            "namespace": "",
+            "shards": sorted(selected),
+        }
+        if shard_errors:
+            result["shard_errors"] = shard_errors
+        return result
+
+    def describe_index_stats(self):
+        with self._lock:
+            shards = dict(self._shards)
+        stats = {}
+        for name, shard in shards.items():
+            if hasattr(shard.index, "describe_index_stats"):
+                shard_stats = shard.index.describe_index_stats()
+                shard_stats = shard_stats.to_dict() if hasattr(shard_stats, "to_dict") else shard_stats
+                stats[name] = {"vector_count": shard_stats.get("total_vector_count"), "loaded_at": shard.loaded_at}
+            else:
+                stats[name] = {"loaded_at": shard.loaded_at}
+        return {"shards": stats}
+
+    @classmethod
+    def from_directory(cls, shard_dir: str = DEFAULT_SHARD_DIR, **kwargs) -> "ShardedIndex":
+        """One shard per <name>.npz in shard_dir, skipping the <name>.tmp.npz
+        files build_shards leaves behind if it is killed mid-write."""
+        index = cls(**kwargs)
+        for file_name in sorted(os.listdir(shard_dir)):
+            if file_name.endswith(SHARD_FILE_SUFFIX) and not file_name.endswith(TMP_SHARD_FILE_SUFFIX):
+                index.add_shard_file(file_name[:-len(SHARD_FILE_SUFFIX)], os.path.join(shard_dir, file_name))
+        return index
+
+
+def shard_path(shard_dir: str, name: str) -> str:
+    return os.path.join(shard_dir, name + SHARD_FILE_SUFFIX)
+
+
+def build_shards(
+    embedding_path: str,
+    shard_dir: str = DEFAULT_SHARD_DIR,
+    shard_field: str = DEFAULT_SHARD_FIELD,
+    only: typing.Optional[typing.Iterable[str]] = None,
+    store: typing.Optional[CorpusStore] = None,
+) -> typing.Dict[str, int]:
+    """Split embeddings.json into one LocalIndex shard per value of the
+    shard_field metadata field, or one HierarchicalIndex shard if the corpus
+    store (for the node tree) is given. With `only`, just those shards are
+    rewritten. Returns shard name -> vector count."""
+    with open(embedding_path, 'r') as f:
+        embeddings = json.load(f)
+    vectors_by_shard: typing.Dict[str, typing.List[typing.Dict[str, typing.Any]]] = {}
+    for vector in embeddings["vectors"]:
+        name = vector["metadata"].get(shard_field) or embeddings.get("namespace") or "default"
+        vectors_by_shard.setdefault(str(name), []).append(vector)
+
+    os.makedirs(shard_dir, exist_ok=True)
+    counts = {}
+    for name, vectors in vectors_by_shard.items():
+        if only is not None and name not in only:
+            continue
+        if store is not None:
+            index = HierarchicalIndex.from_vectors(vectors, store)
+        else:
+            index = LocalIndex()
+            # only the filterable fields, the same as the hosted upload
+            index.upsert(
+                {
+                    "id": vector["id"],
+                    "values": vector["values"],
+                    "metadata": {key: value for key, value in vector["metadata"].items() if key in FILTER_FIELDS},
+                }
+                for vector in vectors
+            )
+        # written next to the old file and renamed over it, so a reloading
+        # server never reads half a shard
+        path = shard_path(shard_dir, name)
+        tmp_path = path[:-len(SHARD_FILE_SUFFIX)] + TMP_SHARD_FILE_SUFFIX
+        index.save(tmp_path)
+        os.replace(tmp_path, path)
+        counts[name] = len(vectors)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Split the embeddings into one local index shard per book.')
+    parser.add_argument('--embedding_path', default="embedding/embeddings.json", help='Path to embedding json file.')
+    parser.add_argument('--shard_dir', default=DEFAULT_SHARD_DIR, help='Where to write the shards.')
+    parser.add_argument('--shard_field', default=DEFAULT_SHARD_FIELD, help='Metadata field to shard by.')
+    parser.add_argument('--rebuild', nargs='+', default=None, help='Only rewrite these shards.')
+    parser.add_argument('--hierarchical', action='store_true', help='Write section-grouped (coarse-to-fine) shards.')
+    parser.add_argument('--data_path', default=DEFAULT_TEXT_DATA_PATH, help='Path to local data jsonl file (node tree for --hierarchical).')
+    parser.add_argument('--corpus_store_path', default=DEFAULT_CORPUS_STORE_PATH, help='Compact corpus store, used instead of the jsonl if it exists.')
+    args = parser.parse_args()
+
+    store = None
+    if args.hierarchical:
+        if os.path.exists(args.corpus_store_path):
+            store = CorpusStore.load(args.corpus_store_path)
+        else:
+            store = CorpusStore.from_jsonl(args.data_path)
+    counts = build_shards(args.embedding_path, args.shard_dir, args.shard_field, only=args.rebuild, store=store)
+    for name, count in sorted(counts.items()):
+        print(f"Shard {name}: {count} vectors -> {shard_path(args.shard_dir, name)}")
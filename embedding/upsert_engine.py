@@ -0,0 +1,238 @@
+"""Concurrent, batched and retrying upserts into a vector store.
+
+Works with anything that has a pinecone-style
+`upsert(vectors=..., namespace=...)` method: a `pinecone.Index` or our
+`local_index.LocalIndex` stand-in.
+
+- vectors are chunked by estimated request payload size (and a hard cap on the
+  number of vectors per request), so large metadata doesn't blow the request
+  limit
+- batches are sent concurrently from a bounded thread pool, with a bounded
+  number of batches in flight so memory doesn't grow with the corpus
+- batches failing with a transient error (429, 5xx, connection errors) are
+  retried with exponential backoff. Upserts are keyed by id, so resending a
+  batch is idempotent. Other errors (e.g. a 400 for a dimension mismatch or
+  oversized metadata) would fail again, so they fail the batch right away
+- batches that still fail are reported (with their ids) instead of aborting the
+  whole load
+
+Example usage:
+    engine = UpsertEngine(index, max_workers=8)
+    report = engine.upsert(id_to_embedding)
+    print(report)
+"""
+
+import concurrent.futures
+import dataclasses
+import random
+import time
+import typing
+
+import requests
+import urllib3
+
+
+# pinecone limits: 2MB per upsert request, 1000 vectors per request
+DEFAULT_MAX_BATCH_BYTES = 2 * 1024 * 1024
+DEFAULT_MAX_BATCH_SIZE = 1000
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 0.5
+DEFAULT_PROGRESS_EVERY = 20  # batches
+
+# a float serialized in a request body takes roughly this many bytes;
+# estimating beats json.dumps-ing every vector just to measure it
+BYTES_PER_VALUE = 20
+BYTES_OVERHEAD_PER_VECTOR = 64
+
+# what the pinecone client (urllib3), our requests-based hosts and
+# LocalIndex raise when the request never got a response
+CONNECTION_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    urllib3.exceptions.MaxRetryError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+
+
+def is_retryable(error: Exception) -> bool:
+    """429s, 5xx and connection errors may pass on a retry; anything else
+    (4xx, bad vectors) would fail the same way again."""
+    status = getattr(error, "status", None)  # pinecone ApiException
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)  # requests.HTTPError
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return isinstance(error, CONNECTION_ERRORS)
+
+
+@dataclasses.dataclass
+class UpsertReport:
+    total_vectors: int = 0
+    upserted_count: int = 0
+    batch_count: int = 0
+    retried_batches: int = 0
+    failed_batches: typing.List[typing.Dict[str, typing.Any]] = dataclasses.field(default_factory=list)
+    elapsed_seconds: float = 0.0
+
+    @property
+    def failed_ids(self) -> typing.List[str]:
+        return [vector_id for batch in self.failed_batches for vector_id in batch["ids"]]
+
+    @property
+    def vectors_per_second(self) -> float:
+        if self.elapsed_seconds == 0:
+            return 0.0
+        return self.upserted_count / self.elapsed_seconds
+
+    def __str__(self):
+        return (
+            f"upserted {self.upserted_count}/{self.total_vectors} vectors in "
+            f"{self.batch_count} batches, {self.elapsed_seconds:.1f}s "
+            f"({self.vectors_per_second:.1f} vectors/s), "
+            f"{self.retried_batches} batches retried, {len(self.failed_batches)} batches failed"
+        )
+
+
+def estimate_vector_bytes(vector: typing.Dict[str, typing.Any]) -> int:
+    size = BYTES_OVERHEAD_PER_VECTOR + len(vector["id"]) + BYTES_PER_VALUE * len(vector["values"])
+    for key, value in (vector.get("metadata") or {}).items():
+        size += len(key) + len(str(value))
+    return size
+
+
+def strip_metadata(
+    vectors: typing.Iterable[typing.Dict[str, typing.Any]],
+    keep_fields: typing.Sequence[str] = (),
+):
+    """Yield copies of the vectors with only the keep_fields metadata, leaving
+    the inputs intact.
+
+    Our metadata holds the full section text, which is too large to store in
+    the hosted index; we look it up locally instead."""
+    for vector in vectors:
+        stripped = {"id": vector["id"], "values": vector["values"]}
+        metadata = {
+            key: value for key, value in (vector.get("metadata") or {}).items() if key in keep_fields
+        }
+        if metadata:
+            stripped["metadata"] = metadata
+        yield stripped
+
+
+def iter_batches(
+    vectors: typing.Iterable[typing.Dict[str, typing.Any]],
+    max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+):
+    """Greedily chunk vectors so that each batch stays under both limits.
+    A single vector larger than max_batch_bytes goes out as its own batch."""
+    batch, batch_bytes = [], 0
+    for vector in vectors:
+        vector_bytes = estimate_vector_bytes(vector)
+        if batch and (batch_bytes + vector_bytes > max_batch_bytes or len(batch) >= max_batch_size):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(vector)
+        batch_bytes += vector_bytes
+    if batch:
+        yield batch
+
+
+class UpsertEngine:
+    def __init__(
+        self,
+        index,
+        namespace: typing.Optional[str] = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+        progress_every: int = DEFAULT_PROGRESS_EVERY,
+        progress_callback: typing.Optional[typing.Callable[[UpsertReport], None]] = None,
+    ):
+        self.index = index
+        self.namespace = namespace
+        self.max_workers = max_workers
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.progress_every = progress_every
+        self.progress_callback = progress_callback or self._print_progress
+
+    @staticmethod
+    def _print_progress(report: UpsertReport):
+        print(
+            f"upserted {report.upserted_count}/{report.total_vectors} vectors "
+            f"({report.vectors_per_second:.1f} vectors/s)"
+        )
+
+    def _upsert_batch(self, batch) -> typing.Tuple[int, int]:
+        """Send one batch, retrying on transient errors (is_retryable).
+        Returns (upserted_count, attempts). Raises a permanent error right
+        away, and the last error once retries are exhausted."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.index.upsert(vectors=batch, namespace=self.namespace)
+                return len(batch), attempt
+            except Exception as e:
+                if attempt > self.max_retries or not is_retryable(e):
+                    raise
+                # exponential backoff with jitter, so workers that failed
+                # together (e.g. on a 429) don't retry together
+                delay = self.backoff_seconds * (2 ** (attempt - 1))
+                time.sleep(delay * (0.5 + random.random()))
+
+    def upsert(
+        self,
+        vectors: typing.Sequence[typing.Dict[str, typing.Any]],
+        include_metadata: bool = False,
+        metadata_fields: typing.Sequence[str] = (),
+    ) -> UpsertReport:
+        """Upsert all vectors. Unless include_metadata is set, only the
+        metadata_fields (e.g. small filterable fields) are uploaded."""
+        report = UpsertReport(total_vectors=len(vectors))
+        if not include_metadata:
+            vectors = strip_metadata(vectors, keep_fields=metadata_fields)
+        batches = iter_batches(vectors, self.max_batch_bytes, self.max_batch_size)
+
+        start = time.perf_counter()
+        # keep at most 2x max_workers batches in flight, so a 100k+ vector load
+        # doesn't materialize every request payload up front
+        max_in_flight = 2 * self.max_workers
+        in_flight: typing.Dict[concurrent.futures.Future, typing.List[str]] = {}
+
+        def _collect(done):
+            for future in done:
+                ids = in_flight.pop(future)
+                report.batch_count += 1
+                try:
+                    upserted_count, attempts = future.result()
+                    report.upserted_count += upserted_count
+                    if attempts > 1:
+                        report.retried_batches += 1
+                except Exception as e:
+                    report.failed_batches.append({"ids": ids, "error": repr(e)})
+                report.elapsed_seconds = time.perf_counter() - start
+                if self.progress_every and report.batch_count % self.progress_every == 0:
+                    self.progress_callback(report)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch in batches:
+                if len(in_flight) >= max_in_flight:
+                    done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    _collect(done)
+                future = executor.submit(self._upsert_batch, batch)
+                in_flight[future] = [vector["id"] for vector in batch]
+            _collect(concurrent.futures.wait(in_flight).done)
+
+        report.elapsed_seconds = time.perf_counter() - start
+        self.progress_callback(report)
+        return report
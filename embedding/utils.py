@@ -6,4 +6,9 @@ def tuple_to_composite_key(tup):
     return COMPOSITE_SPLITTER.join([str(item) for item in tup])
 
 def composite_key_to_tuple(key):
-    return tuple([int(item) if item.isdigit() else item for item in key.split(COMPOSITE_SPLITTER)])
\ No newline at end of file
+    return tuple([int(item) if item.isdigit() else item for item in key.split(COMPOSITE_SPLITTER)])
+
+def is_informative(node):
+    """Nodes with a short title and very little text (e.g. a bare "ARTICLE 1"
+    heading) aren't worth indexing."""
+    return not (len(node['title'].split(" ")) < 5 and len(node['text'].split(" ")) < 10)
@@ -0,0 +1,242 @@
+"""Append-only ledger of LLM calls, and a report over it.
+
+The query machines keep their last few raw responses in memory
+(all_responses), and the Prometheus metrics (chatbot_app/tracing.py) only
+hold totals since the process started. To see which prompt changes actually
+cut latency and spend, every LLM call of the chat pipeline is also appended
+to a local json lines file, one entry per call:
+
+    ts, request_id              when, and which question (the request trace id)
+    stage, model, prompt_hash   which call; prompt_hash changes with the
+                                system prompt (LLMScheduler.prompt_hash)
+    prompt_tokens, completion_tokens, total_tokens, cached_prompt_tokens
+    latency_ms, queue_ms        wall time of the call, and the part of it
+                                spent queued in the scheduler
+    cache                       "miss" (a call was made), "coalesced" (joined
+                                an identical in-flight call) or "hit" (the
+                                answer cache answered, no call at all)
+    retries, priority           scheduler retries; interactive or batch
+    error                       the exception, for failed calls
+
+Entries are appended with one write each to a file opened in append mode, so
+several processes can share one ledger.
+
+Example usage (report on the last day, by stage):
+poetry run python llm_ledger/llm_ledger.py --ledger_path chatbot_proj/llm_ledger.jsonl --since_hours 24
+
+Compare prompt versions:
+poetry run python llm_ledger/llm_ledger.py --group_by stage prompt_hash
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import typing
+
+
+DEFAULT_LEDGER_PATH = "chatbot_proj/llm_ledger.jsonl"
+PERCENTILES = (50, 90, 99)
+GROUP_FIELDS = ("stage", "model", "prompt_hash", "priority", "cache")
+
+
+def entry_from_response(
+    stage: str,
+    response: typing.Optional[typing.Dict[str, typing.Any]],
+    seconds: float,
+    call_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    request_id: typing.Optional[str] = None,
+    error: typing.Optional[BaseException] = None,
+) -> typing.Dict[str, typing.Any]:
+    """Ledger entry for one chat completion (response is None if it
+    failed)."""
+    call_info = call_info or {}
+    usage = (response or {}).get("usage") or {}
+    return {
+        "ts": time.time(),
+        "request_id": request_id,
+        "stage": stage,
+        "model": (response or {}).get("model") or call_info.get("model"),
+        "prompt_hash": call_info.get("prompt_hash"),
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+        "cached_prompt_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        "latency_ms": round(seconds * 1000, 3),
+        "queue_ms": round(call_info.get("queue_seconds", 0.0) * 1000, 3),
+        "cache": "coalesced" if call_info.get("coalesced") else "miss",
+        "retries": call_info.get("retries", 0),
+        "priority": call_info.get("priority", "interactive"),
+        "error": f"{type(error).__name__}: {error}" if error is not None else None,
+    }
+
+
+def cache_hit_entry(stage: str, seconds: float, request_id: typing.Optional[str] = None) -> typing.Dict[str, typing.Any]:
+    """Ledger entry for a question answered from the answer cache, so
+    tokens per question count it."""
+    return {
+        "ts": time.time(),
+        "request_id": request_id,
+        "stage": stage,
+        "model": None,
+        "prompt_hash": None,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "cached_prompt_tokens": 0,
+        "latency_ms": round(seconds * 1000, 3),
+        "queue_ms": 0.0,
+        "cache": "hit",
+        "retries": 0,
+        "priority": "interactive",
+        "error": None,
+    }
+
+
+class LLMLedger:
+    def __init__(self, path: str = DEFAULT_LEDGER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, entry: typing.Dict[str, typing.Any]):
+        line = json.dumps(entry, default=str) + "\n"
+        with self._lock:
+            # one write per entry: appends from several processes don't
+            # interleave within a line
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+_ledgers: typing.Dict[str, LLMLedger] = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(path: str = DEFAULT_LEDGER_PATH) -> LLMLedger:
+    """The process's shared ledger for path."""
+    with _ledgers_lock:
+        if path not in _ledgers:
+            _ledgers[path] = LLMLedger(path)
+        return _ledgers[path]
+
+
+def _reset_after_fork():
+    # a lock held by another thread at fork time would never be released
+    global _ledgers, _ledgers_lock
+    _ledgers = {}
+    _ledgers_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def read_entries(
+    path: str = DEFAULT_LEDGER_PATH,
+    since: typing.Optional[float] = None,
+) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    """Entries at or after the since timestamp. A torn last line (a writer
+    was killed mid-write) is skipped."""
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if since is None or entry.get("ts", 0) >= since:
+                yield entry
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(-(-q * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def report(
+    entries: typing.Iterable[typing.Dict[str, typing.Any]],
+    group_by: typing.Sequence[str] = ("stage",),
+) -> typing.Dict[str, typing.Any]:
+    """Latency percentiles, token totals and tokens per question, per group.
+    Tokens per question divide a group's tokens by every question in the
+    ledger (including answer cache hits), so the groups add up."""
+    groups: typing.Dict[typing.Tuple[typing.Any, ...], typing.List[typing.Dict[str, typing.Any]]] = {}
+    questions = set()
+    anonymous_calls = 0
+    for entry in entries:
+        groups.setdefault(tuple(entry.get(field) for field in group_by), []).append(entry)
+        if entry.get("request_id"):
+            questions.add(entry["request_id"])
+        else:
+            anonymous_calls += 1
+    # calls made outside a request (e.g. the CLIs) count as one question each
+    n_questions = len(questions) + anonymous_calls
+
+    rows = []
+    for key, group in sorted(groups.items(), key=lambda item: tuple(str(part) for part in item[0])):
+        calls = [entry for entry in group if entry.get("cache") != "hit"]
+        latencies = [entry["latency_ms"] for entry in calls]
+        # a coalesced entry's tokens and retries were spent (and counted) by
+        # the call it joined
+        billed = [entry for entry in calls if entry.get("cache") != "coalesced"]
+        total_tokens = sum(entry.get("total_tokens", 0) for entry in billed)
+        row = {field: value for field, value in zip(group_by, key)}
+        row.update({
+            "entries": len(group),
+            "calls": len(calls),
+            "errors": sum(1 for entry in group if entry.get("error")),
+            "coalesced": sum(1 for entry in group if entry.get("cache") == "coalesced"),
+            "cache_hits": len(group) - len(calls),
+            "retries": sum(entry.get("retries", 0) for entry in billed),
+            "prompt_tokens": sum(entry.get("prompt_tokens", 0) for entry in billed),
+            "completion_tokens": sum(entry.get("completion_tokens", 0) for entry in billed),
+            "total_tokens": total_tokens,
+            "tokens_per_question": total_tokens / n_questions if n_questions else 0.0,
+            **{f"p{q}_ms": percentile(latencies, q) for q in PERCENTILES},
+            "p50_queue_ms": percentile([entry.get("queue_ms", 0.0) for entry in calls], 50),
+        })
+        rows.append(row)
+    return {"questions": n_questions, "group_by": list(group_by), "rows": rows}
+
+
+def format_report(result: typing.Dict[str, typing.Any]) -> str:
+    group_by = result["group_by"]
+    columns = ["calls", "hits", "coal", "err", "retry", "p50_ms", "p90_ms", "p99_ms", "queue_ms", "prompt_tok", "compl_tok", "tok/question"]
+    widths = [
+        max([len(field)] + [len(str(row[field])) for row in result["rows"]]) for field in group_by
+    ]
+    lines = [f"{result['questions']} questions"]
+    lines.append(
+        " ".join(field.ljust(width) for field, width in zip(group_by, widths))
+        + " " + " ".join(column.rjust(12) for column in columns)
+    )
+    for row in result["rows"]:
+        values = [
+            row["calls"], row["cache_hits"], row["coalesced"], row["errors"], row["retries"],
+            f"{row['p50_ms']:.0f}", f"{row['p90_ms']:.0f}", f"{row['p99_ms']:.0f}", f"{row['p50_queue_ms']:.0f}",
+            row["prompt_tokens"], row["completion_tokens"], f"{row['tokens_per_question']:.1f}",
+        ]
+        lines.append(
+            " ".join(str(row[field]).ljust(width) for field, width in zip(group_by, widths))
+            + " " + " ".join(str(value).rjust(12) for value in values)
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report latency percentiles and token spend from the LLM call ledger.')
+    parser.add_argument('--ledger_path', default=DEFAULT_LEDGER_PATH, help='Path to the ledger json lines file.')
+    parser.add_argument('--since_hours', type=float, default=None, help='Only calls from the last this many hours.')
+    parser.add_argument('--group_by', nargs='+', default=["stage"], choices=GROUP_FIELDS, help='Fields to group the calls by.')
+    parser.add_argument('--priority', default=None, choices=("interactive", "batch"), help='Only calls of this priority (batch: cache pre-warming).')
+    parser.add_argument('--json', action='store_true', help='Print the report as json.')
+    args = parser.parse_args()
+
+    since = time.time() - args.since_hours * 3600 if args.since_hours is not None else None
+    entries = read_entries(args.ledger_path, since=since)
+    if args.priority:
+        entries = (entry for entry in entries if entry.get("priority") == args.priority)
+    result = report(entries, group_by=args.group_by)
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
@@ -0,0 +1,375 @@
+"""Shared scheduler for OpenAI chat completion calls.
+
+Both query machines (PromptQueryMachine, AppResponseMachine) send their
+requests through one scheduler per process, which:
+
+- coalesces identical in-flight requests (singleflight): while a request is
+  queued or running, the same request body joins it instead of going out again
+- enforces token buckets on requests per minute and tokens per minute
+  (OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT), plus a cap on concurrent calls
+- serves interactive requests before batch ones (e.g. cache pre-warming)
+- queues instead of failing: 429s and 5xx pause dispatching (honouring
+  Retry-After) and the request is retried, up to OPENAI_MAX_RETRIES times
+- keeps to its callers' deadlines: a caller waits at most its timeout (or
+  OPENAI_MAX_WAIT_SECONDS), a call is made, retried or kept waiting in the
+  queue only while one of its callers still waits for it, and its HTTP
+  timeout is cut to the time they have left
+- reports per call how it went (model, attempts, coalesced or not, time
+  queued) to callers that pass a call_info dict, for the LLM call ledger
+  (llm_ledger/llm_ledger.py)
+
+Run from one level up (not from llm_scheduler directory, but from bobbuildergpt)
+
+Example usage (fire a burst of identical and distinct requests):
+poetry run python llm_scheduler/llm_scheduler.py --num_requests 20 --distinct 5
+"""
+
+import argparse
+import concurrent.futures
+import copy
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import typing
+
+import requests
+
+
+OPENAI_URL = os.getenv("OPENAI_URL", "https://api.openai.com/v1/chat/completions")
+DEFAULT_RPM_LIMIT = float(os.getenv("OPENAI_RPM_LIMIT", "200"))
+DEFAULT_TPM_LIMIT = float(os.getenv("OPENAI_TPM_LIMIT", "40000"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+DEFAULT_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+DEFAULT_REQUEST_TIMEOUT_SECONDS = float(os.getenv("OPENAI_REQUEST_TIMEOUT_SECONDS", "120"))
+DEFAULT_MAX_WAIT_SECONDS = float(os.getenv("OPENAI_MAX_WAIT_SECONDS", "600"))
+# budgeted for the completion until the response reports the real usage
+DEFAULT_EXPECTED_COMPLETION_TOKENS = 500
+DEFAULT_RETRY_AFTER_SECONDS = 1.0
+MAX_RETRY_AFTER_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+INTERACTIVE = 0
+BATCH = 1
+
+
+class LLMRequestError(Exception):
+    def __init__(self, message: str, status_code: typing.Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class TokenBucket:
+    """rate_per_minute tokens, refilled continuously, bursting up to a
+    minute's worth."""
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.rate_per_second = rate_per_minute / 60
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be consumed. Amounts over the capacity
+        only need a full bucket (they drive the level negative)."""
+        self._refill()
+        needed = min(amount, self.capacity) - self.level
+        return max(0.0, needed / self.rate_per_second)
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def drain(self):
+        self._refill()
+        self.level = min(self.level, 0.0)
+
+
+def estimate_tokens(request_body: typing.Dict[str, typing.Any]) -> int:
+    prompt = sum((len(message.get("content", "")) + 3) // 4 + 4 for message in request_body.get("messages", []))
+    return prompt + request_body.get("max_tokens", DEFAULT_EXPECTED_COMPLETION_TOKENS)
+
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _retry_after_seconds(response: requests.Response) -> float:
+    """Retry-After is in seconds; OpenAI's x-ratelimit-reset-* headers are
+    durations like "1s", "6m0s" or "20ms"."""
+    retry_after = response.headers.get("retry-after")
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            pass
+    for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        parts = DURATION_PATTERN.findall(response.headers.get(header, ""))
+        if parts:
+            return min(sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts), MAX_RETRY_AFTER_SECONDS)
+    return DEFAULT_RETRY_AFTER_SECONDS
+
+
+class _Call:
+    def __init__(self, key: str, request_body: typing.Dict[str, typing.Any], priority: int, tokens: int):
+        self.key = key
+        self.request_body = request_body
+        self.priority = priority
+        self.tokens = tokens
+        self.attempts = 0
+        self.waiters = 1
+        self.enqueued = time.monotonic()
+        # when the last of its callers stops waiting
+        self.deadline = self.enqueued
+        self.dispatched: typing.Optional[float] = None
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        url: str = OPENAI_URL,
+        headers: typing.Optional[typing.Dict[str, str]] = None,
+        requests_per_minute: float = DEFAULT_RPM_LIMIT,
+        tokens_per_minute: float = DEFAULT_TPM_LIMIT,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        request_timeout_seconds: float = DEFAULT_REQUEST_TIMEOUT_SECONDS,
+        max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS,
+    ):
+        self.url = url
+        self.headers = headers if headers is not None else {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY", ""),
+        }
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.request_timeout_seconds = request_timeout_seconds
+        self.max_wait_seconds = max_wait_seconds
+
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._condition = threading.Condition()
+        self._queue: typing.List[typing.Tuple[int, int, _Call]] = []
+        self._sequence = itertools.count()
+        self._in_flight: typing.Dict[str, _Call] = {}  # queued or running, by key
+        self._running = 0
+        self._paused_until = 0.0
+        self._session = requests.Session()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-call")
+        self._dispatcher = threading.Thread(target=self._dispatch, name="llm-scheduler", daemon=True)
+        self._dispatcher.start()
+
+        self.stats = {"calls": 0, "coalesced": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+
+    @staticmethod
+    def request_key(request_body: typing.Dict[str, typing.Any]) -> str:
+        return hashlib.sha256(json.dumps(request_body, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def prompt_hash(request_body: typing.Dict[str, typing.Any]) -> str:
+        """Short hash of the system messages: changes with the prompt, not
+        with the question."""
+        system = [message.get("content", "") for message in request_body.get("messages", []) if message.get("role") == "system"]
+        return hashlib.sha256(json.dumps(system).encode()).hexdigest()[:12]
+
+    def chat_completion(
+        self,
+        request_body: typing.Dict[str, typing.Any],
+        priority: int = INTERACTIVE,
+        call_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        timeout: typing.Optional[float] = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """Blocking: the parsed response, once the call has been scheduled
+        and made (or joined). Raises LLMRequestError on non-retryable errors
+        or once retries are exhausted, TimeoutError after timeout seconds
+        (at most max_wait_seconds).
+
+        call_info, if given, is filled in with the model, prompt hash,
+        priority, whether the call joined an identical in-flight one, its
+        retries and the seconds it was queued (also when the call fails)."""
+        key = self.request_key(request_body)
+        wait = self.max_wait_seconds if timeout is None else max(min(timeout, self.max_wait_seconds), 0.0)
+        with self._condition:
+            call = self._in_flight.get(key)
+            coalesced = call is not None
+            if call is not None:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+                if priority < call.priority:
+                    # an interactive caller joined a batch call
+                    call.priority = priority
+                    self._queue = [(call.priority if c is call else p, seq, c) for p, seq, c in self._queue]
+                    heapq.heapify(self._queue)
+            else:
+                call = _Call(key, copy.deepcopy(request_body), priority, estimate_tokens(request_body))
+                self._in_flight[key] = call
+                self._push(call)
+            call.deadline = max(call.deadline, time.monotonic() + wait)
+
+        try:
+            response = call.future.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            self._abandon(call)
+            raise TimeoutError(f"LLM call not done after {wait:.1f}s")
+        finally:
+            if call_info is not None:
+                call_info.update({
+                    "model": request_body.get("model"),
+                    "prompt_hash": self.prompt_hash(request_body),
+                    "priority": "batch" if priority == BATCH else "interactive",
+                    "coalesced": coalesced,
+                    "retries": max(call.attempts - 1, 0),
+                    "queue_seconds": (call.dispatched or time.monotonic()) - call.enqueued,
+                })
+        # coalesced callers each get their own copy
+        return copy.deepcopy(response)
+
+    def _abandon(self, call: _Call):
+        """A caller stopped waiting; drop the call if it was the last one and
+        the call is still queued."""
+        with self._condition:
+            call.waiters -= 1
+            if call.waiters > 0 or not any(queued is call for _, _, queued in self._queue):
+                return
+            self._queue = [entry for entry in self._queue if entry[2] is not call]
+            heapq.heapify(self._queue)
+            self._in_flight.pop(call.key, None)
+            call.future.set_exception(TimeoutError("no caller is waiting"))
+            self._condition.notify_all()
+
+    def _push(self, call: _Call):
+        heapq.heappush(self._queue, (call.priority, next(self._sequence), call))
+        self._condition.notify_all()
+
+    def _dispatch(self):
+        with self._condition:
+            while True:
+                if not self._queue or self._running >= self.max_concurrency:
+                    self._condition.wait()
+                    continue
+                wait = self._paused_until - time.monotonic()
+                call = self._queue[0][2]
+                wait = max(wait, self._request_bucket.wait_time(1), self._token_bucket.wait_time(call.tokens))
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+
+                heapq.heappop(self._queue)
+                if time.monotonic() >= call.deadline:
+                    # every caller has given up on it
+                    self._in_flight.pop(call.key, None)
+                    call.future.set_exception(TimeoutError("no caller is waiting"))
+                    continue
+                if call.dispatched is None:
+                    call.dispatched = time.monotonic()
+                self._request_bucket.consume(1)
+                self._token_bucket.consume(call.tokens)
+                self._running += 1
+                self._executor.submit(self._call, call)
+
+    def _call(self, call: _Call):
+        call.attempts += 1
+        error: typing.Optional[LLMRequestError] = None
+        retry_after = None
+        response_json = None
+        # no one waits for a response after call.deadline
+        timeout = max(min(self.request_timeout_seconds, call.deadline - time.monotonic()), 0.1)
+        try:
+            response = self._session.post(self.url, headers=self.headers, json=call.request_body, timeout=timeout)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                retry_after = _retry_after_seconds(response)
+                error = LLMRequestError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+            elif response.status_code != 200:
+                error = LLMRequestError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+            else:
+                response_json = response.json()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            retry_after = DEFAULT_RETRY_AFTER_SECONDS
+            error = LLMRequestError(f"{type(e).__name__}: {e}")
+        except ValueError as e:
+            error = LLMRequestError(f"invalid response: {e}")
+
+        with self._condition:
+            self._running -= 1
+            self.stats["calls"] += 1
+            if (
+                retry_after is not None
+                and call.attempts <= self.max_retries
+                and time.monotonic() + retry_after < call.deadline
+            ):
+                # back off: everyone waits, not just this call
+                self.stats["retries"] += 1
+                if error.status_code == 429:
+                    self.stats["rate_limited"] += 1
+                    self._request_bucket.drain()
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                self._push(call)
+                return
+
+            del self._in_flight[call.key]
+            if response_json is not None:
+                usage = response_json.get("usage") or {}
+                if "total_tokens" in usage:
+                    # settle the estimate against the real usage
+                    self._token_bucket.consume(usage["total_tokens"] - call.tokens)
+                call.future.set_result(response_json)
+            else:
+                self.stats["failed"] += 1
+                call.future.set_exception(error)
+            self._condition.notify_all()
+
+
+_scheduler: typing.Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """The process's shared scheduler."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
+
+
+def _reset_after_fork():
+    # the dispatcher and call threads don't survive a fork
+    global _scheduler, _scheduler_lock
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send a burst of chat completion requests through the scheduler.')
+    parser.add_argument('--num_requests', type=int, default=20)
+    parser.add_argument('--distinct', type=int, default=5, help='Number of distinct request bodies in the burst.')
+    parser.add_argument('--batch_fraction', type=float, default=0.5, help='Fraction of requests sent as batch priority.')
+    parser.add_argument('--model', default="gpt-4-0613")
+    args = parser.parse_args()
+
+    scheduler = get_scheduler()
+
+    def _send(i):
+        start = time.perf_counter()
+        priority = BATCH if i < args.num_requests * args.batch_fraction else INTERACTIVE
+        body = {"model": args.model, "messages": [{"role": "user", "content": f"Say the number {i % args.distinct}."}]}
+        response = scheduler.chat_completion(body, priority=priority)
+        return i, priority, time.perf_counter() - start, response["choices"][0]["message"]["content"]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_requests) as executor:
+        for i, priority, seconds, content in executor.map(_send, range(args.num_requests)):
+            print(f"{i:3d} {'batch' if priority == BATCH else 'interactive':<12} {seconds:6.2f}s {content[:60]!r}")
+    print(scheduler.stats)
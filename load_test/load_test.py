@@ -0,0 +1,332 @@
+"""Load test the chat view offline, against stand-in LLM and vector store APIs.
+
+Starts the mock servers of mock_servers.py and (unless --target_url is given)
+a Django server pointed at them. Then --concurrency virtual users, each with
+its own session, ask questions the way the chat page does: submit a job to
+/chatbot/jobs and poll it until it finishes (--mode jobs, the default), so the
+job queue, its backpressure (503s) and the polling are measured too. With
+--mode sync they post the form to the synchronous chat view instead. It
+reports:
+
+- throughput, p50/p95/p99 latency (submit to answer) and error rate of the
+  whole request
+- the same per pipeline stage, from the request traces the server writes to
+  CODEQUERY_TRACE_LOG_PATH (see chatbot_app/tracing.py)
+
+The query encoder and the BM25/local corpus still run for real, so retrieval
+numbers are representative. Only the paid APIs are stubbed.
+
+Run from one level up (not from load_test directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python load_test/load_test.py --concurrency 8 --requests 200
+
+Slow, flaky LLM with streaming-like token rate:
+poetry run python load_test/load_test.py --concurrency 16 --llm_latency_ms 2000 --tokens_per_second 20 --llm_error_rate 0.05
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+import requests
+
+import mock_servers
+
+
+DEFAULT_SERVER_PORT = 8900
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS = 100
+DEFAULT_SERVER_STARTUP_SECONDS = 120
+DEFAULT_POLL_SECONDS = 1.0  # chat.html's POLL_MS
+MODES = ("jobs", "sync")
+DEFAULT_QUESTIONS = [
+    "How many exits does a two story office building need?",
+    "What are the sprinkler requirements for a hospital?",
+    "Do I need a permit to replace my water heater?",
+    "What is the minimum corridor width in a school?",
+    "Which rooms need smoke alarms in a single family home?",
+    "What fire rating is required between a garage and a dwelling?",
+    "How steep can an accessible ramp be?",
+    "What are the egress window requirements for a basement bedroom?",
+]
+CSRF_TOKEN_PATTERN = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(1, int(round(q / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies_ms: typing.List[float], errors: int, total: int, elapsed_seconds: float = None) -> typing.Dict[str, float]:
+    summary = {
+        "count": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p95_ms": percentile(latencies_ms, 95),
+        "p99_ms": percentile(latencies_ms, 99),
+    }
+    if elapsed_seconds is not None:
+        summary["throughput_rps"] = total / elapsed_seconds if elapsed_seconds else 0.0
+    return summary
+
+
+def start_server(port: int, env: typing.Dict[str, str]) -> subprocess.Popen:
+    # the app resolves its data paths relative to chatbot_proj/. The chat
+    # view creates a session and jobs are rows, so the db needs its tables
+    subprocess.run([sys.executable, "manage.py", "migrate", "--noinput"], cwd="chatbot_proj", env=env, check=True)
+    return subprocess.Popen(
+        [sys.executable, "manage.py", "runserver", "--noreload", f"127.0.0.1:{port}"],
+        cwd="chatbot_proj",
+        env=env,
+    )
+
+
+def wait_until_ready(url: str, timeout_seconds: float, server: typing.Optional[subprocess.Popen] = None):
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"server exited with code {server.returncode}")
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{url} not ready after {timeout_seconds}s")
+
+
+class VirtualUser:
+    """One browser session: fetch the form (for the CSRF token), then ask
+    through the job API (submit, then poll until the job finishes) like the
+    chat page, or post the form to the synchronous chat view."""
+
+    def __init__(
+        self,
+        chat_url: str,
+        user_role: str,
+        building_type: str,
+        timeout_seconds: float,
+        mode: str = "jobs",
+        poll_seconds: float = DEFAULT_POLL_SECONDS,
+    ):
+        # the job API lives under the chat URL
+        self.chat_url = chat_url if chat_url.endswith("/") else chat_url + "/"
+        self.user_role = user_role
+        self.building_type = building_type
+        self.timeout_seconds = timeout_seconds
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.session = requests.Session()
+        self.csrf_token = None
+
+    def _post(self, url: str, question: str) -> requests.Response:
+        return self.session.post(
+            url,
+            data={
+                "csrfmiddlewaretoken": self.csrf_token,
+                "user_role": self.user_role,
+                "building_type": self.building_type,
+                "user_message": question,
+            },
+            headers={"Referer": self.chat_url},
+            timeout=self.timeout_seconds,
+        )
+
+    def _ask_job(self, question: str, deadline: float) -> typing.Optional[str]:
+        response = self._post(self.chat_url + "jobs", question)
+        if response.status_code != 202:
+            # 503: the queue is full (backpressure)
+            return f"HTTP {response.status_code}"
+        job_url = self.chat_url + "jobs/" + response.json()["job_id"]
+        while True:
+            job = self.session.get(job_url, timeout=self.timeout_seconds)
+            if job.status_code != 200:
+                return f"HTTP {job.status_code}"
+            status = job.json()["status"]
+            if status == "done":
+                return None
+            if status not in ("queued", "running"):
+                return f"job {status}"
+            if time.monotonic() >= deadline:
+                return "job not done in time"
+            time.sleep(self.poll_seconds)
+
+    def ask(self, question: str) -> typing.Tuple[float, typing.Optional[str]]:
+        """Latency (ms) and error (None on success) of one question, from
+        submitting it to having the answer."""
+        start = time.perf_counter()
+        try:
+            if self.csrf_token is None:
+                form = self.session.get(self.chat_url, timeout=self.timeout_seconds)
+                self.csrf_token = CSRF_TOKEN_PATTERN.search(form.text).group(1)
+            if self.mode == "jobs":
+                error = self._ask_job(question, time.monotonic() + self.timeout_seconds)
+            else:
+                response = self._post(self.chat_url, question)
+                error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+        except (requests.RequestException, AttributeError, ValueError, KeyError) as e:
+            error = type(e).__name__
+        return (time.perf_counter() - start) * 1000, error
+
+
+def run_load(
+    chat_url: str,
+    questions: typing.List[str],
+    concurrency: int,
+    num_requests: int,
+    user_role: str = "homeowner",
+    building_type: str = "residential",
+    timeout_seconds: float = 300.0,
+    mode: str = "jobs",
+    poll_seconds: float = DEFAULT_POLL_SECONDS,
+):
+    """Run num_requests chat requests from concurrency virtual users. Returns
+    (latencies_ms, errors, elapsed_seconds)."""
+    next_request = iter(range(num_requests))
+    lock = threading.Lock()
+    latencies_ms, errors = [], collections.Counter()
+
+    def _user():
+        user = VirtualUser(chat_url, user_role, building_type, timeout_seconds, mode, poll_seconds)
+        while True:
+            with lock:
+                i = next(next_request, None)
+            if i is None:
+                return
+            latency_ms, error = user.ask(questions[i % len(questions)])
+            with lock:
+                latencies_ms.append(latency_ms)
+                if error:
+                    errors[error] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=_user) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies_ms, errors, time.perf_counter() - start
+
+
+def stage_report(trace_log_path: str) -> typing.Dict[str, typing.Dict[str, float]]:
+    """Latency and error rate per span name, over every trace in the log."""
+    durations, errors = collections.defaultdict(list), collections.Counter()
+    with open(trace_log_path, 'r') as f:
+        for line in f:
+            trace = json.loads(line)
+            for span in trace["spans"]:
+                durations[span["name"]].append(span["duration_ms"])
+                if "error" in span:
+                    errors[span["name"]] += 1
+    return {name: summarize(values, errors[name], len(values)) for name, values in sorted(durations.items())}
+
+
+def print_report(report: typing.Dict[str, typing.Any]):
+    def _row(name, summary):
+        throughput = f"{summary['throughput_rps']:8.2f}" if "throughput_rps" in summary else " " * 8
+        print(
+            f"{name:<24} {summary['count']:>6} {throughput} {summary['p50_ms']:>10.1f} {summary['p95_ms']:>10.1f} "
+            f"{summary['p99_ms']:>10.1f} {summary['error_rate']:>8.2%}"
+        )
+
+    print(f"{'stage':<24} {'count':>6} {'req/s':>8} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    _row("request", report["request"])
+    for name, summary in report.get("stages", {}).items():
+        _row(name, summary)
+    for error, count in report["request_errors"].items():
+        print(f"  {error}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the chat view against stand-in APIs.')
+    mock_servers.add_mock_server_arguments(parser)
+    parser.add_argument('--target_url', default=None, help='Chat URL of an already running server (must already point at the mocks).')
+    parser.add_argument('--server_port', type=int, default=DEFAULT_SERVER_PORT, help='Port of the Django server started by this script.')
+    parser.add_argument('--server_startup_seconds', type=float, default=DEFAULT_SERVER_STARTUP_SECONDS)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of concurrent virtual users.')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help='Number of measured chat requests.')
+    parser.add_argument('--mode', choices=MODES, default="jobs", help='Ask through the job API and poll, like the chat page (jobs), or post to the synchronous chat view (sync).')
+    parser.add_argument('--poll_seconds', type=float, default=DEFAULT_POLL_SECONDS, help='Seconds between job status polls (--mode jobs).')
+    parser.add_argument('--warmup_requests', type=int, default=1, help='Requests sent (and not measured) first, to load models.')
+    parser.add_argument('--questions_file', default=None, help='Questions to ask, one per line.')
+    parser.add_argument('--user_role', default="homeowner")
+    parser.add_argument('--building_type', default="residential")
+    parser.add_argument('--answer_cache', action='store_true', help='Keep the semantic answer cache enabled on the server.')
+    parser.add_argument('--trace_log_path', default=None, help='Trace log of the server, for per-stage numbers.')
+    parser.add_argument('--report_path', default=None, help='Also write the report here, as json.')
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file, 'r') as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    server = None
+    chat_url = args.target_url
+    trace_log_path = args.trace_log_path
+    if chat_url is None:
+        openai_url, index_host = mock_servers.start_mock_servers(args)
+        if trace_log_path is None:
+            trace_log_path = os.path.join(tempfile.mkdtemp(prefix="codequery_load_test_"), "traces.jsonl")
+        env = dict(
+            os.environ,
+            OPENAI_URL=openai_url,
+            PINECONE_INDEX_HOST=index_host,
+            CODEQUERY_TRACE_LOG_PATH=os.path.abspath(trace_log_path),
+            CODEQUERY_TRACE_SLOW_REQUEST_SECONDS="0",
+            CODEQUERY_ANSWER_CACHE_ENABLED="1" if args.answer_cache else "0",
+        )
+        env.setdefault("OPENAI_API_KEY", "mock")
+        env.setdefault("PINECONE_API_KEY", "mock")
+        chat_url = f"http://127.0.0.1:{args.server_port}/chatbot/"
+        server = start_server(args.server_port, env)
+
+    try:
+        # the app reports readiness once its warm start is done
+        wait_until_ready(chat_url.rstrip("/") + "/health", args.server_startup_seconds, server)
+        if args.warmup_requests:
+            run_load(
+                chat_url, questions, 1, args.warmup_requests, args.user_role, args.building_type,
+                mode=args.mode, poll_seconds=args.poll_seconds,
+            )
+        # only measure the traces of this run
+        if trace_log_path and os.path.exists(trace_log_path):
+            os.remove(trace_log_path)
+
+        latencies_ms, errors, elapsed_seconds = run_load(
+            chat_url, questions, args.concurrency, args.requests, args.user_role, args.building_type,
+            mode=args.mode, poll_seconds=args.poll_seconds,
+        )
+        report = {
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "request": summarize(latencies_ms, sum(errors.values()), len(latencies_ms), elapsed_seconds),
+            "request_errors": dict(errors),
+        }
+        if trace_log_path and os.path.exists(trace_log_path):
+            report["stages"] = stage_report(trace_log_path)
+        else:
+            print("no trace log, per-stage numbers are not available")
+
+        print_report(report)
+        if args.report_path:
+            with open(args.report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
@@ -0,0 +1,268 @@
+"""Local stand-ins for the paid APIs the chat pipeline calls, for load tests.
+
+- an OpenAI-style chat completions endpoint (POST /v1/chat/completions), with
+  configurable latency, token rate, streaming ("stream": true, server-sent
+  events) and injected errors (e.g. 429s)
+- a Pinecone-style index query endpoint (POST /query), returning matches
+  sampled from the real corpus ids so the app can augment them
+
+Point the app at them with OPENAI_URL and PINECONE_INDEX_HOST (see
+load_test.py, which does this for you).
+
+Run from one level up (not from load_test directory, but from bobbuildergpt)
+
+Example usage:
+poetry run python load_test/mock_servers.py --llm_latency_ms 800 --tokens_per_second 50
+"""
+
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+import typing
+import uuid
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_LLM_PORT = 8901
+DEFAULT_VECTOR_STORE_PORT = 8902
+DEFAULT_LLM_LATENCY_MS = 500.0
+DEFAULT_TOKENS_PER_SECOND = 40.0
+DEFAULT_COMPLETION_TOKENS = 120
+DEFAULT_VECTOR_STORE_LATENCY_MS = 30.0
+DEFAULT_EMBEDDING_PATH = "embedding/embeddings.json"
+DEFAULT_TEXT_DATA_PATH = "process_pdf_to_jsonl/building_code_output.jsonl"
+# the query expansion's system prompt asks for a list of topics
+EXPANSION_MARKER = "a list of strings"
+FILLER_WORDS = (
+    "the building shall comply with section requirements for fire sprinklers exits occupancy "
+    "load egress width accessible route rated assembly permit inspection approved"
+).split()
+
+
+def _estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def _jittered(milliseconds: float, jitter: float) -> float:
+    return max(0.0, milliseconds * (1 + random.uniform(-jitter, jitter))) / 1000
+
+
+class MockLLMConfig:
+    def __init__(
+        self,
+        latency_ms: float = DEFAULT_LLM_LATENCY_MS,
+        tokens_per_second: float = DEFAULT_TOKENS_PER_SECOND,
+        completion_tokens: int = DEFAULT_COMPLETION_TOKENS,
+        jitter: float = 0.2,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+    ):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+
+def mock_completion_content(messages: typing.List[typing.Dict[str, str]], completion_tokens: int) -> str:
+    """A reply the pipeline can parse: a json list of topics for the query
+    expansion, filler prose for the summarization."""
+    system = " ".join(m["content"] for m in messages if m.get("role") == "system")
+    last_user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    if EXPANSION_MARKER in system:
+        words = re.findall(r"[a-z]{4,}", last_user.lower().split("main_prompt")[-1])
+        topics = [" ".join(words[i:i + 3]) for i in range(0, min(len(words), 9), 3)] or ["building code"]
+        return json.dumps(topics)
+    return " ".join(random.choice(FILLER_WORDS) for _ in range(completion_tokens))
+
+
+class _LLMHandler(http.server.BaseHTTPRequestHandler):
+    config: MockLLMConfig
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: typing.Dict[str, typing.Any]):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        config = self.config
+
+        time.sleep(_jittered(config.latency_ms, config.jitter))
+        if random.random() < config.error_rate:
+            return self._send_json(config.error_status, {"error": {"message": "mock error", "type": "requests"}})
+
+        messages = request.get("messages", [])
+        content = mock_completion_content(messages, config.completion_tokens)
+        prompt_tokens = sum(_estimate_tokens(m.get("content", "")) for m in messages)
+        completion_tokens = _estimate_tokens(content)
+        response_id = "chatcmpl-" + uuid.uuid4().hex
+        model = request.get("model", "gpt-4-0613")
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            pieces = re.findall(r"\S+\s*", content)
+            for piece in pieces:
+                time.sleep(_estimate_tokens(piece) / config.tokens_per_second)
+                chunk = {
+                    "id": response_id, "object": "chat.completion.chunk", "model": model,
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        time.sleep(completion_tokens / config.tokens_per_second)
+        self._send_json(200, {
+            "id": response_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+
+def load_corpus_ids(
+    embedding_path: str = DEFAULT_EMBEDDING_PATH,
+    text_data_path: str = DEFAULT_TEXT_DATA_PATH,
+) -> typing.List[str]:
+    """Ids the app can augment: those of embeddings.json, or (if it hasn't
+    been built) the composite keys of the corpus."""
+    if os.path.exists(embedding_path):
+        with open(embedding_path, 'r') as f:
+            return [vector["id"] for vector in json.load(f)["vectors"]]
+    with open(text_data_path, 'r') as f:
+        return ["$".join(str(item) for item in json.loads(line)["id"]) for line in f]
+
+
+class _VectorStoreHandler(http.server.BaseHTTPRequestHandler):
+    ids: typing.List[str]
+    latency_ms: float
+    jitter: float
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(_jittered(self.latency_ms, self.jitter))
+        if self.path.rstrip("/") != "/query":
+            status, body = 404, {"message": f"unknown path {self.path}"}
+        else:
+            top_k = min(int(request.get("topK", 10)), len(self.ids))
+            scores = sorted((random.uniform(0.2, 0.9) for _ in range(top_k)), reverse=True)
+            status, body = 200, {
+                "matches": [
+                    {"id": vector_id, "score": score, "values": []}
+                    for vector_id, score in zip(random.sample(self.ids, top_k), scores)
+                ],
+                "namespace": request.get("namespace", ""),
+            }
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def _serve(handler, host: str, port: int) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_mock_llm(config: MockLLMConfig, host: str = DEFAULT_HOST, port: int = DEFAULT_LLM_PORT):
+    handler = type("LLMHandler", (_LLMHandler,), {"config": config})
+    return _serve(handler, host, port)
+
+
+def start_mock_vector_store(
+    ids: typing.List[str],
+    latency_ms: float = DEFAULT_VECTOR_STORE_LATENCY_MS,
+    jitter: float = 0.2,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_VECTOR_STORE_PORT,
+):
+    handler = type("VectorStoreHandler", (_VectorStoreHandler,), {"ids": ids, "latency_ms": latency_ms, "jitter": jitter})
+    return _serve(handler, host, port)
+
+
+def add_mock_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--host', default=DEFAULT_HOST, help='Interface the mock servers listen on.')
+    parser.add_argument('--llm_port', type=int, default=DEFAULT_LLM_PORT)
+    parser.add_argument('--vector_store_port', type=int, default=DEFAULT_VECTOR_STORE_PORT)
+    parser.add_argument('--llm_latency_ms', type=float, default=DEFAULT_LLM_LATENCY_MS, help='Time to first token.')
+    parser.add_argument('--tokens_per_second', type=float, default=DEFAULT_TOKENS_PER_SECOND, help='Completion token rate.')
+    parser.add_argument('--completion_tokens', type=int, default=DEFAULT_COMPLETION_TOKENS, help='Length of summarization replies.')
+    parser.add_argument('--llm_error_rate', type=float, default=0.0, help='Fraction of LLM calls that fail.')
+    parser.add_argument('--llm_error_status', type=int, default=429, help='HTTP status of failed LLM calls.')
+    parser.add_argument('--vector_store_latency_ms', type=float, default=DEFAULT_VECTOR_STORE_LATENCY_MS)
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative +/- jitter of all latencies.')
+    parser.add_argument('--embedding_path', default=DEFAULT_EMBEDDING_PATH, help='Ids returned by the vector store.')
+    parser.add_argument('--local_building_code_data_path', default=DEFAULT_TEXT_DATA_PATH, help='Ids, if there are no embeddings.')
+
+
+def start_mock_servers(args) -> typing.Tuple[str, str]:
+    """Start both servers from parsed args; returns (OPENAI_URL, PINECONE_INDEX_HOST)."""
+    start_mock_llm(
+        MockLLMConfig(
+            latency_ms=args.llm_latency_ms,
+            tokens_per_second=args.tokens_per_second,
+            completion_tokens=args.completion_tokens,
+            jitter=args.jitter,
+            error_rate=args.llm_error_rate,
+            error_status=args.llm_error_status,
+        ),
+        host=args.host,
+        port=args.llm_port,
+    )
+    start_mock_vector_store(
+        load_corpus_ids(args.embedding_path, args.local_building_code_data_path),
+        latency_ms=args.vector_store_latency_ms,
+        jitter=args.jitter,
+        host=args.host,
+        port=args.vector_store_port,
+    )
+    return (
+        f"http://{args.host}:{args.llm_port}/v1/chat/completions",
+        f"http://{args.host}:{args.vector_store_port}",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve stand-in OpenAI and vector store APIs.')
+    add_mock_server_arguments(parser)
+    args = parser.parse_args()
+
+    openai_url, index_host = start_mock_servers(args)
+    print(f"OPENAI_URL={openai_url}")
+    print(f"PINECONE_INDEX_HOST={index_host}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -17,12 +17,22 @@ import multiprocessing
 import pandas as pd
 import PyPDF2
 
+import sys
+sys.path.append("../embedding")
+import corpus_store
+import dedup
+import jsonl_reader
+import lineage_table
+
 
 text_list = []
 DEFAULT_STARTING_PAGE = 12
 DEFAULT_END_PAGE = 2000
 PDF_PATH = '../2022_ca_designer_collection_1st_ptg_rev.pdf'
 DEFAULT_OUTPUT_FILE="building_code_output.jsonl"
+DEFAULT_LINEAGE_TABLE_FILE="building_code_lineage.json"
+DEFAULT_CORPUS_STORE_FILE="building_code_corpus.npz"
+DEFAULT_DUPLICATE_MAP_FILE="building_code_duplicates.json"
 
 def open_pdf_to_dataframe(
     starting_page: int = DEFAULT_STARTING_PAGE,
@@ -177,6 +187,18 @@ if __name__ == "__main__":
         '-o', '--output_file', type=str, default=DEFAULT_OUTPUT_FILE,
         help='Output file name.'
     )
+    parser.add_argument(
+        '-l', '--lineage_table_file', type=str, default=DEFAULT_LINEAGE_TABLE_FILE,
+        help='Output file name for the lineage/breadcrumb sidecar table.'
+    )
+    parser.add_argument(
+        '-c', '--corpus_store_file', type=str, default=DEFAULT_CORPUS_STORE_FILE,
+        help='Output file name for the compact array-backed corpus store.'
+    )
+    parser.add_argument(
+        '-d', '--duplicate_map_file', type=str, default=DEFAULT_DUPLICATE_MAP_FILE,
+        help='Output file name for the near-duplicate map (only representatives get embedded).'
+    )
 
     args = parser.parse_args()
 
@@ -235,3 +257,10 @@ if __name__ == "__main__":
 
     ca_parsed_text = parse_text(ca_concatenated_string)
     write_to_file(ca_parsed_text, output_file=args.output_file)
+
+    # the tree is static from here on, so compute every node's lineage and
+    # readable breadcrumb once, instead of at query time
+    lineage_table.write_lineage_table(args.output_file, args.lineage_table_file)
+    corpus_store.CorpusStore.from_jsonl(args.output_file).save(args.corpus_store_file)
+    jsonl_reader.build_offset_index(args.output_file)
+    dedup.write_duplicate_map(args.output_file, args.duplicate_map_file)
@@ -1,35 +1,43 @@
 """Run an API call to openai GPT-4"""
 import argparse
+import collections
 import sys
-import requests
 import os
 import json
+import typing
 
 import openai
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from llm_scheduler import llm_scheduler  # noqa: E402
+
 # Set up OpenAI API credentials
 openai.organization = os.getenv("OPENAI_ORGANIZATION")
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-OPENAI_URL = "https://api.openai.com/v1/chat/completions"
-REQUEST_HEADER = {
-    "Content-Type": "application/json",
-    "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY"),
-}
+# only the most recent raw responses are kept around for debugging
+MAX_STORED_RESPONSES = 10
 
 # Define the GPT-4 prompt
 
 class PromptQueryMachine:
     def __init__(
-        self, user_role, building_type, messages_history: list = []
+        self, user_role, building_type, messages_history: typing.Optional[list] = None
     ):
-        self.messages_history = messages_history
+        # never share (or mutate) the caller's list: a mutable default here
+        # used to make every instance append to the same history forever
+        self.messages_history = []
         self.user_role = user_role
         self.building_type = building_type
         self.system_message = """output: a list of strings (["topic 1", ...]) that can form a vectorized query, separated by topics if distinct topics exist (no more than 3)"""
-        self.all_responses = []
+        self.all_responses = collections.deque(maxlen=MAX_STORED_RESPONSES)
+        # how the last call went (retries, coalesced, ...; see
+        # LLMScheduler.chat_completion), for the LLM call ledger
+        self.last_call_info: typing.Dict[str, typing.Any] = {}
 
         self.add_system_message_to_history()
+        # prior turns of this session (see chatbot_app/conversation_store.py)
+        self.messages_history.extend(messages_history or [])
 
     def add_message_to_history(self, message):
         self.messages_history.append({"role": "user", "content": message})
@@ -49,18 +57,28 @@ class PromptQueryMachine:
         self.messages_history.append({"role": "user", "content": str(fmtd_message)})
         return self.messages_history
 
-    def make_request(self):
+    def make_request(self, priority: typing.Optional[int] = None, timeout: typing.Optional[float] = None):
+        """priority: llm_scheduler.INTERACTIVE (default) or llm_scheduler.BATCH;
+        timeout: seconds to wait for the response at most (default: the
+        scheduler's max wait)"""
+        if priority is None:
+            priority = llm_scheduler.INTERACTIVE
         request_body = {
             "model": "gpt-4-0613",
             "messages": self.messages_history,
         }
-        response = requests.post(OPENAI_URL, headers=REQUEST_HEADER, json=request_body)
-        self.all_responses.append(response.json())
+        # shared, rate limited and coalesced with identical in-flight calls
+        # (see llm_scheduler/llm_scheduler.py); OPENAI_URL is read there
+        self.last_call_info = {}
+        response = llm_scheduler.get_scheduler().chat_completion(
+            request_body, priority=priority, call_info=self.last_call_info, timeout=timeout
+        )
+        self.all_responses.append(response)
 
         # parse the response, add to history
-        self.add_assistant_message_to_history(response.json()["choices"][0]["message"]["content"])
+        self.add_assistant_message_to_history(response["choices"][0]["message"]["content"])
 
-        return response.json()
+        return response
 
 
 if __name__ == "__main__":
@@ -2,33 +2,47 @@
 poetry run python queried_results_to_app_response.py --user_role architect \
     --building_type residential \
     --initial_user_message "What are the structural requirements?" \
-    --pinecone_response_list "[{\"topic\": \"text about topic\", \"index\": \"802.1c\", \"section_text\": \"text in section\"}, {\"topic\": \"text about second topic\", \"index\": \"52.1b\", \"section_text\": \"more text\"}]"
+    --pinecone_response_list "[{\"topic\": \"text about topic\", \"content\": [{\"index\": \"802.1c\", \"title\": \"Loads.\", \"text\": \"text in section\"}]}, {\"topic\": \"text about second topic\", \"content\": [{\"index\": \"52.1b\", \"title\": \"Beams.\", \"text\": \"more text\"}]}]"
 
 
-a more realistic example:
+a more realistic example (key, parent_key and score, as retrieval returns them,
+let sections be deduplicated, nested under their parent and ordered):
 poetry run python queried_results_to_app_response.py --user_role "building inspector" \
     --building_type hospitals \
     --initial_user_message "What are some checklist items for surgical clinics compliance?" \
-    --pinecone_response_list "[{\"topic\": \"clinics compliance requirements\", \"content\": [{\"index\": \"802.1c\", \"section_text\": \"all hospitals must have 1 sprinkler per room and hallway\"}]}]"
+    --pinecone_response_list "[{\"topic\": \"clinics compliance requirements\", \"content\": [{\"index\": \"802.1c\", \"title\": \"Sprinklers.\", \"text\": \"all hospitals must have 1 sprinkler per room and hallway\", \"key\": \"level_4\\$60000123\", \"parent_key\": \"level_3\\$60000100\", \"score\": 0.83}]}]"
 """
 
 import argparse
+import collections
 import sys
 import openai
 import json
 import os
+import typing
 
-import requests
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from llm_scheduler import llm_scheduler  # noqa: E402
+
+try:
+    import tiktoken
+except ImportError:  # optional, token counts are estimated without it
+    tiktoken = None
 
 # Initialize GPT-4 with your private key
 openai.organization = os.getenv("OPENAI_ORGANIZATION")
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-OPENAI_URL = "https://api.openai.com/v1/chat/completions"
-REQUEST_HEADER = {
-    "Content-Type": "application/json",
-    "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY"),
-}
+# only the most recent raw responses are kept around for debugging
+MAX_STORED_RESPONSES = 10
+
+# retrieved sections are packed into about this many prompt tokens: room for
+# the full text of 3 topics x 10 retrieved sections of typical length, with
+# gpt-4's 8k context leaving ~2k tokens for the answer
+DEFAULT_CONTEXT_TOKEN_BUDGET = 6000
+MIN_TRUNCATED_SECTION_TOKENS = 50
+GPT_TOKENIZER_ENCODING = "cl100k_base"  # gpt-4
+_gpt_encoding = tiktoken.get_encoding(GPT_TOKENIZER_ENCODING) if tiktoken is not None else None
 
 
 class AppResponseMachine:
@@ -48,7 +62,10 @@ class AppResponseMachine:
         self.user_role = user_role
         self.building_type = building_type
         self.system_message = AppResponseMachine.SYSTEM_MESSAGE
-        self.all_responses = []
+        self.all_responses = collections.deque(maxlen=MAX_STORED_RESPONSES)
+        # how the last call went (retries, coalesced, ...; see
+        # LLMScheduler.chat_completion), for the LLM call ledger
+        self.last_call_info: typing.Dict[str, typing.Any] = {}
 
         self.add_system_message_to_history()
 
@@ -68,38 +85,178 @@ class AppResponseMachine:
         self.messages_history.append({"role": "user", "content": str(message)})
         return self.messages_history
 
-    def make_request(self):
+    def make_request(self, priority: typing.Optional[int] = None, timeout: typing.Optional[float] = None):
+        """priority: llm_scheduler.INTERACTIVE (default) or llm_scheduler.BATCH;
+        timeout: seconds to wait for the response at most (default: the
+        scheduler's max wait)"""
+        if priority is None:
+            priority = llm_scheduler.INTERACTIVE
         request_body = {
             "model": "gpt-4-0613",
             "messages": self.messages_history,
         }
-        response = requests.post(OPENAI_URL, headers=REQUEST_HEADER, json=request_body)
-        self.all_responses.append(response.json())
+        # shared, rate limited and coalesced with identical in-flight calls
+        # (see llm_scheduler/llm_scheduler.py); OPENAI_URL is read there
+        self.last_call_info = {}
+        response = llm_scheduler.get_scheduler().chat_completion(
+            request_body, priority=priority, call_info=self.last_call_info, timeout=timeout
+        )
+        self.all_responses.append(response)
 
         # parse the response, add to history
-        self.add_assistant_message_to_history(response.json()["choices"][0]["message"]["content"])
+        self.add_assistant_message_to_history(response["choices"][0]["message"]["content"])
+
+        return response
+
+
+def count_tokens(text: str) -> int:
+    """Count GPT-4 tokens locally with tiktoken, or estimate (~4 characters
+    per token) if tiktoken isn't installed."""
+    if _gpt_encoding is not None:
+        return len(_gpt_encoding.encode(text))
+    return (len(text) + 3) // 4
+
 
-        return response.json()
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if _gpt_encoding is not None:
+        return _gpt_encoding.decode(_gpt_encoding.encode(text)[:max_tokens])
+    return text[: max_tokens * 4]
 
 
-def prep_input(pinecone_response_list: str):
-    # first turn str into list of tuples
-    pinecone_response_list = json.loads(pinecone_response_list.replace('\\"', '"'))
-    docs = []
-    for item in pinecone_response_list:
-        # item is a dict
-        query = item["topic"]
-        content_ret = str(item["content"])
-        docs.append(f"Query: {query}\nData: {content_ret}\n")
-    return "\n".join(docs)
+def _section_label(item) -> str:
+    # "index" is the readable lineage, e.g. "Chapter 1, Article 1, 1-101. Abbreviations."
+    index = item.get("index", "")
+    if isinstance(index, (list, tuple)):
+        index = " ".join(str(part) for part in index)
+    return str(index)
+
+
+def pack_context(
+    pinecone_response_list: typing.List[typing.Dict[str, typing.Any]],
+    token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+) -> str:
+    """Pack the retrieved sections of every topic into about token_budget
+    tokens of compact plain text.
+
+    - the same section retrieved for several topics is included once
+    - a section whose parent section was also retrieved is merged into the
+      parent's entry, instead of repeating the shared lineage
+    - no retrieved section is left out: the label and title line of every
+      section is budgeted first (the budget is only exceeded if those alone
+      don't fit)
+    - the texts then go in by their entry's best retrieval score until the
+      budget is used up; the first text that doesn't fit is truncated if
+      enough budget is left, the later ones are cut to "..."
+    - a section's context (its parent and nearby siblings, see
+      embedding/context_expansion.py) only gets the budget left over by
+      all the sections; it follows the section, unless that node was
+      retrieved itself or is already in an earlier section's context
+    """
+    topics = [item["topic"] for item in pinecone_response_list]
+
+    # dedupe sections across topics, keeping the best score
+    sections: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for position, item in enumerate(content for topic_item in pinecone_response_list for content in topic_item["content"]):
+        key = item.get("key") or _section_label(item)
+        score = item.get("score", 0.0)
+        if key in sections:
+            sections[key]["score"] = max(sections[key]["score"], score)
+            continue
+        sections[key] = {
+            "key": key,
+            "parent_key": item.get("parent_key"),
+            "label": _section_label(item),
+            "title": item.get("title", ""),
+            # section_text: the older format of the CLI examples
+            "text": item.get("text", item.get("section_text", "")),
+            "score": score,
+            "position": position,
+            "children": [],
+            "context": item.get("context", []),
+        }
+
+    # merge children into their parent when both were retrieved
+    entries = []
+    for section in sections.values():
+        parent = sections.get(section["parent_key"])
+        if parent is not None and parent is not section:
+            parent["children"].append(section)
+        else:
+            entries.append(section)
 
+    def _entry_score(section):
+        return max([section["score"]] + [_entry_score(child) for child in section["children"]])
 
+    def _walk(section, depth=0):
+        yield section, depth
+        for child in sorted(section["children"], key=lambda child: child["position"]):
+            yield from _walk(child, depth + 1)
 
-def get_gpt_prompt(user_role, building_type, initial_user_message, pinecone_response_list):
+    entries.sort(key=lambda section: (-_entry_score(section), section["position"]))
+    ordered = [pair for entry in entries for pair in _walk(entry)]
+    labels = [("  " * depth) + f"- {section['label']}: {section['title']}".rstrip() for section, depth in ordered]
+
+    header = "Queries: " + "; ".join(str(topic) for topic in topics) + "\nSections:\n"
+    # the retrieved sections first: every label (with "..." for a text cut
+    # off), then as many texts as fit
+    short_lines = [label + (" ..." if section["text"] else "") for (section, _), label in zip(ordered, labels)]
+    short_tokens = [count_tokens(line + "\n") for line in short_lines]
+    remaining = token_budget - count_tokens(header) - sum(short_tokens)
+    section_lines = []
+    for (section, depth), label, short_line, reserved in zip(ordered, labels, short_lines, short_tokens):
+        line = f"{label} {section['text']}".rstrip()
+        extra_tokens = count_tokens(line + "\n") - reserved
+        if extra_tokens <= remaining:
+            section_lines.append(line)
+            remaining -= extra_tokens
+        elif remaining >= MIN_TRUNCATED_SECTION_TOKENS:
+            section_lines.append(truncate_to_tokens(line, reserved + remaining - count_tokens("...")).rstrip() + "...")
+            remaining = 0
+        else:
+            section_lines.append(short_line)
+
+    # then their context, from the budget left over, in the same order
+    shown_context = set(sections)
+    context_lines: typing.List[typing.List[str]] = [[] for _ in ordered]
+    for lines, (section, depth) in zip(context_lines, ordered):
+        for context in section["context"]:
+            if context["key"] in shown_context:
+                continue
+            line = ("  " * (depth + 1)) + f"~ {context['relation']}: {context['title']} {context['text']}".rstrip()
+            line_tokens = count_tokens(line + "\n")
+            if line_tokens <= remaining:
+                lines.append(line)
+                shown_context.add(context["key"])
+                remaining -= line_tokens
+
+    packed = [header]
+    for line, lines in zip(section_lines, context_lines):
+        packed.append("\n".join([line] + lines) + "\n")
+    return "".join(packed)
+
+
+def prep_input(
+    pinecone_response_list: typing.Union[str, typing.List[typing.Dict[str, typing.Any]]],
+    token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+):
+    # first turn str into list of dicts
+    if isinstance(pinecone_response_list, str):
+        pinecone_response_list = json.loads(pinecone_response_list.replace('\\"', '"'))
+    return pack_context(pinecone_response_list, token_budget=token_budget)
+
+
+
+def get_gpt_prompt(
+    user_role,
+    building_type,
+    initial_user_message,
+    pinecone_response_list,
+    token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+):
     gpt_prompt = (
         f"I am a {user_role} looking for information about {building_type} building codes. "
         f"Here is my question: \n\n'{initial_user_message}'\n\n"
-        f"Relevant Documents:\n\n{prep_input(pinecone_response_list)}"
+        f"Relevant Documents:\n\n{prep_input(pinecone_response_list, token_budget=token_budget)}"
     )
     return gpt_prompt
 
@@ -127,12 +284,24 @@ if __name__ == "__main__":
     parser.add_argument(
         '--pinecone_response_list',
         type=str,
-        help='List of tuples (query, (index, section_text))',
+        help='Json list of {topic, content: [{index, title, text, key, parent_key, score}]}.',
+    )
+    parser.add_argument(
+        '--context_token_budget',
+        type=int,
+        default=DEFAULT_CONTEXT_TOKEN_BUDGET,
+        help='Max number of tokens of retrieved sections to put in the prompt.',
     )
 
     args = parser.parse_args()
 
-    gpt_prompt = get_gpt_prompt(args.user_role, args.building_type, args.initial_user_message, args.pinecone_response_list)
+    gpt_prompt = get_gpt_prompt(
+        args.user_role,
+        args.building_type,
+        args.initial_user_message,
+        args.pinecone_response_list,
+        token_budget=args.context_token_budget,
+    )
 
     arm = AppResponseMachine(args.user_role, args.building_type)
     arm.add_user_message_to_history(gpt_prompt)